@@ -0,0 +1,359 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from xgboost import XGBClassifier
+
+from functions import read_raw_data, expand_collisions, transform_raw_data, clean_df, impute_fit_df, impute_transform_df, \
+    impute_fit_df_TE, impute_transform_df_TE, CustomPreprocessor
+
+# benchmarks of each stage of the preprocessing and training, run on synthetic data so they don't need the STATS19 extract
+# usage: python benchmark.py --sizes 10000 100000 1000000 10000000
+# each run is appended to benchmark_results.jsonl and compared with the previous run, so that regressions show up as a ratio > 1
+
+# labels of each categorical variable, most common first, with the same cardinality as the STATS19 extract
+age_bands = ['26 - 35', '36 - 45', '46 - 55', '21 - 25', '16 - 20', '56 - 65', '11 - 15', '66 - 75', '6 - 10', 'Over 75', '0 - 5', 'Data missing or out of range']
+imd_deciles = ['Less deprived 40-50%', 'More deprived 40-50%', 'Less deprived 30-40%', 'More deprived 30-40%', 'Less deprived 20-30%', 'More deprived 20-30%',
+               'Less deprived 10-20%', 'More deprived 10-20%', 'Least deprived 10%', 'Most deprived 10%', 'Data missing or out of range']
+home_area_types = ['Urban area', 'Small town', 'Rural', 'Data missing or out of range']
+synthetic_labels = {
+    'day_of_week': ['Friday', 'Wednesday', 'Thursday', 'Tuesday', 'Monday', 'Saturday', 'Sunday'],
+    'first_road_class': ['A', 'Unclassified', 'B', 'C', 'A(M)', 'Motorway'],
+    'road_type': ['Single carriageway', 'Dual carriageway', 'Roundabout', 'One way street', 'Slip road', 'Unknown', 'Data missing or out of range'],
+    'junction_detail': ['Not at junction or within 20 metres', 'T or staggered junction', 'Crossroads', 'Roundabout', 'Private drive or entrance',
+                        'Other junction', 'Mini-roundabout', 'More than 4 arms (not roundabout)', 'Slip road', 'unknown (self reported)',
+                        'Data missing or out of range'],
+    'junction_control': ['Give way or uncontrolled', 'Auto traffic signal', 'Data missing or out of range', 'Stop sign', 'Authorised person',
+                         'unknown (self reported)'],
+    'second_road_class': ['Not at junction or within 20 metres', 'Unclassified', 'A', 'C', 'B', 'A(M)', 'Motorway', 'unknown (self reported)',
+                          'Data missing or out of range'],
+    'pedestrian_crossing_human_control': ['None within 50 metres', 'Control by school crossing patrol', 'Control by other authorised person',
+                                          'unknown (self reported)', 'Data missing or out of range'],
+    'pedestrian_crossing_physical_facilities': ['No physical crossing facilities within 50 metres', 'Pedestrian phase at traffic signal junction',
+                                                'Pelican, puffin, toucan or similar non-junction pedestrian light crossing', 'Zebra', 'Central refuge',
+                                                'Footbridge or subway', 'unknown (self reported)', 'Data missing or out of range'],
+    'light_conditions': ['Daylight', 'Darkness - lights lit', 'Darkness - no lighting', 'Darkness - lighting unknown', 'Darkness - lights unlit',
+                         'Data missing or out of range'],
+    'weather_conditions': ['Fine no high winds', 'Raining no high winds', 'Unknown', 'Other', 'Fine + high winds', 'Raining + high winds', 'Fog or mist',
+                           'Snowing no high winds', 'Snowing + high winds', 'Data missing or out of range'],
+    'road_surface_conditions': ['Dry', 'Wet or damp', 'Frost or ice', 'Snow', 'Flood over 3cm. deep', 'Mud', 'Oil or diesel', 'unknown (self reported)',
+                                'Data missing or out of range'],
+    'special_conditions_at_site': ['None', 'Roadworks', 'Road surface defective', 'Oil or diesel', 'Mud', 'Road sign or marking defective or obscured',
+                                   'Auto traffic signal - out', 'Auto signal part defective', 'unknown (self reported)', 'Data missing or out of range'],
+    'carriageway_hazards': ['None', 'Other object on road', 'Previous accident', 'Vehicle load on road', 'Any animal in carriageway (except ridden horse)',
+                            'Pedestrian in carriageway - not injured', 'Dog on road', 'Other animal on road', 'unknown (self reported)',
+                            'Data missing or out of range'],
+    'urban_or_rural_area': ['Urban', 'Rural', 'Unallocated'],
+    'sex_of_casualty': ['Male', 'Female', 'Data missing or out of range'],
+    'age_band_of_casualty': age_bands,
+    'casualty_severity': ['Slight', 'Serious', 'Fatal'],
+    'casualty_home_area_type': home_area_types,
+    'casualty_imd_decile': imd_deciles,
+    'vehicle_type': ['Car', 'Van / Goods 3.5 tonnes mgw or under', 'Taxi/Private hire car', 'Bus or coach (17 or more pass seats)',
+                     'Motorcycle 125cc and under', 'Goods 7.5 tonnes mgw and over', 'Motorcycle over 500cc', 'Pedal cycle', 'Motorcycle 50cc and under',
+                     'Goods over 3.5t. and under 7.5t', 'Motorcycle over 125cc and up to 500cc', 'Minibus (8 - 16 passenger seats)', 'Other vehicle',
+                     'Agricultural vehicle', 'Goods vehicle - unknown weight', 'Motorcycle - unknown cc', 'Mobility scooter', 'Electric motorcycle',
+                     'Ridden horse', 'Tram', 'Unknown vehicle type (self rep only)', 'Data missing or out of range'],
+    'towing_and_articulation': ['No tow/articulation', 'Articulated vehicle', 'Single trailer', 'Other tow', 'Caravan', 'Double or multiple trailer',
+                                'unknown (self reported)', 'Data missing or out of range'],
+    'vehicle_manoeuvre': ['Going ahead other', 'Turning right', 'Turning left', 'Overtaking moving vehicle - offside', 'Slowing or stopping', 'Moving off',
+                          'Going ahead left-hand bend', 'Going ahead right-hand bend', 'Changing lane to right', 'Changing lane to left', 'Parked',
+                          'Waiting to go - held up', 'U-turn', 'Overtaking static vehicle - offside', 'Overtaking - nearside', 'Waiting to turn right',
+                          'Reversing', 'Waiting to turn left', 'unknown (self reported)', 'Data missing or out of range'],
+    'vehicle_location_restricted_lane': ["On main c'way - not in restricted lane", 'Cycle lane (on main carriageway)', 'Bus lane',
+                                         'Cycleway or shared use footway (not part of  main carriageway)', 'Footway (pavement)', 'Not on carriageway',
+                                         'Busway (including guided busway)', 'On lay-by or hard shoulder', 'Entering lay-by or hard shoulder',
+                                         'Leaving lay-by or hard shoulder', 'Tram/Light rail track', 'unknown (self reported)', 'Data missing or out of range'],
+    'junction_location': ['Not at or within 20 metres of junction', 'Mid Junction - on roundabout or on main road',
+                          'Approaching junction or waiting/parked at junction approach', 'Entering main road', 'Cleared junction or waiting/parked at junction exit',
+                          'Leaving main road', 'Entering roundabout', 'Leaving roundabout', 'Entering from slip road', 'unknown (self reported)',
+                          'Data missing or out of range'],
+    'skidding_and_overturning': ['None', 'Skidded', 'Overturned', 'Skidded and overturned', 'Jackknifed', 'Jackknifed and overturned',
+                                 'unknown (self reported)', 'Data missing or out of range'],
+    'hit_object_in_carriageway': ['None', 'Kerb', 'Parked vehicle', 'Other object', 'Open door of vehicle', 'Road works', 'Bollard or refuge',
+                                  'Central island of roundabout', 'Previous accident', 'Any animal (except ridden horse)', 'Bridge (side)', 'Bridge (roof)',
+                                  'unknown (self reported)', 'Data missing or out of range'],
+    'vehicle_leaving_carriageway': ['Did not leave carriageway', 'Nearside', 'Offside', 'Nearside and rebounded', 'Straight ahead at junction',
+                                    'Offside and rebounded', 'Offside on to central reservation', 'Offside on to centrl res + rebounded',
+                                    'Offside - crossed central reservation', 'unknown (self reported)', 'Data missing or out of range'],
+    'hit_object_off_carriageway': ['None', 'Other permanent object', 'Wall or fence', 'Tree', 'Lamp post', 'Road sign or traffic signal',
+                                   'Telegraph or electricity pole', 'Near/Offside crash barrier', 'Bus stop or bus shelter', 'Central crash barrier',
+                                   'Entered ditch', 'Submerged in water', 'unknown (self reported)', 'Data missing or out of range'],
+    'first_point_of_impact': ['Front', 'Offside', 'Nearside', 'Back', 'Did not impact', 'unknown (self reported)', 'Data missing or out of range'],
+    'vehicle_left_hand_drive': ['No', 'Unknown', 'Yes', 'Data missing or out of range'],
+    'propulsion_code': ['Undefined', 'Petrol', 'Heavy oil', 'Hybrid electric', 'Electric', 'Gas/Bi-fuel', 'Petrol/Gas (LPG)', 'Gas', 'Gas Diesel',
+                        'Electric diesel', 'New fuel technology', 'Fuel cells', 'Steam', 'Data missing or out of range'],
+    'journey_purpose_of_driver': ['Not known', 'Other', 'Journey as part of work', 'Commuting to/from work', 'Pupil riding to/from school',
+                                  'Taking pupil to/from school', 'Other/Not known (2005-10)', 'Data missing or out of range'],
+    'sex_of_driver': ['Male', 'Female', 'Not known', 'Data missing or out of range'],
+    'age_band_of_driver': age_bands,
+    'driver_imd_decile': imd_deciles,
+    'driver_home_area_type': home_area_types
+}
+dates = pd.date_range("2018-01-01", "2022-12-31").strftime("%Y-%m-%d")
+times = [f"{h:02d}:{m:02d}" for h in range(24) for m in range(60)]
+# there are ~35,000 LSOAs in England and Wales
+n_lsoas = 35000
+# features used in the modelling notebooks, which the imputation and training stages are run on
+benchmark_features = ['age_of_casualty', 'engine_capacity_cc', 'vehicle_type', 'vehicle_subtype', 'junction_detail', 'vehicle_manoeuvre', 'sex_of_driver',
+                      'casualty_imd_decile', 'driver_imd_decile', 'time_period', 'light_conditions', 'weather_conditions', 'season', 'first_road_class',
+                      'second_road_class', 'road_type', 'speed_limit', 'junction_control', 'road_surface_conditions', 'propulsion_code',
+                      'urban_or_rural_area', 'first_point_of_impact', 'day_of_week', 'sex_of_casualty', 'towing_and_articulation']
+
+def sample_labels(rng, labels, size, p=None):
+    # samples a categorical with labels in roughly Zipf proportions (or p), so that rare categories are rare like in the real data
+    if p is None:
+        p = 1 / np.arange(1, len(labels) + 1)
+        p = p / p.sum()
+    return pd.Categorical.from_codes(rng.choice(len(labels), size=size, p=p), categories=labels)
+
+def synthetic_raw_data(n_rows, seed=0, first_collision=0):
+    # synthetic rows in the format of the extract written by get_raw_data.r: one row per casualty of each vehicle of each collision involving a bike,
+    # and one row for each vehicle without a casualty. Returns whole collisions only, so up to n_rows rows
+    # collisions are numbered from first_collision, so that chunks generated separately have distinct accident_index
+    rng = np.random.default_rng(seed)
+
+    # collisions have 1-4 vehicles - the first is always a bike, and ~5% of the others are too
+    n_collisions = n_rows // 2 + 1
+    n_vehicles = rng.choice([1, 2, 3, 4], size=n_collisions, p=[0.2, 0.7, 0.08, 0.02])
+    vehicle_collision = np.repeat(np.arange(n_collisions), n_vehicles)
+    vehicle_reference = np.arange(len(vehicle_collision)) - np.repeat(np.cumsum(n_vehicles) - n_vehicles, n_vehicles) + 1
+    is_bike = (vehicle_reference == 1) | (rng.random(len(vehicle_collision)) < 0.05)
+
+    # bikes have 1 casualty (~3% have 2), and ~10% of other vehicles have 1
+    n_casualties = np.where(is_bike, 1 + (rng.random(len(is_bike)) < 0.03), rng.random(len(is_bike)) < 0.1).astype(int)
+    row_vehicle = np.repeat(np.arange(len(is_bike)), np.maximum(n_casualties, 1))
+    row_collision = vehicle_collision[row_vehicle]
+    if len(row_vehicle) > n_rows:
+        keep = row_collision < row_collision[n_rows]
+        row_vehicle, row_collision = row_vehicle[keep], row_collision[keep]
+    n = len(row_vehicle)
+    n_collisions = row_collision[-1] + 1 if n > 0 else 0
+
+    # casualty_reference numbers the casualties of each collision from 1, and is missing for vehicles without a casualty
+    has_casualty = n_casualties[row_vehicle] > 0
+    casualty_number = np.cumsum(has_casualty)
+    collision_start = np.flatnonzero(np.diff(row_collision, prepend=-1))
+    casualty_number = casualty_number - np.repeat(casualty_number[collision_start] - has_casualty[collision_start], np.diff(np.append(collision_start, n)))
+    casualty_reference = np.where(has_casualty, casualty_number, np.nan)
+
+    df = pd.DataFrame({'accident_index': pd.Categorical.from_codes(row_collision, categories=[f"2022{i:09d}" for i in range(first_collision, first_collision + n_collisions)])})
+
+    # collision variables
+    collisions = pd.DataFrame({
+        'longitude': rng.uniform(-5.5, 1.7, n_collisions).round(6),
+        'latitude': rng.uniform(50.0, 55.8, n_collisions).round(6),
+        'date': sample_labels(rng, dates, n_collisions, np.full(len(dates), 1 / len(dates))),
+        'time': sample_labels(rng, times, n_collisions, np.full(len(times), 1 / len(times))),
+        'number_of_vehicles': n_vehicles[:n_collisions],
+        'speed_limit': rng.choice([30, 20, 40, 60, 50, 70], size=n_collisions, p=[0.6, 0.2, 0.08, 0.07, 0.03, 0.02])
+    })
+    for col in ['day_of_week', 'first_road_class', 'road_type', 'junction_detail', 'junction_control', 'second_road_class',
+                'pedestrian_crossing_human_control', 'pedestrian_crossing_physical_facilities', 'light_conditions', 'weather_conditions',
+                'road_surface_conditions', 'special_conditions_at_site', 'carriageway_hazards', 'urban_or_rural_area']:
+        collisions[col] = sample_labels(rng, synthetic_labels[col], n_collisions)
+    # junction_control is missing (rather than a label) when not at a junction
+    collisions.loc[rng.random(n_collisions) < 0.4, 'junction_control'] = np.nan
+    for col in collisions.columns:
+        df[col] = collisions[col].take(row_collision).reset_index(drop=True)
+    # the extract has the location and date of the collision on both sides of the join with involving_cyclist
+    df = df.rename(columns={'longitude': 'longitude.x', 'latitude': 'latitude.x', 'date': 'date.x'})
+    df['longitude.y'], df['latitude.y'], df['date.y'] = df['longitude.x'], df['latitude.x'], df['date.x']
+
+    # vehicle and driver variables
+    df['vehicle_reference'] = vehicle_reference[row_vehicle]
+    n_vehicles_used = row_vehicle[-1] + 1 if n > 0 else 0
+    vehicle_type = sample_labels(rng, synthetic_labels['vehicle_type'], n_vehicles_used)
+    vehicle_type[is_bike[:n_vehicles_used]] = 'Pedal cycle'
+    vehicles = pd.DataFrame({'vehicle_type': vehicle_type})
+    for col in ['towing_and_articulation', 'vehicle_manoeuvre', 'vehicle_location_restricted_lane', 'junction_location', 'skidding_and_overturning',
+                'hit_object_in_carriageway', 'vehicle_leaving_carriageway', 'hit_object_off_carriageway', 'first_point_of_impact',
+                'vehicle_left_hand_drive', 'propulsion_code', 'journey_purpose_of_driver', 'sex_of_driver', 'driver_imd_decile', 'driver_home_area_type']:
+        vehicles[col] = sample_labels(rng, synthetic_labels[col], n_vehicles_used)
+    # bikes have no engine, and ~20% of other vehicles have a missing engine size, age or driver age
+    vehicles['engine_capacity_cc'] = np.where(is_bike[:n_vehicles_used] | (rng.random(n_vehicles_used) < 0.2), np.nan,
+                                              rng.lognormal(7.3, 0.5, n_vehicles_used).round())
+    vehicles['age_of_vehicle'] = np.where(rng.random(n_vehicles_used) < 0.2, np.nan, rng.integers(0, 25, n_vehicles_used))
+    vehicles['age_of_driver'] = np.where(rng.random(n_vehicles_used) < 0.1, np.nan, rng.integers(10, 90, n_vehicles_used))
+    vehicles['age_band_of_driver'] = age_band(vehicles['age_of_driver'])
+    vehicles['lsoa_of_driver'] = lsoas(rng, n_vehicles_used)
+    for col in vehicles.columns:
+        df[col] = vehicles[col].take(row_vehicle).reset_index(drop=True)
+
+    # casualty variables, missing for vehicles without a casualty
+    df['casualty_reference'] = casualty_reference
+    for col in ['sex_of_casualty', 'casualty_home_area_type', 'casualty_imd_decile']:
+        df[col] = sample_labels(rng, synthetic_labels[col], n)
+    df['casualty_severity'] = sample_labels(rng, synthetic_labels['casualty_severity'], n, [0.8, 0.19, 0.01])
+    df['age_of_casualty'] = np.where(rng.random(n) < 0.02, np.nan, rng.integers(1, 90, n))
+    df['age_band_of_casualty'] = age_band(df['age_of_casualty'])
+    df['lsoa_of_casualty'] = lsoas(rng, n)
+    casualty_cols = ['sex_of_casualty', 'casualty_home_area_type', 'casualty_imd_decile', 'casualty_severity', 'age_of_casualty', 'age_band_of_casualty', 'lsoa_of_casualty']
+    df.loc[~has_casualty, casualty_cols] = np.nan
+
+    return df
+
+def age_band(ages):
+    bins = [-1, 5, 10, 15, 20, 25, 35, 45, 55, 65, 75, np.inf]
+    labels = ['0 - 5', '6 - 10', '11 - 15', '16 - 20', '21 - 25', '26 - 35', '36 - 45', '46 - 55', '56 - 65', '66 - 75', 'Over 75']
+    bands = pd.cut(ages, bins=bins, labels=labels)
+    return bands.cat.add_categories(['Data missing or out of range']).fillna('Data missing or out of range')
+
+def lsoas(rng, size):
+    return pd.Categorical.from_codes(rng.integers(0, n_lsoas, size), categories=[f"E01{i:06d}" for i in range(n_lsoas)])
+
+def write_synthetic_csv(path, n_rows, seed=0, chunk_rows=500000):
+    # writes ~n_rows rows of synthetic_raw_data to path, generating chunk_rows at a time so that 10M+ rows don't need to fit in memory
+    # written to a temporary file first so that an interrupted write never leaves a partial file
+    first_collision = 0
+    rows_written = 0
+    chunk_number = 0
+    while rows_written < n_rows:
+        chunk = synthetic_raw_data(min(chunk_rows, n_rows - rows_written), seed=[seed, chunk_number], first_collision=first_collision)
+        if len(chunk) == 0:
+            break
+        chunk.to_csv(path + ".tmp", mode='w' if chunk_number == 0 else 'a', header=(chunk_number == 0), index=False)
+        first_collision += chunk['accident_index'].nunique()
+        rows_written += len(chunk)
+        chunk_number += 1
+    os.replace(path + ".tmp", path)
+
+    return rows_written
+
+def time_stage(func, repeat=3, memory=True):
+    # returns the output of func, the fastest of repeat runs in seconds, and the peak memory allocated by a separate run in bytes (or None)
+    # memory is measured with tracemalloc, which counts allocations made through python and numpy (so all pandas data),
+    # but not allocations made directly by C libraries such as XGBoost
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        output = func()
+        times.append(time.perf_counter() - start)
+
+    peak_bytes = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return output, min(times), peak_bytes
+
+def benchmark_csv(path_to_csv, repeat=3, memory=True, seed=0):
+    # runs every stage on path_to_csv, each on the output of the stage before, and returns a list of {"stage", "seconds", "peak_mb", "rows"}
+    results = []
+
+    def run(stage, func):
+        output, seconds, peak_bytes = time_stage(func, repeat, memory)
+        results.append({"stage": stage, "seconds": seconds, "peak_mb": None if peak_bytes is None else peak_bytes / 2**20})
+        print(f"  {stage:<32} {seconds:9.3f}s" + ("" if peak_bytes is None else f" {peak_bytes / 2**20:10.1f}MB"))
+        return output
+
+    raw = run("read_raw_data", lambda: read_raw_data(path_to_csv))
+    run("expand_collisions", lambda: expand_collisions(raw.copy(deep=False)))
+    df = run("transform_raw_data", lambda: transform_raw_data(path_to_csv))
+    del raw
+    df = run("clean_df", lambda: clean_df(df))
+
+    X = df[benchmark_features]
+    y = pd.Series(np.where(df['casualty_severity'] == "Fatal", 1, 0), index=df.index, name='fatality')
+    del df
+    rng = np.random.default_rng(seed)
+    fitted = run("impute_fit_df", lambda: impute_fit_df(X))
+    run("impute_transform_df", lambda: impute_transform_df(X, *fitted, X.columns, rng=rng))
+    fitted = run("impute_fit_df_TE", lambda: impute_fit_df_TE(X, y))
+    run("impute_transform_df_TE", lambda: impute_transform_df_TE(X, *fitted[:5], X.columns, fitted[5], rng=rng))
+    preprocessor = run("CustomPreprocessor.fit", lambda: CustomPreprocessor(rng=seed).fit(X))
+    X_transformed = run("CustomPreprocessor.transform", lambda: preprocessor.transform(X))
+    run("XGBClassifier.fit", lambda: XGBClassifier(n_estimators=100, random_state=seed).fit(X_transformed, y))
+    preprocessor = CustomPreprocessor(rng=seed, sparse_output=True).fit(X)
+    X_transformed = run("CustomPreprocessor.transform csr", lambda: preprocessor.transform(X))
+    run("XGBClassifier.fit csr", lambda: XGBClassifier(n_estimators=100, random_state=seed).fit(X_transformed, y))
+
+    for result in results:
+        result["rows"] = len(X)
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare_results(results, previous_results):
+    # prints the ratio of each stage's time to the latest previous run of the same stage and size
+    previous = {}
+    for result in previous_results:
+        previous[(result["stage"], result["n_rows"])] = result
+
+    print(f"{'stage':<32} {'n_rows':>10} {'seconds':>9} {'previous':>9} {'ratio':>7}  previous run")
+    for result in results:
+        before = previous.get((result["stage"], result["n_rows"]))
+        if before is None:
+            print(f"{result['stage']:<32} {result['n_rows']:>10} {result['seconds']:9.3f}")
+            continue
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] > 0 else float("nan")
+        flag = "  <- slower" if ratio > 1.2 else ""
+        print(f"{result['stage']:<32} {result['n_rows']:>10} {result['seconds']:9.3f} {before['seconds']:9.3f} {ratio:7.2f}  {before['commit']} {before['timestamp']}{flag}")
+
+def run_benchmarks(sizes, repeat=3, memory=True, seed=0, data_dir="benchmark_data", results_path="benchmark_results.jsonl"):
+    # generates (or reuses) a synthetic csv of each size in data_dir, benchmarks it, and appends the results to results_path
+    os.makedirs(data_dir, exist_ok=True)
+    run_info = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "machine": platform.node(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__
+    }
+
+    results = []
+    for n_rows in sizes:
+        path = os.path.join(data_dir, f"synthetic_{n_rows}_{seed}.csv")
+        if not os.path.exists(path):
+            print(f"Generating {n_rows} rows")
+            write_synthetic_csv(path, n_rows, seed=seed)
+        print(f"Benchmarking {n_rows} rows")
+        for result in benchmark_csv(path, repeat=repeat, memory=memory, seed=seed):
+            results.append({**run_info, "n_rows": n_rows, **result})
+
+    previous_results = load_results(results_path)
+    with open(results_path, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    compare_results(results, previous_results)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing and training stages on synthetic STATS19-format data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000, 10000000], help="rows of synthetic raw data")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each stage, the fastest is recorded")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slower) memory profiling run of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default="benchmark_data", help="where the synthetic csvs are written")
+    parser.add_argument("--results", default="benchmark_results.jsonl", help="results are appended to this file")
+    args = parser.parse_args()
+
+    run_benchmarks(args.sizes, repeat=args.repeat, memory=not args.no_memory, seed=args.seed, data_dir=args.data_dir, results_path=args.results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import functions
+from functions import transform_raw_data, clean_df
+
+# bump to invalidate every cache entry, e.g. if the storage format changes
+cache_version = 1
+
+def file_hash(path, block_size=2**20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+def input_hash(path, cache_dir, years=None):
+    # hashing a multi-year csv takes a few seconds, so the hash is remembered against the file's size and modification time
+    # and only recomputed when either changes
+    if os.path.isdir(path):
+        return dataset_hash(path, cache_dir, years)
+
+    index_path = os.path.join(cache_dir, "input_hashes.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = index.get(key)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    index[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash(path)}
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+
+    return index[key]["sha256"]
+
+def dataset_hash(path, cache_dir, years=None):
+    # hash of a parquet dataset written by ingest.py, from the path and input_hash of each of its files
+    # only the files of the year=<year> partitions of years (default: all) are hashed, so adding a year doesn't change the hash of the others
+    partitions = None if years is None else {f"year={year}" for year in years}
+    h = hashlib.sha256()
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            relative_path = os.path.relpath(file_path, path)
+            if partitions is not None and relative_path.split(os.sep)[0] not in partitions:
+                continue
+            h.update(relative_path.replace(os.sep, "/").encode())
+            h.update(input_hash(file_path, cache_dir).encode())
+
+    return h.hexdigest()
+
+def cache_key(path_to_csv, cache_dir, clean=True, years=None):
+    # an entry is only valid for the same input data, the same version of functions.py and the same steps applied
+    h = hashlib.sha256()
+    h.update(str(cache_version).encode())
+    h.update(input_hash(path_to_csv, cache_dir, years).encode())
+    if years is not None:
+        h.update(json.dumps(sorted(int(year) for year in years)).encode())
+    with open(functions.__file__, "rb") as f:
+        h.update(f.read())
+    h.update(b"clean" if clean else b"raw")
+
+    return h.hexdigest()[:32]
+
+def load_df(path_to_csv, cache_dir=".cache", clean=True, max_cache_bytes=5 * 2**30, years=None):
+    # returns transform_raw_data(path_to_csv, years), followed by clean_df if clean=True, loading it from cache_dir if it has already been computed
+    # path_to_csv can also be a parquet dataset written by ingest.py, of which only the partitions of years (default: all) are read
+    # entries are stored as uncompressed feather (arrow ipc) files, which keep the categoricals and index, and are memory mapped on load
+    # the numeric columns (and the codes of categoricals without missing values) are converted to pandas without copying (split_blocks),
+    # so are views of the memory mapped file and read-only - take a .copy() of a cached DataFrame before writing into it in place
+    # least recently used entries (of the derived entries in cache_dir, see evict) are deleted once the cache is bigger than max_cache_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, cache_key(path_to_csv, cache_dir, clean, years) + ".arrow")
+
+    if os.path.exists(path):
+        # touch the entry so that eviction treats it as recently used
+        os.utime(path)
+        return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+
+    df = transform_raw_data(path_to_csv, years=years)
+    if clean:
+        df = clean_df(df)
+
+    # written to a temporary file first so that an interrupted write never leaves a partial entry
+    feather.write_feather(pa.Table.from_pandas(df, preserve_index=True), path + ".tmp", compression="uncompressed")
+    os.replace(path + ".tmp", path)
+    evict(cache_dir, max_cache_bytes)
+
+    return df
+
+def entry_size(path):
+    # entries are files, or directories of files (e.g. the folds stored by experiment.preprocess_folds)
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def evictable(name):
+    # entries derived from files on disk, which are cheap to recompute: DataFrames, folds (experiment.py), count point indexes (spatial.py)
+    # and explain stats (explain.py) - anything else in cache_dir (e.g. weather fetched from an API) is never evicted
+    return not name.endswith(".tmp") and (name.endswith(".arrow") or name.startswith(("folds-", "count_points-", "explain-")))
+
+def evict(cache_dir, max_cache_bytes, keep=()):
+    # deletes the least recently used entries until the evictable entries (see evictable) fit in max_cache_bytes
+    # entries that are still being written are left alone, and the entries in keep are counted but never deleted,
+    # e.g. folds that are memory mapped by the caller
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if evictable(name)]
+    entries = sorted(entries, key=os.path.getmtime, reverse=True)
+    keep = [os.path.abspath(path) for path in keep]
+
+    total_bytes = 0
+    for path in entries:
+        total_bytes += entry_size(path)
+        if total_bytes > max_cache_bytes and os.path.abspath(path) not in keep:
+            remove_entry(path)
+
+def clear_cache(cache_dir=".cache"):
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            remove_entry(os.path.join(cache_dir, name))
@@ -0,0 +1,276 @@
+import inspect
+import math
+import os
+import shutil
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn.base import BaseEstimator, clone
+from sklearn.metrics import precision_score
+from sklearn.model_selection import StratifiedKFold, ParameterSampler, train_test_split
+
+import functions
+from cache import evict
+from store import StoredFold, write_fold
+
+# hyperparameter search for pipelines of the form [preprocessing steps..., classifier], as used in the modelling notebooks
+# RandomizedSearchCV refits the whole pipeline for every candidate in every fold, but only the classifier's parameters are searched,
+# so here the preprocessing steps (e.g. CustomPreprocessor, SMOTE) are fitted once per fold and only the classifier is fitted per candidate
+# the preprocessed folds are cached on disk, so later searches over the same data and preprocessing (e.g. the next notebook cell) skip it entirely
+# the cached folds are a memory mapped store (see store.py): the worker processes are passed each fold's path and map the same read-only pages,
+# so memory doesn't grow with n_jobs
+
+# bump to invalidate every cached fold, e.g. if the storage format changes
+fold_cache_version = 2
+
+def preprocess_fold(steps, X_train, y_train, X_test):
+    # fits the preprocessing steps on the train part of the fold and transforms both parts
+    # resampling steps (e.g. SMOTE) are only applied to the train part, like imblearn's Pipeline
+    for name, step in steps:
+        step = clone(step)
+        if hasattr(step, "fit_resample"):
+            X_train, y_train = step.fit_resample(X_train, y_train)
+        else:
+            X_train = step.fit_transform(X_train, y_train)
+            X_test = step.transform(X_test)
+
+    # stored as row-major numpy arrays, which are memory mapped rather than copied to the worker processes,
+    # and which XGBoost converts to a DMatrix ~20% faster than column-major arrays (e.g. CustomPreprocessor's output)
+    # sparse matrices (e.g. CustomPreprocessor(sparse_output=True)) are kept as they are
+    if not sparse.issparse(X_train):
+        X_train = np.ascontiguousarray(X_train.to_numpy(dtype='float') if isinstance(X_train, pd.DataFrame) else X_train)
+    if not sparse.issparse(X_test):
+        X_test = np.ascontiguousarray(X_test.to_numpy(dtype='float') if isinstance(X_test, pd.DataFrame) else X_test)
+    return X_train, np.asarray(y_train), X_test
+
+def source(obj):
+    # source code of a function or class, or None if it can't be found
+    # classes defined in a notebook have no source file, so their source is made up of their methods', which do
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        pass
+    if isinstance(obj, type):
+        methods = [source(value) for value in vars(obj).values() if inspect.isfunction(value)]
+        return None if None in methods else "".join(methods)
+    return None
+
+def steps_source(steps):
+    # source of the classes (and their base classes) of the steps and of the estimators and functions in their parameters,
+    # so that editing e.g. a transformer defined in a notebook invalidates the cached folds - or None if any of it can't be found
+    sources = []
+    for _, step in steps:
+        for obj in [step] + list(step.get_params(deep=True).values() if hasattr(step, "get_params") else []):
+            if inspect.isfunction(obj) or isinstance(obj, type):
+                objects = [obj]
+            elif hasattr(obj, "get_params"):
+                objects = [cls for cls in type(obj).__mro__ if cls is not object]
+            else:
+                continue
+            for part in objects:
+                sources.append(source(part))
+                if sources[-1] is None:
+                    return None
+
+    return sources
+
+def preprocess_folds(steps, X, y, cv, cache_dir=None, max_cache_bytes=5 * 2**30):
+    # returns a list of (X_train, y_train, X_test, y_test) per fold or, with a cache_dir, a StoredFold of them per fold,
+    # loaded from cache_dir if they have already been computed
+    # a cached entry is only valid for the same data, preprocessing steps and parameters, source of the steps (see steps_source), folds
+    # and version of functions.py - steps whose source can't be found aren't cached
+    # note an unseeded resampling step is frozen at its first fit, which also means every candidate is compared on the same resampled data
+    # least recently used entries (of everything in cache_dir, see cache.evict) are deleted once the cache is bigger than max_cache_bytes
+    # the folds are computed once, so that an unseeded cv can't key the cache on different folds than the ones preprocessed
+    splits = list(cv.split(X, y))
+    sources = steps_source(steps) if cache_dir is not None else None
+    if sources is None:
+        cache_dir = None
+    if cache_dir is not None:
+        with open(functions.__file__, "rb") as f:
+            key = joblib.hash((fold_cache_version, X, np.asarray(y), steps, sources, splits, f.read()))
+        path = os.path.join(cache_dir, "folds-" + key)
+        if os.path.exists(path):
+            # touch the entry so that eviction treats it as recently used
+            os.utime(path)
+            return [StoredFold(os.path.join(path, f"fold-{k}")) for k in range(len(os.listdir(path)))]
+        # written to a temporary directory first so that an interrupted write never leaves a partial entry
+        shutil.rmtree(path + ".tmp", ignore_errors=True)
+        os.makedirs(path + ".tmp")
+
+    y = np.asarray(y)
+    folds = []
+    for k, (train_index, test_index) in enumerate(splits):
+        X_train, y_train, X_test = preprocess_fold(steps, X.iloc[train_index], y[train_index], X.iloc[test_index])
+        if cache_dir is not None:
+            # each fold is written as soon as it's preprocessed, so only one fold is held in memory at a time
+            write_fold(os.path.join(path + ".tmp", f"fold-{k}"), X_train, y_train, X_test, y[test_index], train_index, test_index)
+        else:
+            folds.append((X_train, y_train, X_test, y[test_index]))
+
+    if cache_dir is not None:
+        os.rename(path + ".tmp", path)
+        evict(cache_dir, max_cache_bytes, keep=[path])
+        folds = [StoredFold(os.path.join(path, f"fold-{k}")) for k in range(len(os.listdir(path)))]
+
+    return folds
+
+def fit_candidate(classifier, params, fold, scoring, early_stopping_rounds=None, validation_fraction=0.1):
+    # a StoredFold is opened here, in the worker, so only its path is sent to the worker
+    X_train, y_train, X_test, y_test = fold.load() if isinstance(fold, StoredFold) else fold
+    model = clone(classifier).set_params(**params)
+    fit_params = {}
+    if early_stopping_rounds is not None:
+        # stops adding trees once the score on a validation split of the train part stops improving, so the test part is only used to score the fit
+        # the split is stratified and seeded, so every candidate is stopped on the same rows
+        fit_rows, validation_rows = train_test_split(np.arange(len(y_train)), test_size=validation_fraction, stratify=y_train, random_state=0)
+        fit_rows, validation_rows = np.sort(fit_rows), np.sort(validation_rows)
+        model.set_params(early_stopping_rounds=early_stopping_rounds)
+        fit_params = {"eval_set": [(X_train[validation_rows], y_train[validation_rows])], "verbose": False}
+        X_train, y_train = X_train[fit_rows], y_train[fit_rows]
+
+    start = time.perf_counter()
+    model.fit(X_train, y_train, **fit_params)
+    fit_time = time.perf_counter() - start
+
+    return {
+        "train_score": scoring(y_train, model.predict(X_train)),
+        "test_score": scoring(y_test, model.predict(X_test)),
+        "fit_time": fit_time,
+        "best_iteration": getattr(model, "best_iteration", None) if early_stopping_rounds is not None else None
+    }
+
+class CachedSearchCV(BaseEstimator):
+    # randomized search over the parameters of the last step of a pipeline, with the other steps fitted once per fold (see preprocess_folds)
+    # param_distributions, n_iter and random_state sample the same candidates as RandomizedSearchCV, and cv_results_ has the same
+    # mean_test_<score>/mean_train_<score>/param_<name> columns, so it can replace RandomizedSearchCV in run_experiment
+    # the candidates are fitted in n_jobs processes, each limited to its share of the cores for XGBoost's threads
+    # for XGBoost classifiers:
+    # - halving_factor runs successive halving on n_estimators: every candidate is first fitted with a few trees,
+    #   then only the best 1/halving_factor are refitted with halving_factor times as many trees, until the classifier's n_estimators is reached
+    # - early_stopping_rounds stops each fit once the score on a validation split of the fold's train part (validation_fraction of its rows)
+    #   hasn't improved for that many trees, and the best estimator is refitted with the mean number of trees used in the folds
+    def __init__(self, estimator, param_distributions, n_iter=10, scoring=precision_score, cv=4, n_jobs=None, random_state=None,
+                 refit=True, cache_dir=".cache", max_cache_bytes=5 * 2**30, halving_factor=None, early_stopping_rounds=None, validation_fraction=0.1,
+                 verbose=0):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.scoring = scoring
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.refit = refit
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.halving_factor = halving_factor
+        self.early_stopping_rounds = early_stopping_rounds
+        self.validation_fraction = validation_fraction
+        self.verbose = verbose
+
+    def fit(self, X, y):
+        steps, (classifier_name, classifier) = self.estimator.steps[:-1], self.estimator.steps[-1]
+        prefix = classifier_name + "__"
+        not_classifier = [param for param in self.param_distributions if not param.startswith(prefix)]
+        if len(not_classifier) > 0:
+            raise ValueError(f"Only the parameters of {classifier_name} can be searched, as the other steps are fitted once per fold: {not_classifier}")
+
+        cv = StratifiedKFold(self.cv) if isinstance(self.cv, int) else self.cv
+        start = time.perf_counter()
+        folds = preprocess_folds(steps, X, y, cv, self.cache_dir, self.max_cache_bytes)
+        if self.verbose > 0:
+            print(f"Preprocessed {len(folds)} folds in {time.perf_counter() - start:.1f}s")
+
+        candidates = list(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state))
+        candidate_params = [{param[len(prefix):]: value for param, value in params.items()} for params in candidates]
+
+        # successive halving rounds: (round, n_estimators), with enough rounds to narrow the candidates down to about 1
+        max_n_estimators = classifier.get_params().get("n_estimators") or 100
+        if self.halving_factor is not None:
+            n_rounds = 1 + int(math.log(len(candidates)) / math.log(self.halving_factor))
+            n_estimators = max(1, max_n_estimators // self.halving_factor**(n_rounds - 1))
+        else:
+            n_estimators = None
+
+        results = []
+        remaining = list(range(len(candidates)))
+        round_number = 0
+        with Parallel(n_jobs=self.n_jobs) as parallel:
+            while True:
+                resources = {} if n_estimators is None else {"n_estimators": n_estimators}
+                if self.verbose > 0:
+                    print(f"Round {round_number}: fitting {len(remaining)} candidates x {len(folds)} folds" + (f", n_estimators={n_estimators}" if n_estimators is not None else ""))
+                fold_results = parallel(delayed(fit_candidate)(classifier, {**candidate_params[i], **resources}, fold, self.scoring, self.early_stopping_rounds,
+                                                               self.validation_fraction)
+                                        for i in remaining for fold in folds)
+
+                round_results = []
+                for j, i in enumerate(remaining):
+                    candidate_results = fold_results[j * len(folds):(j + 1) * len(folds)]
+                    round_results.append((i, candidate_results))
+                    results.append((round_number, n_estimators, i, candidate_results))
+
+                if n_estimators is None or len(remaining) <= 1 or n_estimators >= max_n_estimators:
+                    break
+
+                # keep the best 1/halving_factor of the candidates for the next round
+                round_results = sorted(round_results, key=lambda result: -np.mean([r["test_score"] for r in result[1]]))
+                remaining = [i for i, _ in round_results[:math.ceil(len(remaining) / self.halving_factor)]]
+                n_estimators = min(n_estimators * self.halving_factor, max_n_estimators)
+                round_number += 1
+
+        self.cv_results_ = self.results_df(results, candidates, len(folds))
+        # the best candidate is taken from the last round, i.e. the one fitted with the most trees
+        last_round = self.cv_results_[self.cv_results_["iter"] == round_number]
+        self.best_index_ = last_round[self.score_name("mean_test")].idxmax()
+        self.best_score_ = self.cv_results_.loc[self.best_index_, self.score_name("mean_test")]
+        self.best_params_ = dict(self.cv_results_.loc[self.best_index_, "params"])
+        if self.early_stopping_rounds is not None:
+            self.best_params_[prefix + "n_estimators"] = int(round(self.cv_results_.loc[self.best_index_, "mean_best_iteration"])) + 1
+        elif n_estimators is not None:
+            self.best_params_[prefix + "n_estimators"] = n_estimators
+        if self.verbose > 0:
+            print(f"Searched in {time.perf_counter() - start:.1f}s, best {self.best_score_:.4f} {self.best_params_}")
+
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X, y)
+
+        return self
+
+    def score_name(self, prefix):
+        # e.g. precision_score -> mean_test_precision, matching RandomizedSearchCV with scoring={"precision": ...}
+        name = getattr(self.scoring, "__name__", "score")
+        return f"{prefix}_{name[:-len('_score')] if name.endswith('_score') else name}"
+
+    def results_df(self, results, candidates, n_splits):
+        rows = []
+        for round_number, n_estimators, i, candidate_results in results:
+            test_scores = [r["test_score"] for r in candidate_results]
+            train_scores = [r["train_score"] for r in candidate_results]
+            row = {"iter": round_number, "n_resources": n_estimators, "candidate": i, "params": candidates[i]}
+            row.update({"param_" + param: value for param, value in candidates[i].items()})
+            row.update({self.score_name(f"split{k}_test"): score for k, score in enumerate(test_scores)})
+            row[self.score_name("mean_test")] = np.mean(test_scores)
+            row[self.score_name("std_test")] = np.std(test_scores)
+            row.update({self.score_name(f"split{k}_train"): score for k, score in enumerate(train_scores)})
+            row[self.score_name("mean_train")] = np.mean(train_scores)
+            row[self.score_name("std_train")] = np.std(train_scores)
+            row["mean_fit_time"] = np.mean([r["fit_time"] for r in candidate_results])
+            if self.early_stopping_rounds is not None:
+                row["mean_best_iteration"] = np.mean([r["best_iteration"] for r in candidate_results])
+            rows.append(row)
+
+        df = pd.DataFrame(rows)
+        # ranked within each round, as the candidates of different rounds are fitted with different n_estimators
+        df[self.score_name("rank_test")] = df.groupby("iter")[self.score_name("mean_test")].rank(ascending=False, method='min').astype(int)
+        return df
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
@@ -0,0 +1,172 @@
+import argparse
+import collections
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+import score
+from cache import input_hash
+from functions import expand_collisions, clean_df
+from score import seed_pipeline, chunks, read_chunk, casualty_keys
+
+# feature attributions (SHAP values) of a saved pipeline's predictions, for pipelines whose last step is an XGBoost model
+# XGBoost computes exact TreeSHAP values itself (predict with pred_contribs=True), in log-odds, using the trees' training cover as the background,
+# so no background sample is needed - the contributions of each row plus the bias (expected value) add up to the row's log-odds
+# the contributions of the preprocessor's output columns (e.g. the one-hot columns of a variable) are summed per variable of the pipeline's features,
+# which by the additivity of SHAP values is the contribution of that variable
+# a csv is explained in chunks of whole collisions in worker processes, like score.py, and the mean contribution and mean absolute contribution of
+# each variable (background statistics for reporting) are cached for each csv and pipeline
+# usage: python explain.py stats19CycleCollisions.csv pipeline.joblib contributions.csv --workers 8
+
+def split_pipeline(pipeline):
+    # preprocessing steps used at predict time (resampling steps like SMOTE are only used in fit) and the XGBoost model at the end
+    steps = [step for _, step in pipeline.steps[:-1] if hasattr(step, "transform")]
+    model = pipeline.steps[-1][1]
+    if not hasattr(model, "get_booster"):
+        raise ValueError(f"The last step of the pipeline has to be an XGBoost model, not {type(model).__name__}")
+
+    return steps, model
+
+def output_columns(steps, model):
+    # names of the columns the model is fitted on - CustomPreprocessor sorts its output columns, so they're taken from the last preprocessing step
+    if len(steps) > 0 and hasattr(steps[-1], "get_feature_names_out"):
+        return list(steps[-1].get_feature_names_out())
+    if hasattr(model, "feature_names_in_"):
+        return list(model.feature_names_in_)
+    return [f"f{i}" for i in range(model.n_features_in_)]
+
+def source_variables(columns, features):
+    # the variable in features that each column comes from: the column itself, or the longest feature it starts with,
+    # as one-hot columns are named <variable>_<category>
+    by_length = sorted(features, key=len, reverse=True)
+    return [col if col in features else next((feature for feature in by_length if col.startswith(feature + "_")), col) for col in columns]
+
+def aggregation_matrix(columns, features):
+    # (columns, variables) matrix of 0s and 1s that sums the contributions of each variable's columns
+    # variables are features, followed by any columns that don't come from one of the features
+    sources = source_variables(columns, features)
+    variables = list(features) + [source for source in dict.fromkeys(sources) if source not in features]
+    variable_index = {variable: i for i, variable in enumerate(variables)}
+    matrix = np.zeros((len(columns), len(variables)))
+    matrix[np.arange(len(columns)), [variable_index[source] for source in sources]] = 1
+
+    return matrix, variables
+
+def contributions(df, pipeline, features, batch_size=50000):
+    # DataFrame of the SHAP value (log-odds) of each variable of features for each row of df, with the bias in the last column
+    # rows are explained batch_size at a time, so memory doesn't depend on the size of df - XGBoost spreads each batch over its threads
+    steps, model = split_pipeline(pipeline)
+    booster = model.get_booster()
+    matrix, variables = aggregation_matrix(output_columns(steps, model), features)
+    # the same trees as predict, i.e. up to the best iteration if fitted with early stopping
+    best_iteration = getattr(model, "best_iteration", None)
+    iteration_range = (0, best_iteration + 1) if best_iteration is not None else (0, 0)
+
+    batches = []
+    df_features = df[features]
+    for start in range(0, len(df), batch_size):
+        X = df_features.iloc[start:start + batch_size]
+        for step in steps:
+            X = step.transform(X)
+        contribs = booster.predict(xgb.DMatrix(X, missing=model.missing), pred_contribs=True, iteration_range=iteration_range, validate_features=False)
+        batches.append(np.column_stack([contribs[:, :-1] @ matrix, contribs[:, -1]]))
+
+    values = np.concatenate(batches) if len(batches) > 0 else np.zeros((0, len(variables) + 1))
+    return pd.DataFrame(values, index=df.index, columns=variables + ["bias"])
+
+def init_worker(path_to_pipeline, n_threads):
+    # as score.init_worker, with XGBoost limited to the worker's share of the cores
+    score.init_worker(path_to_pipeline)
+    _, model = split_pipeline(score.pipeline)
+    model.get_booster().set_param({"nthread": n_threads})
+
+def explain_chunk(chunk, chunk_number, seed):
+    seed_pipeline(score.pipeline, chunk_number, seed)
+    df, n_casualties, _ = expand_collisions(read_chunk(chunk), keys=True)
+    keys = casualty_keys(df)
+    df = clean_df(df)
+
+    return keys, contributions(df, score.pipeline, score.features), n_casualties
+
+def stats_path(path_to_csv, path_to_pipeline, chunksize, seed, cache_dir):
+    # the imputation of each chunk is seeded from seed and the chunk's number (see score.seed_pipeline), so the stats depend on both
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha256((input_hash(path_to_csv, cache_dir) + input_hash(path_to_pipeline, cache_dir) + f"{chunksize}-{seed}").encode()).hexdigest()[:32]
+    return os.path.join(cache_dir, "explain-" + key + ".json")
+
+def explain_csv(path_to_csv, path_to_pipeline, path_to_output=None, chunksize=100000, n_workers=None, seed=0, cache_dir=".cache"):
+    # writes the contributions of each variable for each bike casualty to path_to_output (if given), keyed as in score.py,
+    # and returns (and caches) the background statistics - see background_stats
+    n_workers = n_workers or os.cpu_count()
+    pending = collections.deque()
+    casualty_offset = 0
+    n_rows = 0
+    sums = None
+    abs_sums = None
+    header_written = False
+
+    with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(path_to_pipeline, max(1, os.cpu_count() // n_workers))) as executor, \
+            open(path_to_output if path_to_output is not None else os.devnull, "w", newline="") as f:
+        def write_next():
+            nonlocal casualty_offset, n_rows, sums, abs_sums, header_written
+            keys, df, n_casualties = pending.popleft().result()
+            sums = df.sum() if sums is None else sums + df.sum()
+            abs_sums = df.abs().sum() if abs_sums is None else abs_sums + df.abs().sum()
+
+            if path_to_output is not None:
+                keys["accident_index_2"] += casualty_offset
+                pd.concat([keys, df.reset_index(drop=True)], axis=1).to_csv(f, header=not header_written, index=False)
+                header_written = True
+            casualty_offset += n_casualties
+            n_rows += len(df)
+
+        for chunk_number, chunk in enumerate(chunks(path_to_csv, chunksize)):
+            pending.append(executor.submit(explain_chunk, chunk, chunk_number, seed))
+            if len(pending) >= 2 * n_workers:
+                write_next()
+
+        while len(pending) > 0:
+            write_next()
+
+    stats = pd.DataFrame({"mean": sums / n_rows, "mean_abs": abs_sums / n_rows}).sort_values("mean_abs", ascending=False)
+    stats.index.name = "variable"
+    os.makedirs(cache_dir, exist_ok=True)
+    path = stats_path(path_to_csv, path_to_pipeline, chunksize, seed, cache_dir)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"n_rows": n_rows, "stats": stats.reset_index().to_dict(orient="records")}, f)
+    os.replace(path + ".tmp", path)
+
+    return stats
+
+def background_stats(path_to_csv, path_to_pipeline, chunksize=100000, n_workers=None, seed=0, cache_dir=".cache"):
+    # mean contribution and mean absolute contribution (global importance) of each variable, and the bias, over every bike casualty in the csv
+    # cached for the csv, pipeline, chunksize and seed, so are only computed once (or by explain_csv)
+    path = stats_path(path_to_csv, path_to_pipeline, chunksize, seed, cache_dir)
+    if os.path.exists(path):
+        # touch the entry so that cache.evict treats it as recently used
+        os.utime(path)
+        with open(path) as f:
+            return pd.DataFrame(json.load(f)["stats"]).set_index("variable")
+
+    return explain_csv(path_to_csv, path_to_pipeline, chunksize=chunksize, n_workers=n_workers, seed=seed, cache_dir=cache_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Explain the predictions of a saved XGBoost pipeline for a STATS19-format csv with SHAP values")
+    parser.add_argument("path_to_csv")
+    parser.add_argument("path_to_pipeline", help="pipeline saved with score.save_pipeline")
+    parser.add_argument("path_to_output")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows of the csv read at a time")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for imputing missing values")
+    args = parser.parse_args()
+
+    stats = explain_csv(args.path_to_csv, args.path_to_pipeline, args.path_to_output, chunksize=args.chunksize, n_workers=args.workers, seed=args.seed)
+    print(stats.to_string())
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,211 @@
+import csv
+import io
+import os
+
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.preprocessing import MinMaxScaler, TargetEncoder
 
-def transform_raw_data(path_to_csv):
-    df = pd.read_csv(path_to_csv, header=0)
-    df = df.rename(columns={
-        'longitude.x': 'longitude',
-        'latitude.x': 'latitude',
-        'date.x': 'date'
-    })
+from profiling import profiled, stage
+
+# variables kept for each bike casualty, and for the vehicle/driver chosen for that casualty
+casualty_vars = [
+    'longitude', 
+    'latitude', 
+    'date',
+    'day_of_week',
+    'time', 
+    'first_road_class',
+    'road_type', 
+    'speed_limit',
+    'junction_detail', 
+    'junction_control', 
+    'second_road_class',
+    'pedestrian_crossing_human_control', 
+    'pedestrian_crossing_physical_facilities', 
+    'light_conditions',
+    'weather_conditions', 
+    'road_surface_conditions',
+    'special_conditions_at_site', 
+    'carriageway_hazards',
+    'urban_or_rural_area',
+    'sex_of_casualty', 
+    'age_of_casualty', 
+    'age_band_of_casualty',
+    'casualty_severity',
+    'casualty_home_area_type', 
+    'casualty_imd_decile', 
+    'lsoa_of_casualty'
+]
+vehicle_vars = [
+    'vehicle_type', 
+    'vehicle_subtype',
+    'towing_and_articulation',
+    'vehicle_manoeuvre',
+    'vehicle_location_restricted_lane', 
+    'junction_location',
+    'skidding_and_overturning', 
+    'hit_object_in_carriageway',
+    'vehicle_leaving_carriageway', 
+    'hit_object_off_carriageway',
+    'first_point_of_impact', 
+    'vehicle_left_hand_drive',
+    'engine_capacity_cc', 
+    'propulsion_code',
+    'age_of_vehicle'
+]
+driver_vars = [
+    'journey_purpose_of_driver', 
+    'sex_of_driver', 
+    'age_of_driver',
+    'age_band_of_driver',
+    'driver_imd_decile',
+    'driver_home_area_type', 
+    'lsoa_of_driver'
+]
+# weather at the time and location of each collision - only added by weather.py (transform_raw_data_with_weather), never read from the raw data
+weather_vars = [
+    'RH2M',
+    'T2M',
+    'PRECTOTCORR',
+    'WS2M'
+]
+
+# declarative mappings used to derive categorical columns
+# each rule is (match, pattern, label) where match is "isin" (pattern is a list of values) or "contains" (pattern is a substring)
+# the first rule a value matches gives its label
+vehicle_subtype_rules = [
+    ("isin", ["VAN / GOODS 3.5 TONNES MGW OR UNDER", "MINIBUS (8 - 16 PASSENGER SEATS)"], "4. Van"),
+    ("contains", "GOODS", "1. HGV"),
+    ("isin", ["AGRICULTURAL VEHICLE"], "2. Agricultural vehicle"),
+    ("isin", ["BUS OR COACH (17 OR MORE PASS SEATS)"], "3. Bus"),
+    ("contains", "CAR", "5. Car"),
+    ("contains", "MOTORCYCLE", "6. Motorbike"),
+    ("isin", ["PEDAL CYCLE"], "7. Bike")
+]
+season_rules = [
+    ("isin", [3, 4, 5], "spring"),
+    ("isin", [6, 7, 8], "summer"),
+    ("isin", [9, 10, 11], "autumn")
+]
+# some values of vehicle_type have no values for engine_capacity_cc -> using other types of vehicle that have the most similar engine size
+vehicle_type_2_rules = [
+    ("isin", ["Agricultural vehicle", "Goods vehicle - unknown weight"], "Goods over 3.5t. and under 7.5t"),
+    ("isin", ["Electric motorcycle"], "Motorcycle 50cc and under"),
+    ("isin", ["Motorcycle - unknown cc"], "Motorcycle 125cc and under"),
+    ("isin", ["Unknown vehicle type (self rep only)"], "Car")
+]
+# continuous variables imputed with their median within a group, and the variable of that group
+vars_to_groupby = {
+    "engine_capacity_cc": "vehicle_type_2",
+    "age_of_casualty": "towing_and_articulation",
+    "age_of_driver": "vehicle_type"
+}
+
+@profiled
+def map_categories(values, rules, default=None, case_sensitive=True):
+    # maps each value of a column to a label using a list of rules (see above)
+    # values matching no rule, and missing values, are given the default - if there is no default, values are kept as they are
+    # the rules are only evaluated once per distinct value, then looked up for every row by its category code
+    # returns a categorical, with the categories sorted so that sorting by the column sorts by label
+    codes, categories = pd.factorize(values)
+    categories = pd.Index(categories)
+    match_on = categories if case_sensitive else categories.str.upper()
+
+    conditions = []
+    for match, pattern, _ in rules:
+        if match == "isin":
+            conditions.append(np.asarray(match_on.isin(pattern)))
+        elif match == "contains":
+            conditions.append(np.asarray(match_on.str.contains(pattern, regex=False), dtype=bool))
+        else:
+            raise ValueError(f"Unknown match type: {match}")
+
+    labels = np.select(conditions, [label for _, _, label in rules], default=None).astype('object')
+    no_match = ~np.any(conditions, axis=0) if len(conditions) > 0 else np.ones(len(categories), dtype=bool)
+    labels[no_match] = np.asarray(categories, dtype='object')[no_match] if default is None else default
+
+    # missing values have code -1, which picks out the last label
+    labels = np.append(labels, np.nan if default is None else default)
+    label_codes, label_categories = pd.factorize(labels, sort=True)
+
+    return pd.Categorical.from_codes(np.take(label_codes, codes), categories=label_categories)
+
+# variables that are numeric in the raw data - every other variable is a label, and is stored as a categorical
+numeric_vars = [
+    'longitude',
+    'latitude',
+    'speed_limit',
+    'age_of_casualty',
+    'engine_capacity_cc',
+    'age_of_vehicle',
+    'age_of_driver'
+]
+# numeric variables that are integer codes, which clean_df makes categoricals - they're read as nullable integers, so that their values
+# (and so e.g. their one-hot column names, speed_limit_30 rather than speed_limit_30.0) don't depend on whether the rows read have a missing value
+integer_vars = ['speed_limit']
+
+@profiled
+def read_raw_data(path_to_csv, chunksize=None, years=None):
+    # path_to_csv is the extract written by get_raw_data.r (or a file object of it), or a parquet dataset written by ingest.py
+    if isinstance(path_to_csv, (str, os.PathLike)) and os.path.isdir(path_to_csv):
+        return read_raw_parquet(path_to_csv, chunksize, years)
+    if years is not None:
+        raise ValueError("years can only be selected from a parquet dataset written by ingest.py")
+
+    # the raw extract has location and date columns from both sides of the join with involving_cyclist in get_raw_data.r
+    raw_names = {'longitude': 'longitude.x', 'latitude': 'latitude.x', 'date': 'date.x'}
+    label_vars = [col for col in casualty_vars + vehicle_vars + driver_vars if col not in numeric_vars + ['vehicle_subtype']]
+
+    # only the columns used by expand_collisions are read, with labels read straight into categoricals
+    # accident_index is read as a string so that ids split across pandas' internal blocks (or across chunks) still join to each other
+    usecols = ['accident_index', 'casualty_reference', 'number_of_vehicles'] + [raw_names.get(col, col) for col in casualty_vars + vehicle_vars + driver_vars]
+    dtype = {raw_names.get(col, col): 'category' for col in label_vars}
+    dtype.update({col: 'Int16' for col in integer_vars})
+    dtype['accident_index'] = 'str'
+
+    df = pd.read_csv(path_to_csv, header=0, usecols=lambda col: col in usecols, dtype=dtype, chunksize=chunksize)
+    if chunksize is None:
+        return df.rename(columns={
+            'longitude.x': 'longitude',
+            'latitude.x': 'latitude',
+            'date.x': 'date'
+        })
+
+    return (chunk.rename(columns={'longitude.x': 'longitude', 'latitude.x': 'latitude', 'date.x': 'date'}) for chunk in df)
+
+@profiled
+def read_raw_parquet(path_to_dataset, chunksize=None, years=None):
+    # reads the year-partitioned dataset written by ingest.py, in the same format as read_raw_data
+    # only the partitions of years (default: all) and the columns used by expand_collisions are read
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path_to_dataset, format="parquet", partitioning="hive")
+    usecols = ['accident_index', 'casualty_reference', 'number_of_vehicles'] + casualty_vars + vehicle_vars + driver_vars
+    columns = [col for col in usecols if col in dataset.schema.names]
+    year_filter = ds.field('year').isin(list(years)) if years is not None else None
+
+    if chunksize is None:
+        return parquet_to_pandas(dataset.to_table(columns=columns, filter=year_filter))
+
+    return (parquet_to_pandas(pa.Table.from_batches([batch])) for batch in dataset.to_batches(columns=columns, filter=year_filter, batch_size=chunksize))
+
+def parquet_to_pandas(table):
+    # the pandas metadata is ignored so that integer columns with missing values are read as floats, as read_csv does,
+    # rather than as nullable integers (whose missing values don't compare as nan does in expand_collisions)
+    # apart from integer_vars, which are nullable integers as in read_raw_data
+    df = table.to_pandas(date_as_object=False, ignore_metadata=True)
+    for col in integer_vars:
+        if col in df.columns:
+            df[col] = df[col].astype('Int16')
+
+    return df
 
+@profiled
+def expand_collisions(df, casualty_offset=0, row_offset=0, weather=False, keys=False):
     # First, for collisions where there is more than 1 bike casualty, I will create a separate collision for each bike casualty
     # Then for collisions where there is more than 1 vehicle, I will take only one vehicle based on the following hierarchy:
     #    1. HGV
@@ -18,181 +214,252 @@ def transform_raw_data(path_to_csv):
     #    4. Van
     #    5. Car
     #    6. Motorbike
+    # casualty_offset and row_offset number the casualties and merged rows of df as if it were preceded by that many casualties/rows,
+    # so that the output for a chunk of collisions is identical to the same rows of the output for the whole file
+    # weather=True carries the weather_vars of df (see weather.add_weather) through to the output
+    # keys=True keeps the accident_index and casualty_reference of each bike casualty, so that the output can be joined back to the STATS19 records
+    # returns the expanded collisions, plus the number of casualties and merged rows used, to offset the next chunk
 
     # creating vehicle subtype hierarchy
-    df['vehicle_subtype'] = [
-        "4. Van" if vehicle_type[0] in ["VAN / GOODS 3.5 TONNES MGW OR UNDER", "MINIBUS (8 - 16 PASSENGER SEATS)"]
-        else "1. HGV" if "GOODS" in vehicle_type[0]
-        else "2. Agricultural vehicle" if vehicle_type[0] == "AGRICULTURAL VEHICLE"
-        else "3. Bus" if vehicle_type[0] == "BUS OR COACH (17 OR MORE PASS SEATS)"
-        else "5. Car" if "CAR" in vehicle_type[0]
-        else "6. Motorbike" if "MOTORCYCLE" in vehicle_type[0]
-        else "7. Bike" if vehicle_type[0] == "PEDAL CYCLE"
-        else "8. Unknown"
-        for vehicle_type in zip(df['vehicle_type'].str.upper())
-    ]
+    df['vehicle_subtype'] = map_categories(df['vehicle_type'], vehicle_subtype_rules, default="8. Unknown", case_sensitive=False)
 
     # creating a separate collision for each bike casualty
-    casualty_vars = [
-        'longitude', 
-        'latitude', 
-        'date',
-        'day_of_week',
-        'time', 
-        'first_road_class',
-        'road_type', 
-        'speed_limit',
-        'junction_detail', 
-        'junction_control', 
-        'second_road_class',
-        'pedestrian_crossing_human_control', 
-        'pedestrian_crossing_physical_facilities', 
-        'light_conditions',
-        'weather_conditions', 
-        'road_surface_conditions',
-        'special_conditions_at_site', 
-        'carriageway_hazards',
-        'urban_or_rural_area',
-        # 'RH2M', 
-        # 'T2M', 
-        # 'PRECTOTCORR',
-        # 'WS2M',
-        'sex_of_casualty', 
-        'age_of_casualty', 
-        'age_band_of_casualty',
-        'casualty_severity',
-        'casualty_home_area_type', 
-        'casualty_imd_decile', 
-        'lsoa_of_casualty'
-    ]
-    vehicle_vars = [
-        'vehicle_type', 
-        'vehicle_subtype',
-        'towing_and_articulation',
-        'vehicle_manoeuvre',
-        'vehicle_location_restricted_lane', 
-        'junction_location',
-        'skidding_and_overturning', 
-        'hit_object_in_carriageway',
-        'vehicle_leaving_carriageway', 
-        'hit_object_off_carriageway',
-        'first_point_of_impact', 
-        'vehicle_left_hand_drive',
-        'engine_capacity_cc', 
-        'propulsion_code',
-        'age_of_vehicle'
-    ]
-    driver_vars = [
-        'journey_purpose_of_driver', 
-        'sex_of_driver', 
-        'age_of_driver',
-        'age_band_of_driver',
-        'driver_imd_decile',
-        'driver_home_area_type', 
-        'lsoa_of_driver'
-    ]
     unique_casualties = df[(df['vehicle_type'] == 'Pedal cycle') & ~pd.isnull(df['casualty_reference'])][['accident_index', 'casualty_reference'] + casualty_vars].drop_duplicates().reset_index(drop=True)
+    if weather:
+        # the weather of each collision is taken from its first row, so that it isn't part of the key the casualties are deduplicated on
+        collision_weather = df[['accident_index'] + weather_vars].drop_duplicates('accident_index')
+        unique_casualties = unique_casualties.merge(collision_weather, how='left', on='accident_index')
+    unique_casualties.index = unique_casualties.index + casualty_offset
     unique_casualties['accident_index_2'] = unique_casualties.index
 
-    df_expanded = pd.merge(unique_casualties, df[['accident_index', 'casualty_reference', 'number_of_vehicles'] + vehicle_vars + driver_vars], how="inner", on="accident_index", suffixes=["", "_y"])
-    df_expanded = df_expanded[((df_expanded['casualty_reference'] != df_expanded['casualty_reference_y']) & (df_expanded['number_of_vehicles'] > 1)) | (df_expanded['number_of_vehicles'] == 1)]\
-        .drop(columns=['casualty_reference', 'casualty_reference_y', 'accident_index', 'number_of_vehicles'])
+    with stage("expand_collisions.merge", df) as s:
+        df_expanded = pd.merge(unique_casualties, df[['accident_index', 'casualty_reference', 'number_of_vehicles'] + vehicle_vars + driver_vars], how="inner", on="accident_index", suffixes=["", "_y"])
+        n_rows = len(df_expanded)
+        df_expanded.index = df_expanded.index + row_offset
+        df_expanded = df_expanded[((df_expanded['casualty_reference'] != df_expanded['casualty_reference_y']) & (df_expanded['number_of_vehicles'] > 1)) | (df_expanded['number_of_vehicles'] == 1)]\
+            .drop(columns=['casualty_reference_y', 'number_of_vehicles'] + ([] if keys else ['casualty_reference', 'accident_index']))
+        s.set_output(df_expanded)
 
     # keep 1 vehicle per collision, based on hierarchy
-    df_expanded = df_expanded.sort_values(['accident_index_2', 'vehicle_subtype'])
-    df_expanded = df_expanded.groupby('accident_index_2').nth(0)
+    with stage("expand_collisions.keep_vehicle", df_expanded) as s:
+        df_expanded = df_expanded.sort_values(['accident_index_2', 'vehicle_subtype'])
+        df_expanded = df_expanded.groupby('accident_index_2').nth(0)
+        s.set_output(df_expanded)
 
     # creating date and time features
     df_expanded['time_period'] = (df_expanded.time.str.slice(start=0, stop=2).astype('int') // 4)
     df_expanded['time_period'] = (df_expanded['time_period'] * 4).astype('str') + ':00 - ' + ((df_expanded['time_period'] + 1) * 4).astype('str') + ':00'
+    df_expanded['time_period'] = df_expanded['time_period'].astype('category')
 
     df_expanded['date'] = pd.to_datetime(df_expanded.date)
     df_expanded['month'] = df_expanded['date'].dt.month
-    df_expanded['season'] = [
-        'spring' if month in [3, 4, 5]
-        else 'summer' if month in [6, 7, 8]
-        else 'autumn' if month in [9, 10, 11]
-        else 'winter'
-        for month
-        in df_expanded['month']
-    ]
+    df_expanded['season'] = map_categories(df_expanded['month'], season_rules, default='winter')
 
     df_expanded = df_expanded.drop(columns=['date', 'month'])
 
+    return df_expanded, len(unique_casualties), n_rows
+
+@profiled
+def transform_raw_data(path_to_csv, years=None):
+    df = read_raw_data(path_to_csv, years=years)
+    df_expanded, _, _ = expand_collisions(df)
+
     return df_expanded
 
-def clean_df(df):
-    # standardise missing values
-    missing_values = ['Data missing or out of range', 'unknown (self reported)', np.nan, pd.NA, 'Unknown', 'Not known', 'Undefined', '-1', 'Unallocated']
-    df = df.replace({i: "Missing" for i in missing_values})
+def read_raw_data_by_collision(path_to_csv, chunksize=100000, years=None):
+    # yields chunks of the raw data that each contain all of the rows of their collisions
+    # a collision can only be expanded once all of its rows have been read, so the rows of the last collision in each chunk are held back
+    # and prepended to the next chunk. This assumes the rows of each collision are contiguous in the csv, which is how get_raw_data.r writes them
+    held_back = None
+
+    for chunk in read_raw_data(path_to_csv, chunksize=chunksize, years=years):
+        if held_back is not None:
+            chunk = concat_categoricals(held_back, chunk)
+
+        is_last_collision = (chunk['accident_index'] == chunk['accident_index'].iloc[-1]).to_numpy()
+        held_back = chunk[is_last_collision]
+        chunk = chunk[~is_last_collision]
+        if len(chunk) > 0:
+            yield chunk
+
+    if held_back is not None and len(held_back) > 0:
+        yield held_back
+
+def concat_categoricals(first, second):
+    # pd.concat of first and second, with the categoricals kept as categoricals - pd.concat falls back to object for categoricals whose
+    # categories differ, so each is given the union of both categories first
+    first = first.copy(deep=False)
+    second = second.copy(deep=False)
+    for col in first.columns:
+        if isinstance(first[col].dtype, pd.CategoricalDtype) and isinstance(second[col].dtype, pd.CategoricalDtype):
+            categories = first[col].cat.categories.union(second[col].cat.categories)
+            first[col] = first[col].cat.set_categories(categories)
+            second[col] = second[col].cat.set_categories(categories)
+
+    return pd.concat([first, second], ignore_index=True)
+
+def collision_byte_ranges(path_to_csv, chunksize=100000):
+    # yields (start, end) byte offsets of chunks of about chunksize rows of the extract, each starting at the first row of a collision,
+    # so that the chunks can be read and parsed in worker processes (with read_raw_data_range) rather than all in the process that splits the csv
+    # only the rows either side of each split are read here. As read_raw_data_by_collision, this assumes the rows of each collision are
+    # contiguous, and also that no value contains a newline, which holds for the extract written by get_raw_data.r
+    size = os.path.getsize(path_to_csv)
+    with open(path_to_csv, "rb") as f:
+        header = f.readline()
+        index_position = next(csv.reader([header.decode()])).index('accident_index')
+        start = f.tell()
+
+        # the number of bytes in chunksize rows is estimated from the first 1MB of rows
+        sample = f.readlines(2**20)
+        step = max(1, int(chunksize * sum(map(len, sample)) / max(1, len(sample))))
+
+        while start < size:
+            # the chunk ends at the first row after start + step that starts a collision
+            f.seek(start + step)
+            f.readline()
+            end = f.tell()
+            line = f.readline()
+            if len(line) > 0:
+                accident_index = next(csv.reader([line.decode()]))[index_position]
+                while len(line) > 0 and next(csv.reader([line.decode()]))[index_position] == accident_index:
+                    end = f.tell()
+                    line = f.readline()
+            # the last chunk runs to the end of the file
+            if len(line) == 0:
+                end = size
+            yield start, end
+            start = end
+
+def read_raw_data_range(path_to_csv, start, end):
+    # read_raw_data of the rows in the (start, end) byte range of the extract, e.g. from collision_byte_ranges
+    with open(path_to_csv, "rb") as f:
+        header = f.readline()
+        f.seek(start)
+        data = f.read(end - start)
+
+    return read_raw_data(io.BytesIO(header + data))
+
+def transform_raw_data_chunked(path_to_csv, chunksize=100000, years=None):
+    # streaming version of transform_raw_data for extracts that don't fit in memory - yields the output in chunks, which concatenate to
+    # exactly the output of transform_raw_data (same rows, order and index)
+    # categoricals in each chunk only have the categories seen in that chunk, so they need to be unified (e.g. with concat_categoricals) if chunks are concatenated
+    casualty_offset = 0
+    row_offset = 0
+
+    for chunk in read_raw_data_by_collision(path_to_csv, chunksize=chunksize, years=years):
+        df_expanded, n_casualties, n_rows = expand_collisions(chunk, casualty_offset, row_offset)
+        casualty_offset += n_casualties
+        row_offset += n_rows
+        if len(df_expanded) > 0:
+            yield df_expanded
+
+def transform_raw_data_to_csv(path_to_csv, path_to_output, chunksize=100000):
+    # runs transform_raw_data_chunked, appending each chunk to path_to_output as it goes so only one chunk is held in memory
+    # returns the number of rows written
+    n_rows = 0
+    for i, df_expanded in enumerate(transform_raw_data_chunked(path_to_csv, chunksize=chunksize)):
+        df_expanded.to_csv(path_to_output, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+        n_rows += len(df_expanded)
+
+    return n_rows
+
+@profiled
+def as_categorical(df, missing_values=["Missing"]):
+    # stores the string columns of df as categoricals, with missing_values removed from the categories
+    # so that missing values are held as the categorical missing code (-1) rather than as a label
+    df = df.copy(deep=False)
+    for col in df.select_dtypes(include=['object', 'category']).columns:
+        values = df[col] if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].astype('category')
+        missing_categories = [value for value in missing_values if value in values.cat.categories]
+        if len(missing_categories) > 0:
+            values = values.cat.remove_categories(missing_categories)
+        df[col] = values
+
+    return df
 
+def add_categories(values, categories):
+    # adds any of categories that a categorical series doesn't already have, so that they can be assigned to it
+    new_categories = [category for category in categories if category not in values.cat.categories]
+    if len(new_categories) > 0:
+        values = values.cat.add_categories(new_categories)
+
+    return values
+
+@profiled
+def clean_df(df):
     drop_columns = [
-        'accident_index_2',
+        'accident_index', 'casualty_reference', 'accident_index_2',
         'lsoa_of_casualty', 'lsoa_of_driver', 
         'age_band_of_casualty', 'age_band_of_driver',
         'special_conditions_at_site', 'carriageway_hazards', 'skidding_and_overturning', 'hit_object_in_carriageway', 'hit_object_off_carriageway', 'journey_purpose_of_driver', 'vehicle_leaving_carriageway',
         'age_of_vehicle'
     ]
     drop_columns = [col for col in drop_columns if col in df.columns]
-    if len(drop_columns) > 0:
-        df = df.drop(columns=drop_columns)
+    df = df.drop(columns=drop_columns)
+
+    # standardise missing values - missing values of categorical variables are stored as the categorical missing code, and of continuous variables as nan
+    missing_values = ['Data missing or out of range', 'unknown (self reported)', 'Unknown', 'Not known', 'Undefined', '-1', 'Unallocated']
 
     # categorise speed_limit
+    # with the categories of a nullable integer column as plain integers (categories can't be missing), which is how the cache (cache.py) reads them back
     if 'speed_limit' in df.columns:
-        df['speed_limit'] = df['speed_limit'].astype('object')
+        speed_limit = df['speed_limit'].astype('category')
+        categories = speed_limit.cat.categories
+        if isinstance(categories.dtype, pd.api.extensions.ExtensionDtype):
+            speed_limit = speed_limit.cat.rename_categories(categories.astype(categories.dtype.numpy_dtype))
+        df['speed_limit'] = speed_limit
 
     # convert numeric to continuous
     for col in ['engine_capacity_cc', 'age_of_casualty', 'age_of_driver']:
         if col in df.columns:
-            df[col] = df[col].replace('Missing', np.nan).astype('float')
+            df[col] = df[col].mask(df[col].isin(missing_values)).astype('float')
+
+    df = as_categorical(df, missing_values)
 
     # does not make sense for propulsion_code to have a value for cyclists
     if 'propulsion_code' in df.columns:
-        df["propulsion_code"] = np.where(df["vehicle_type"] == "Pedal cycle", "Undefined", df["propulsion_code"])
+        df["propulsion_code"] = add_categories(df["propulsion_code"], ["Undefined"]).mask(df["vehicle_type"] == "Pedal cycle", "Undefined")
 
     if 'junction_control' in df.columns:
-        df['junction_control'] = df['junction_control'].replace('Missing', 'Not at or within 20 metres of junction')
+        df['junction_control'] = add_categories(df['junction_control'], ['Not at or within 20 metres of junction']).fillna('Not at or within 20 metres of junction')
 
     return df
 
+@profiled
 def impute_fit_df(df):
     # calculate category distributions of each categorical variable
-    df = df.replace("Missing", np.nan).reset_index(drop=True)
+    df = as_categorical(df).reset_index(drop=True)
 
+    # value_counts on a categorical counts the category codes, and includes categories with no rows, which are dropped
     categorical_freqs = {}
-    for col in df.select_dtypes(include='object').columns:
-        freq_dict = df[col].value_counts(normalize=True).to_dict()
-        categorical_freqs[col] = freq_dict
+    for col in df.select_dtypes(include='category').columns:
+        freq_dict = df[col].value_counts(normalize=True)
+        categorical_freqs[col] = freq_dict[freq_dict > 0].to_dict()
 
     # imputing continuous variables
     # creating new vehicle_type column because some values of vehicle_type have no values for engine_capacity_cc -> using other types of vehicle that have the most similar engine size
     if "vehicle_type" in df.columns:
-        df["vehicle_type_2"] = [
-            "Goods over 3.5t. and under 7.5t" if vehicle_type in ["Agricultural vehicle", "Goods vehicle - unknown weight"]
-            else "Motorcycle 50cc and under" if vehicle_type == "Electric motorcycle"
-            else "Motorcycle 125cc and under" if vehicle_type == "Motorcycle - unknown cc"
-            else "Car" if vehicle_type == "Unknown vehicle type (self rep only)"
-            else vehicle_type
-            for vehicle_type in df["vehicle_type"]
-        ]
-
-    vars_to_groupby = {
-        "engine_capacity_cc": "vehicle_type_2",
-        "age_of_casualty": "towing_and_articulation",
-        "age_of_driver": "vehicle_type"
-    }
+        df["vehicle_type_2"] = map_categories(df["vehicle_type"], vehicle_type_2_rules)
+
     continuous_medians_grouped = {}
     continuous_medians = {}
 
-    for col in vars_to_groupby:
-        if col in df.columns:
-            impute_value = df[~df[col].isna()][col].median()
-            continuous_medians[col] = impute_value
+    with stage("impute_fit_df.medians", df):
+        for col in vars_to_groupby:
+            if col in df.columns:
+                impute_value = df[~df[col].isna()][col].median()
+                continuous_medians[col] = impute_value
 
-            if vars_to_groupby[col] in df.columns:
-                lookup_df = df.groupby(vars_to_groupby[col])[col].median()
-                continuous_medians_grouped[col] = lookup_df
-            else:
+                if vars_to_groupby[col] in df.columns:
+                    lookup_df = df.groupby(vars_to_groupby[col], observed=True)[col].median()
+                    continuous_medians_grouped[col] = lookup_df
+                else:
+                    continuous_medians_grouped[col] = None
+
+        # every other continuous variable (e.g. the exposure features of spatial.py) is imputed with its overall median
+        for col in df.select_dtypes(exclude=['object', 'category']).columns:
+            if col not in continuous_medians:
+                continuous_medians[col] = df[col].median()
                 continuous_medians_grouped[col] = None
 
     # "Pedal cycle" has no values for engine_capacity_cc for obvious reasons
@@ -205,60 +472,96 @@ def impute_fit_df(df):
         df["engine_capacity_cc"] = np.where(df["vehicle_type"] == "Pedal cycle", 0.00065 * engine_capacity_car, df["engine_capacity_cc"])
 
     # fit scaler
-    continuous_vars = [col for col in list(df.select_dtypes(exclude='object').columns) if col not in ['longitude', 'latitude']]
+    continuous_vars = [col for col in list(df.select_dtypes(exclude=['object', 'category']).columns) if col not in ['longitude', 'latitude']]
     if len(continuous_vars) > 0:
-        scaler = MinMaxScaler()
-        scaler.fit(df[continuous_vars])
+        with stage("impute_fit_df.scaler", df):
+            scaler = MinMaxScaler()
+            scaler.fit(df[continuous_vars])
     else:
         scaler = None
 
     return categorical_freqs, vars_to_groupby, continuous_medians_grouped, continuous_medians, scaler
 
+@profiled
+def impute_categorical_vars(df, categorical_freqs, columns, rng=None):
+    # fills the missing values of each categorical column with categories sampled from categorical_freqs
+    # one value is drawn per missing cell, with the draws for every column made in a single call to the generator,
+    # then each column's draws are turned into categories by a binary search of its cumulative distribution
+    # rng is a numpy Generator or seed - if None, the generator is seeded from numpy's global random state so np.random.seed still applies
+    if rng is None:
+        rng = np.random.randint(0, 2**31)
+    rng = np.random.default_rng(rng)
+
+    missing_rows = {col: np.flatnonzero(df[col].isna().to_numpy()) for col in columns}
+    missing_rows = {col: rows for col, rows in missing_rows.items() if len(rows) > 0}
+    draws = rng.random(sum(len(rows) for rows in missing_rows.values()))
+
+    start = 0
+    for col, rows in missing_rows.items():
+        freq_dict = categorical_freqs[col]
+        values = add_categories(df[col], freq_dict.keys())
+        categories = values.cat.categories.get_indexer(list(freq_dict.keys()))
+
+        # normalised by the last value so that rounding can't leave draws past the end of the distribution
+        cdf = np.cumsum(list(freq_dict.values()))
+        sampled = np.searchsorted(cdf / cdf[-1], draws[start:start + len(rows)], side='right')
+        start += len(rows)
+
+        codes = values.cat.codes.to_numpy().copy()
+        codes[rows] = categories[sampled]
+        df[col] = pd.Categorical.from_codes(codes, dtype=values.dtype)
+
+    return df
+
+@profiled
+def impute_continuous_vars(df, vars_to_groupby, continuous_medians_grouped, continuous_medians, select_features):
+    # missing values are filled with the median of their group (e.g. engine_capacity_cc by vehicle_type_2)
+    # or with the overall median if there were no values in the group, or no group column (every variable not in vars_to_groupby)
+    # the group medians are laid out by the group column's category codes, so each row's median is a direct lookup by its code
+    for var in continuous_medians:
+        if var not in select_features:
+            continue
+
+        values = df[var].to_numpy(dtype='float', copy=True)
+        missing = np.isnan(values)
+        if not missing.any():
+            continue
+
+        impute_values = np.full(len(df), continuous_medians[var])
+        lookup_df = continuous_medians_grouped.get(var)
+        if lookup_df is not None and vars_to_groupby[var] in df.columns:
+            group = df[vars_to_groupby[var]].astype('category')
+            # position of each category in the lookup, -1 (-> nan) if the group had no median; code -1 (missing group) also picks out nan
+            positions = lookup_df.index.get_indexer(group.cat.categories)
+            medians = np.append(np.append(lookup_df.to_numpy(dtype='float'), np.nan)[positions], np.nan)
+            group_values = medians[group.cat.codes.to_numpy()]
+            impute_values = np.where(np.isnan(group_values), impute_values, group_values)
+
+        values[missing] = impute_values[missing]
+        df[var] = values
+
+    return df
+
+@profiled
 def impute_transform_df(df, categorical_freqs, vars_to_groupby, continuous_medians_grouped,
                         continuous_medians, scaler, select_features, encoded_cols_dict=None,
-                        one_hot_encode=True, one_hot_encoded_cols=None):
-    missing = pd.DataFrame([i for i in zip(df.columns, df.dtypes, df.nunique(), 100 * ((df == "Missing") | (df.isnull())).mean()) if i[3] > 0], columns=['column', 'dtype', 'nunique', 'missing %']).sort_values("missing %")
+                        one_hot_encode=True, one_hot_encoded_cols=None, rng=None, sparse_output=False):
+    # sparse_output=True returns the one-hot encoded data as a scipy CSR matrix and a list of its column names (see one_hot_sparse)
+    # rather than a DataFrame
+    if sparse_output and not one_hot_encode:
+        raise ValueError("sparse_output needs one_hot_encode=True")
+    df = as_categorical(df).reset_index(drop=True)
 
     # categorical missing values imputed while keeping the category distributions of each variable the same
-    categorical_missing = list(missing[missing['dtype'] == 'object']['column'])
-    df = df.replace("Missing", np.nan).reset_index(drop=True)
-
-    for col in categorical_missing:
-        if col in select_features and col not in ['longitude', 'latitude']:
-            freq_dict = categorical_freqs[col]
-            df[col] = df[col].fillna(pd.Series(np.random.choice(list(freq_dict.keys()), p=list(freq_dict.values()), size=len(df))))
+    categorical_vars = [col for col in df.select_dtypes(include='category').columns if col in select_features and col not in ['longitude', 'latitude']]
+    df = impute_categorical_vars(df, categorical_freqs, categorical_vars, rng)
 
     # imputing continuous variables
     # creating new vehicle_type column because some values of vehicle_type have no values for engine_capacity_cc -> using other types of vehicle that have the most similar engine size
     if "vehicle_type" in df.columns:
-        df["vehicle_type_2"] = [
-            "Goods over 3.5t. and under 7.5t" if vehicle_type in ["Agricultural vehicle", "Goods vehicle - unknown weight"]
-            else "Motorcycle 50cc and under" if vehicle_type == "Electric motorcycle"
-            else "Motorcycle 125cc and under" if vehicle_type == "Motorcycle - unknown cc"
-            else "Car" if vehicle_type == "Unknown vehicle type (self rep only)"
-            else vehicle_type
-            for vehicle_type in df["vehicle_type"]
-        ]
-
-    # first imputation should capture most nulls
-    # second imputation should capture any remaining nulls (remaining because there were no values in the lookup group)
-    def impute_continuous_vars(df, impute_lookup, grouped=False):
-        for var in impute_lookup:
-            if var in select_features:
-                if grouped and vars_to_groupby[var] in df.columns:
-                    lookup_df = impute_lookup[var]
-                    df = pd.merge(df, lookup_df, how="left", on=vars_to_groupby[var], suffixes=["", "_y"])
-                    df[var] = np.where(df[var].isna(), df[var + '_y'], df[var])
-                    df = df.drop(columns=[var + '_y'])
-                else:
-                    impute_value = impute_lookup[var]
-                    df[var] = df[var].replace(np.nan, impute_value)
+        df["vehicle_type_2"] = map_categories(df["vehicle_type"], vehicle_type_2_rules)
 
-        return df
-
-    df_1 = impute_continuous_vars(df, continuous_medians_grouped, grouped=True)
-    df_2 = impute_continuous_vars(df_1, continuous_medians)
-    df = df_2
+    df = impute_continuous_vars(df, vars_to_groupby, continuous_medians_grouped, continuous_medians, select_features)
 
     # "Pedal cycle" has no values for engine_capacity_cc for obvious reasons
     # assume average cyclist can push 100W ≈ 0.13 horsepower -> horsepower of standard car ~200 -> cyclist horsepower 0.13/200=0.00065 of a car -> set engine_capacity_cc of "Pedal cycle" to 0.00065 that of a car
@@ -276,16 +579,22 @@ def impute_transform_df(df, categorical_freqs, vars_to_groupby, continuous_media
     df = df[select_features]
 
     # check there are no more missing values
-    assert sum(((df.isna()) | (df == "Missing")).any()) == 0
+    assert sum(df.isna().any()) == 0
 
     # apply transformations
-    continuous_vars = [col for col in list(df.select_dtypes(exclude='object').columns) if col not in ['longitude', 'latitude']]
+    continuous_vars = [col for col in list(df.select_dtypes(exclude=['object', 'category']).columns) if col not in ['longitude', 'latitude']]
     if scaler != None:
-        df[continuous_vars] = scaler.transform(df[continuous_vars])
+        with stage("impute_transform_df.scale", df):
+            df[continuous_vars] = scaler.transform(df[continuous_vars])
+
+    if sparse_output:
+        return one_hot_sparse(df, select_features, encoded_cols_dict, continuous_vars if one_hot_encoded_cols != None else None, one_hot_encoded_cols)
 
     if one_hot_encode:
-        categorical_vars = [col for col in list(df.select_dtypes(include='object').columns) if col not in ['date', 'time', 'casualty_severity']]
-        df = pd.get_dummies(df, columns=categorical_vars, drop_first=False)
+        categorical_vars = [col for col in list(df.select_dtypes(include=['object', 'category']).columns) if col not in ['date', 'time', 'casualty_severity']]
+        with stage("impute_transform_df.get_dummies", df) as s:
+            df = pd.get_dummies(df, columns=categorical_vars, drop_first=False)
+            s.set_output(df)
 
     # add empty columns for one-hot encoded columns that are missing
     # sklearn requires that train and test data has the same columns
@@ -309,46 +618,94 @@ def impute_transform_df(df, categorical_freqs, vars_to_groupby, continuous_media
 
     return df
 
+@profiled
+def one_hot_sparse(df, select_features, encoded_cols_dict=None, continuous_vars=None, one_hot_encoded_cols=None):
+    # the one-hot output of impute_transform_df as a CSR matrix with the same columns, built directly from the category codes
+    # rather than from pd.get_dummies, so the mostly zero one-hot columns are never stored densely or copied
+    # XGBoost and sklearn's linear models fit on the matrix as it is
+    # columns: every number column and a column per category (named as pd.get_dummies does), plus the encoded_cols_dict columns of select_features,
+    # or continuous_vars + one_hot_encoded_cols if given - sorted, like impute_transform_df
+    categorical_vars = list(df.select_dtypes(include=['object', 'category']).columns)
+    not_encoded = [col for col in categorical_vars if col in ['date', 'time', 'casualty_severity']]
+    if len(not_encoded) > 0:
+        raise ValueError(f"Columns can't be stored in a sparse matrix: {not_encoded}")
+    number_vars = [col for col in df.columns if col not in categorical_vars]
+
+    values = {col: df[col].astype('category') for col in categorical_vars}
+    category_cols = {col: [f"{col}_{category}" for category in values[col].cat.categories] for col in categorical_vars}
+    if one_hot_encoded_cols != None:
+        columns = list(continuous_vars) + list(one_hot_encoded_cols)
+    else:
+        columns = number_vars + [encoded_col for col in categorical_vars for encoded_col in category_cols[col]]
+        if encoded_cols_dict != None:
+            columns += [encoded_col for col in select_features for encoded_col in encoded_cols_dict.get(col, []) if encoded_col not in columns]
+    columns = sorted(set(columns))
+    column_index = {col: i for i, col in enumerate(columns)}
+
+    number_vars = [col for col in number_vars if col in column_index]
+    output_columns = np.full((len(df), len(number_vars) + len(categorical_vars)), -1, dtype=np.int32)
+    output_values = np.ones(output_columns.shape)
+    for j, col in enumerate(number_vars):
+        output_columns[:, j] = column_index[col]
+        output_values[:, j] = df[col].to_numpy(dtype='float')
+    for j, col in enumerate(categorical_vars, start=len(number_vars)):
+        # output column of each category, -1 if it isn't one of the columns; code -1 (missing) also picks out -1
+        outputs = np.array([column_index.get(encoded_col, -1) for encoded_col in category_cols[col]] + [-1], dtype=np.int32)
+        output_columns[:, j] = outputs[values[col].cat.codes.to_numpy()]
+
+    return rows_to_csr(output_columns, output_values, len(columns)), columns
+
+def rows_to_csr(output_columns, output_values, n_columns):
+    # CSR matrix from the (output column, value) of each variable of each row, as (rows, variables) arrays with output column -1 for no value
+    # every row has at most one value per variable, so the matrix is built directly in row order rather than via a COO matrix
+    # values of number variables are stored even when they're 0, as XGBoost treats a value that isn't stored as missing rather than 0,
+    # so only the one-hot columns (0 or 1) have values that aren't stored, which XGBoost splits on the same as 0
+    stored = output_columns >= 0
+    indptr = np.zeros(len(output_columns) + 1, dtype=np.int64)
+    np.cumsum(stored.sum(axis=1), out=indptr[1:])
+
+    matrix = sparse.csr_matrix((output_values[stored], output_columns[stored], indptr), shape=(len(output_columns), n_columns))
+    # sorted in place, which needs less memory than sorting the arrays beforehand
+    matrix.sort_indices()
+    return matrix
+
+@profiled
 def impute_fit_df_TE(X, y):
     df = pd.concat([X, y], axis=1)
 
     # calculate category distributions of each categorical variable
-    df = df.replace("Missing", np.nan).reset_index(drop=True)
+    df = as_categorical(df).reset_index(drop=True)
 
+    # value_counts on a categorical counts the category codes, and includes categories with no rows, which are dropped
     categorical_freqs = {}
-    for col in df.select_dtypes(include='object').columns:
-        freq_dict = df[col].value_counts(normalize=True).to_dict()
-        categorical_freqs[col] = freq_dict
+    for col in df.select_dtypes(include='category').columns:
+        freq_dict = df[col].value_counts(normalize=True)
+        categorical_freqs[col] = freq_dict[freq_dict > 0].to_dict()
 
     # imputing continuous variables
     # creating new vehicle_type column because some values of vehicle_type have no values for engine_capacity_cc -> using other types of vehicle that have the most similar engine size
     if "vehicle_type" in df.columns:
-        df["vehicle_type_2"] = [
-            "Goods over 3.5t. and under 7.5t" if vehicle_type in ["Agricultural vehicle", "Goods vehicle - unknown weight"]
-            else "Motorcycle 50cc and under" if vehicle_type == "Electric motorcycle"
-            else "Motorcycle 125cc and under" if vehicle_type == "Motorcycle - unknown cc"
-            else "Car" if vehicle_type == "Unknown vehicle type (self rep only)"
-            else vehicle_type
-            for vehicle_type in df["vehicle_type"]
-        ]
-
-    vars_to_groupby = {
-        "engine_capacity_cc": "vehicle_type_2",
-        "age_of_casualty": "towing_and_articulation",
-        "age_of_driver": "vehicle_type"
-    }
+        df["vehicle_type_2"] = map_categories(df["vehicle_type"], vehicle_type_2_rules)
+
     continuous_medians_grouped = {}
     continuous_medians = {}
 
-    for col in vars_to_groupby:
-        if col in df.columns:
-            impute_value = df[~df[col].isna()][col].median()
-            continuous_medians[col] = impute_value
+    with stage("impute_fit_df_TE.medians", df):
+        for col in vars_to_groupby:
+            if col in df.columns:
+                impute_value = df[~df[col].isna()][col].median()
+                continuous_medians[col] = impute_value
 
-            if vars_to_groupby[col] in df.columns:
-                lookup_df = df.groupby(vars_to_groupby[col])[col].median()
-                continuous_medians_grouped[col] = lookup_df
-            else:
+                if vars_to_groupby[col] in df.columns:
+                    lookup_df = df.groupby(vars_to_groupby[col], observed=True)[col].median()
+                    continuous_medians_grouped[col] = lookup_df
+                else:
+                    continuous_medians_grouped[col] = None
+
+        # every other continuous variable (e.g. the exposure features of spatial.py) is imputed with its overall median
+        for col in df.select_dtypes(exclude=['object', 'category']).columns:
+            if col not in continuous_medians and col != 'fatality':
+                continuous_medians[col] = df[col].median()
                 continuous_medians_grouped[col] = None
 
     # "Pedal cycle" has no values for engine_capacity_cc for obvious reasons
@@ -364,64 +721,37 @@ def impute_fit_df_TE(X, y):
         df = df.drop(columns=["vehicle_type_2"])
 
     # fit scaler
-    continuous_vars = [col for col in list(df.select_dtypes(exclude='object').columns) if col not in ['longitude', 'latitude', 'fatality']]
+    continuous_vars = [col for col in list(df.select_dtypes(exclude=['object', 'category']).columns) if col not in ['longitude', 'latitude', 'fatality']]
     if len(continuous_vars) > 0:
-        scaler = MinMaxScaler()
-        scaler.fit(df[continuous_vars])
+        with stage("impute_fit_df_TE.scaler", df):
+            scaler = MinMaxScaler()
+            scaler.fit(df[continuous_vars])
     else:
         scaler = None
 
     # fit target encoder
-    categorical_vars = [col for col in list(df.select_dtypes(include='object').columns) if col not in ['date', 'time', 'fatality']]
-    encoder = TargetEncoder(categories='auto', target_type='binary', smooth='auto', cv=5, random_state=42)
-    encoder.fit(df[categorical_vars], y)
+    categorical_vars = [col for col in list(df.select_dtypes(include=['object', 'category']).columns) if col not in ['date', 'time', 'fatality']]
+    with stage("impute_fit_df_TE.target_encoder", df):
+        encoder = TargetEncoder(categories='auto', target_type='binary', smooth='auto', cv=5, random_state=42)
+        encoder.fit(df[categorical_vars], y)
 
     return categorical_freqs, vars_to_groupby, continuous_medians_grouped, continuous_medians, scaler, encoder
 
+@profiled
 def impute_transform_df_TE(df, categorical_freqs, vars_to_groupby, continuous_medians_grouped,
-                        continuous_medians, scaler, select_features, encoder):
-    missing = pd.DataFrame([i for i in zip(df.columns, df.dtypes, df.nunique(), 100 * ((df == "Missing") | (df.isnull())).mean()) if i[3] > 0], columns=['column', 'dtype', 'nunique', 'missing %']).sort_values("missing %")
+                        continuous_medians, scaler, select_features, encoder, rng=None):
+    df = as_categorical(df).reset_index(drop=True)
 
     # categorical missing values imputed while keeping the category distributions of each variable the same
-    categorical_missing = list(missing[missing['dtype'] == 'object']['column'])
-    df = df.replace("Missing", np.nan).reset_index(drop=True)
-
-    for col in categorical_missing:
-        if col in select_features and col not in ['longitude', 'latitude']:
-            freq_dict = categorical_freqs[col]
-            df[col] = df[col].fillna(pd.Series(np.random.choice(list(freq_dict.keys()), p=list(freq_dict.values()), size=len(df))))
+    categorical_vars = [col for col in df.select_dtypes(include='category').columns if col in select_features and col not in ['longitude', 'latitude']]
+    df = impute_categorical_vars(df, categorical_freqs, categorical_vars, rng)
 
     # imputing continuous variables
     # creating new vehicle_type column because some values of vehicle_type have no values for engine_capacity_cc -> using other types of vehicle that have the most similar engine size
     if "vehicle_type" in df.columns:
-        df["vehicle_type_2"] = [
-            "Goods over 3.5t. and under 7.5t" if vehicle_type in ["Agricultural vehicle", "Goods vehicle - unknown weight"]
-            else "Motorcycle 50cc and under" if vehicle_type == "Electric motorcycle"
-            else "Motorcycle 125cc and under" if vehicle_type == "Motorcycle - unknown cc"
-            else "Car" if vehicle_type == "Unknown vehicle type (self rep only)"
-            else vehicle_type
-            for vehicle_type in df["vehicle_type"]
-        ]
-
-    # first imputation should capture most nulls
-    # second imputation should capture any remaining nulls (remaining because there were no values in the lookup group)
-    def impute_continuous_vars(df, impute_lookup, grouped=False):
-        for var in impute_lookup:
-            if var in select_features:
-                if grouped and vars_to_groupby[var] in df.columns:
-                    lookup_df = impute_lookup[var]
-                    df = pd.merge(df, lookup_df, how="left", on=vars_to_groupby[var], suffixes=["", "_y"])
-                    df[var] = np.where(df[var].isna(), df[var + '_y'], df[var])
-                    df = df.drop(columns=[var + '_y'])
-                else:
-                    impute_value = impute_lookup[var]
-                    df[var] = df[var].replace(np.nan, impute_value)
-
-        return df
+        df["vehicle_type_2"] = map_categories(df["vehicle_type"], vehicle_type_2_rules)
 
-    df_1 = impute_continuous_vars(df, continuous_medians_grouped, grouped=True)
-    df_2 = impute_continuous_vars(df_1, continuous_medians)
-    df = df_2
+    df = impute_continuous_vars(df, vars_to_groupby, continuous_medians_grouped, continuous_medians, select_features)
 
     # "Pedal cycle" has no values for engine_capacity_cc for obvious reasons
     # assume average cyclist can push 100W ≈ 0.13 horsepower -> horsepower of standard car ~200 -> cyclist horsepower 0.13/200=0.00065 of a car -> set engine_capacity_cc of "Pedal cycle" to 0.00065 that of a car
@@ -439,18 +769,272 @@ def impute_transform_df_TE(df, categorical_freqs, vars_to_groupby, continuous_me
     df = df[select_features]
 
     # check there are no more missing values
-    assert sum(((df.isna()) | (df == "Missing")).any()) == 0
+    assert sum(df.isna().any()) == 0
 
     # apply transformations
-    continuous_vars = [col for col in list(df.select_dtypes(exclude='object').columns) if col not in ['longitude', 'latitude']]
+    continuous_vars = [col for col in list(df.select_dtypes(exclude=['object', 'category']).columns) if col not in ['longitude', 'latitude']]
     if scaler != None:
-        df[continuous_vars] = scaler.transform(df[continuous_vars])
+        with stage("impute_transform_df_TE.scale", df):
+            df[continuous_vars] = scaler.transform(df[continuous_vars])
 
-    categorical_vars = [col for col in list(df.select_dtypes(include='object').columns) if col not in ['date', 'time', 'casualty_severity', 'fatality']]
-    df[categorical_vars] = encoder.transform(df[categorical_vars])
+    categorical_vars = [col for col in list(df.select_dtypes(include=['object', 'category']).columns) if col not in ['date', 'time', 'casualty_severity', 'fatality']]
+    with stage("impute_transform_df_TE.target_encode", df):
+        df[categorical_vars] = encoder.transform(df[categorical_vars])
 
     # sklearn requires that train and test data has same column order
     cols = sorted(list(df.columns))
     df = df[cols]
 
-    return df
\ No newline at end of file
+    return df
+
+class CustomPreprocessor(BaseEstimator, TransformerMixin):
+    # fitted version of impute_fit_df/impute_transform_df (encoding="one_hot") or impute_fit_df_TE/impute_transform_df_TE (encoding="target")
+    # fit compiles the fitted values into a transform plan: the output columns are fixed, each category of each categorical variable is given
+    # its output column (one-hot) or encoded value (target encoding), and the medians and scaler are stored as arrays
+    # transform then fills a preallocated numpy array, without building any intermediate DataFrames, so that it is fast for single records
+    # transform accepts a DataFrame, a dict (one record) or a list of dicts, and returns a float array with columns get_feature_names_out()
+    # for scoring single records, passing dicts avoids the per-column overhead of pandas (~1ms for a 1-row DataFrame vs ~0.3ms for a dict)
+    # categories not seen in fit are encoded as all zeros (one-hot) or the target mean (target encoding)
+    # sparse_output=True (one-hot only) returns a scipy CSR matrix instead, with only the nonzero values stored - see one_hot_sparse
+    # log_cols are continuous variables that are also output as log_<variable>, the log of the imputed and scaled value (plus 1e-7, so 0 is finite)
+    def __init__(self, encoding="one_hot", encoded_cols_dict=None, one_hot_encoded_cols=None, rng=None, sparse_output=False, log_cols=None):
+        self.encoding = encoding
+        self.encoded_cols_dict = encoded_cols_dict
+        self.one_hot_encoded_cols = one_hot_encoded_cols
+        self.rng = rng
+        self.sparse_output = sparse_output
+        self.log_cols = log_cols
+
+    # fit is only called on the train data
+    @profiled
+    def fit(self, X, y=None):
+        if self.encoding == "one_hot":
+            self.categorical_freqs_, self.vars_to_groupby_, self.continuous_medians_grouped_, self.continuous_medians_, self.scaler_ = impute_fit_df(X)
+            self.encoder_ = None
+        elif self.encoding == "target":
+            self.categorical_freqs_, self.vars_to_groupby_, self.continuous_medians_grouped_, self.continuous_medians_, self.scaler_, self.encoder_ = impute_fit_df_TE(X, y)
+        else:
+            raise ValueError(f"Unknown encoding: {self.encoding}")
+
+        self.rng_ = np.random.default_rng(self.rng)
+        self.compile_plan(as_categorical(X))
+        self.imputer_ = None
+        return self
+
+    # updates the fit with a new batch of train data (e.g. the latest month of STATS19) without refitting on the batches before it
+    # the fitted values are the same as fit on every batch at once, except that medians may be estimated - see incremental.py
+    # partial_fit after fit starts again from the new batch
+    @profiled
+    def partial_fit(self, X, y=None):
+        # imported here as incremental.py imports this module
+        from incremental import IncrementalImputer
+
+        if self.encoding not in ["one_hot", "target"]:
+            raise ValueError(f"Unknown encoding: {self.encoding}")
+        if getattr(self, "imputer_", None) is None:
+            self.imputer_ = IncrementalImputer(target_encode=self.encoding == "target")
+            self.rng_ = np.random.default_rng(self.rng)
+        self.imputer_.partial_fit(X, y)
+
+        if self.encoding == "one_hot":
+            self.categorical_freqs_, self.vars_to_groupby_, self.continuous_medians_grouped_, self.continuous_medians_, self.scaler_ = self.imputer_.fitted_values()
+            self.encoder_ = None
+        else:
+            self.categorical_freqs_, self.vars_to_groupby_, self.continuous_medians_grouped_, self.continuous_medians_, self.scaler_, self.encoder_ = self.imputer_.fitted_values()
+
+        self.compile_plan(self.imputer_.template())
+        return self
+
+    def compile_plan(self, X):
+        if self.sparse_output and self.encoding != "one_hot":
+            raise ValueError("sparse_output is only for one-hot encoding")
+        self.features_ = list(X.columns)
+        self.categorical_vars_ = [col for col in X.select_dtypes(include='category').columns if col not in ['longitude', 'latitude']]
+        self.continuous_vars_ = [col for col in X.columns if col not in self.categorical_vars_]
+        passthrough = [col for col in self.categorical_vars_ if col in ['date', 'time', 'casualty_severity', 'fatality']]
+        if len(passthrough) > 0:
+            raise ValueError(f"Columns can't be encoded as numbers: {passthrough}")
+        log_cols = list(self.log_cols) if self.log_cols is not None else []
+        if any(col not in self.continuous_vars_ for col in log_cols):
+            raise ValueError(f"log_cols have to be continuous variables: {[col for col in log_cols if col not in self.continuous_vars_]}")
+
+        # output columns, in the same order as impute_transform_df(_TE)
+        if self.encoding == "one_hot":
+            encoded_cols = [f"{col}_{category}" for col in self.categorical_vars_ for category in X[col].cat.categories]
+            if self.encoded_cols_dict is not None:
+                encoded_cols += [encoded_col for col in self.features_ for encoded_col in self.encoded_cols_dict.get(col, []) if encoded_col not in encoded_cols]
+            scaled_vars = [col for col in self.continuous_vars_ if col not in ['longitude', 'latitude']]
+            if self.one_hot_encoded_cols is not None:
+                columns = scaled_vars + list(self.one_hot_encoded_cols)
+            else:
+                columns = self.continuous_vars_ + encoded_cols
+        else:
+            columns = self.features_
+        columns = list(columns) + [f"log_{col}" for col in log_cols]
+        self.feature_names_out_ = np.array(sorted(columns), dtype='object')
+        column_index = {col: i for i, col in enumerate(self.feature_names_out_)}
+
+        # categorical variables: category -> position in the vocabulary, and position -> output column or encoded value
+        # position -2 marks a missing value, -1 a category not seen in fit
+        self.vocabularies_ = {}
+        self.category_lookups_ = {}
+        self.category_outputs_ = {}
+        self.impute_positions_ = {}
+        self.impute_cdfs_ = {}
+        for col in self.categorical_vars_:
+            if self.encoding == "one_hot":
+                vocabulary = pd.Index(X[col].cat.categories)
+                # position -1 (unseen category) -> no output column
+                self.category_outputs_[col] = np.array([column_index.get(f"{col}_{category}", -1) for category in vocabulary] + [-1])
+            else:
+                encoder_index = list(self.encoder_.feature_names_in_).index(col)
+                categories = self.encoder_.categories_[encoder_index]
+                keep = ~pd.isna(categories)
+                vocabulary = pd.Index(categories[keep])
+                # unseen categories are given the target mean, like TargetEncoder
+                self.category_outputs_[col] = np.append(self.encoder_.encodings_[encoder_index][keep], self.encoder_.target_mean_)
+            self.vocabularies_[col] = vocabulary
+            self.category_lookups_[col] = {category: position for position, category in enumerate(vocabulary)}
+            self.category_lookups_[col]["Missing"] = -2
+
+            freq_dict = self.categorical_freqs_.get(col, {})
+            self.impute_positions_[col] = vocabulary.get_indexer(list(freq_dict.keys()))
+            cdf = np.cumsum(list(freq_dict.values()))
+            self.impute_cdfs_[col] = cdf / cdf[-1] if len(cdf) > 0 else cdf
+
+        # continuous variables: group medians laid out by the vocabulary position of the group column, with the overall median for position -1
+        self.median_plans_ = {}
+        for var, impute_value in self.continuous_medians_.items():
+            if var not in self.continuous_vars_:
+                continue
+            group_col = self.vars_to_groupby_.get(var)
+            lookup_df = self.continuous_medians_grouped_.get(var)
+            # vehicle_type_2 is derived from vehicle_type, so its medians are laid out by vehicle_type
+            key_col = "vehicle_type" if group_col == "vehicle_type_2" else group_col
+            if lookup_df is None or key_col not in self.vocabularies_:
+                self.median_plans_[var] = (None, np.array([impute_value]))
+                continue
+            keys = self.vocabularies_[key_col]
+            if group_col == "vehicle_type_2":
+                keys = pd.Index(np.asarray(map_categories(pd.Series(keys), vehicle_type_2_rules), dtype='object'))
+            medians = np.append(lookup_df.to_numpy(dtype='float'), np.nan)[lookup_df.index.get_indexer(keys)]
+            medians = np.append(np.where(np.isnan(medians), impute_value, medians), impute_value)
+            self.median_plans_[var] = (key_col, medians)
+
+        # "Pedal cycle" has no values for engine_capacity_cc - see impute_fit_df
+        self.engine_capacity_bike_ = None
+        if 'engine_capacity_cc' in self.continuous_vars_ and 'vehicle_type' in self.vocabularies_:
+            try:
+                engine_capacity_car = self.continuous_medians_grouped_["engine_capacity_cc"].loc["Car"]
+            except (KeyError, AttributeError):
+                engine_capacity_car = self.continuous_medians_["engine_capacity_cc"]
+            # position None if "Pedal cycle" wasn't seen in fit, as -1 is also the position of every other unseen vehicle type
+            bike_position = self.vocabularies_['vehicle_type'].get_indexer(["Pedal cycle"])[0]
+            self.engine_capacity_bike_ = (bike_position if bike_position >= 0 else None, 0.00065 * engine_capacity_car)
+
+        # scaler parameters (X * scale + min) and output column of each continuous variable
+        self.scaling_ = {}
+        if self.scaler_ is not None:
+            for col, scale, min_value in zip(self.scaler_.feature_names_in_, self.scaler_.scale_, self.scaler_.min_):
+                self.scaling_[col] = (scale, min_value)
+        self.continuous_outputs_ = {col: column_index[col] for col in self.continuous_vars_ if col in column_index}
+        self.log_outputs_ = {col: column_index[f"log_{col}"] for col in log_cols}
+        if self.encoding == "target":
+            self.categorical_columns_ = {col: column_index[col] for col in self.categorical_vars_}
+
+    def category_positions(self, col, values):
+        # categoricals are looked up once per category then gathered by code, small batches are looked up in a dict,
+        # and anything else with a vectorised index lookup
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            lookup = self.category_lookups_[col]
+            category_positions = np.array([lookup.get(category, -1) for category in values.cat.categories] + [-2], dtype=np.intp)
+            positions = category_positions[values.cat.codes.to_numpy()]
+        elif len(values) <= 64:
+            # value != value picks out nan
+            lookup = self.category_lookups_[col]
+            positions = np.fromiter((lookup.get(value, -2 if value is None or value != value else -1) for value in values), dtype=np.intp, count=len(values))
+        else:
+            positions = self.vocabularies_[col].get_indexer(values)
+            positions[np.asarray(values == "Missing", dtype=bool) | pd.isna(values)] = -2
+
+        # impute missing values by sampling from the category distributions seen in fit
+        missing = np.flatnonzero(positions == -2)
+        if len(missing) > 0:
+            sampled = np.searchsorted(self.impute_cdfs_[col], self.rng_.random(len(missing)), side='right')
+            positions[missing] = self.impute_positions_[col][sampled]
+
+        return positions
+
+    @profiled
+    def transform(self, X, y=None):
+        if isinstance(X, dict):
+            X = [X]
+        if isinstance(X, pd.DataFrame):
+            n = len(X)
+            columns = {col: X[col] if n > 64 else X[col].to_numpy() for col in self.features_}
+        else:
+            n = len(X)
+            columns = {col: np.array([record.get(col) for record in X], dtype='object') for col in self.features_}
+
+        # column-major, so that each variable's values are written to contiguous memory
+        # for sparse output, the output column and value of each variable are collected instead (see rows_to_csr)
+        if self.sparse_output:
+            sparse_vars = {col: j for j, col in enumerate(self.categorical_vars_ + list(self.continuous_outputs_) + [f"log_{col}" for col in self.log_outputs_])}
+            output_columns = np.full((n, len(sparse_vars)), -1, dtype=np.int32)
+            output_values = np.ones((n, len(sparse_vars)))
+        else:
+            out = np.zeros((n, len(self.feature_names_out_)), order='F')
+            out_flat = out.ravel(order='F')
+        rows = np.arange(n)
+
+        positions = {}
+        for col in self.categorical_vars_:
+            positions[col] = self.category_positions(col, columns[col])
+            if self.encoding == "one_hot":
+                if self.sparse_output:
+                    output_columns[:, sparse_vars[col]] = self.category_outputs_[col][positions[col]]
+                else:
+                    category_columns = self.category_outputs_[col][positions[col]]
+                    encoded = category_columns >= 0
+                    out_flat[category_columns[encoded] * n + rows[encoded]] = 1.0
+            else:
+                out[:, self.categorical_columns_[col]] = self.category_outputs_[col][positions[col]]
+
+        for col in self.continuous_vars_:
+            values = np.asarray(columns[col], dtype='float')
+            if col in self.median_plans_:
+                key_col, medians = self.median_plans_[col]
+                missing = np.isnan(values)
+                if missing.any():
+                    values = values.copy()
+                    values[missing] = medians[positions[key_col][missing]] if key_col is not None else medians[0]
+            if col == 'engine_capacity_cc' and self.engine_capacity_bike_ is not None:
+                bike_position, engine_capacity_bike = self.engine_capacity_bike_
+                if bike_position is None:
+                    is_bike = np.asarray(columns['vehicle_type'] == "Pedal cycle", dtype=bool)
+                else:
+                    is_bike = positions['vehicle_type'] == bike_position
+                values = np.where(is_bike, engine_capacity_bike, values)
+            if col in self.scaling_:
+                scale, min_value = self.scaling_[col]
+                values = values * scale + min_value
+            if col in self.continuous_outputs_:
+                if self.sparse_output:
+                    output_columns[:, sparse_vars[col]] = self.continuous_outputs_[col]
+                    output_values[:, sparse_vars[col]] = values
+                else:
+                    out[:, self.continuous_outputs_[col]] = values
+            if col in self.log_outputs_:
+                if self.sparse_output:
+                    output_columns[:, sparse_vars[f"log_{col}"]] = self.log_outputs_[col]
+                    output_values[:, sparse_vars[f"log_{col}"]] = np.log(values + 0.0000001)
+                else:
+                    out[:, self.log_outputs_[col]] = np.log(values + 0.0000001)
+
+        if self.sparse_output:
+            return rows_to_csr(output_columns, output_values, len(self.feature_names_out_))
+
+        return out
+
+    def get_feature_names_out(self, input_features=None):
+        return self.feature_names_out_
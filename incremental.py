@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler, TargetEncoder
+
+from functions import as_categorical, map_categories, vehicle_type_2_rules, vars_to_groupby
+
+# incremental version of impute_fit_df/impute_fit_df_TE, for refitting the preprocessing as new batches of STATS19 data arrive
+# rather than the fitted values themselves, mergeable summaries of the data are kept, and each new batch is added to them:
+# - category counts (-> categorical_freqs)
+# - minimum and maximum of each continuous variable (-> scaler)
+# - counts of each target class for each category (-> the target encoder's encodings)
+# - quantile sketches of each continuous variable, overall and by the groups of vars_to_groupby (-> continuous_medians, continuous_medians_grouped)
+# so refitting costs as much as the new batch rather than the whole history
+# the fitted values are the same as fitting on every batch at once, except medians of variables with more than max_centroids distinct values,
+# which are estimated
+# usage: imputer = IncrementalImputer(target_encode=True); imputer.partial_fit(X_2023, y_2023); imputer.partial_fit(X_2024, y_2024)
+#        categorical_freqs, vars_to_groupby, continuous_medians_grouped, continuous_medians, scaler, encoder = imputer.fitted_values()
+# or CustomPreprocessor(encoding="target").partial_fit(X, y), which uses this
+
+class QuantileSketch:
+    # mergeable summary of a distribution for estimating its quantiles, like a t-digest: sorted centroids (mean, count)
+    # every distinct value is its own centroid until there are more than max_centroids, so quantiles of variables with few distinct values
+    # (e.g. ages) are exact; beyond that neighbouring centroids are merged, keeping the centroids in the tails smaller than in the middle
+    def __init__(self, max_centroids=5000):
+        self.max_centroids = max_centroids
+        self.means = np.array([])
+        self.counts = np.array([], dtype='int64')
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float')
+        means, counts = np.unique(values[~np.isnan(values)], return_counts=True)
+        return self.merge_centroids(means, counts)
+
+    def merge(self, other):
+        return self.merge_centroids(other.means, other.counts)
+
+    def merge_centroids(self, means, counts):
+        means, inverse = np.unique(np.concatenate([self.means, means]), return_inverse=True)
+        self.means = means
+        self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]), minlength=len(means)).astype('int64')
+        if len(self.means) > self.max_centroids:
+            self.compress()
+        return self
+
+    def compress(self):
+        # centroids are merged in buckets of equal width on the t-digest k1 scale, k = asin(2q - 1) for quantile q,
+        # which are narrowest in the tails, giving max_centroids / 2 centroids
+        cumulative = np.cumsum(self.counts)
+        q = (cumulative - self.counts / 2) / cumulative[-1]
+        buckets = np.floor((np.arcsin(2 * q - 1) / np.pi + 0.5) * (self.max_centroids // 2)).astype('int64')
+        # buckets are in order, so each bucket is a run of neighbouring centroids
+        _, buckets = np.unique(buckets, return_inverse=True)
+        counts = np.bincount(buckets, weights=self.counts)
+        self.means = np.bincount(buckets, weights=self.means * self.counts) / counts
+        self.counts = counts.astype('int64')
+
+    def quantile(self, q):
+        # interpolated between the values either side, like pandas' quantile, so quantile(0.5) is the median
+        n = self.counts.sum()
+        if n == 0:
+            return np.nan
+        cumulative = np.cumsum(self.counts)
+        position = (n - 1) * q
+        lower, upper = self.means[np.searchsorted(cumulative, [np.floor(position), np.ceil(position)], side='right')]
+        return lower + (upper - lower) * (position - np.floor(position))
+
+def add_counts(counts, new_counts):
+    if counts is None:
+        return new_counts
+    return counts.add(new_counts, fill_value=0).fillna(0).astype('int64')
+
+class IncrementalImputer:
+    # target_encode=True fits the target encoder as impute_fit_df_TE, and needs y - otherwise fits as impute_fit_df
+    # every batch needs the same columns
+    def __init__(self, target_encode=False, max_centroids=5000):
+        self.target_encode = target_encode
+        self.max_centroids = max_centroids
+        self.columns = None
+        self.n_rows = 0
+
+    def partial_fit(self, X, y=None):
+        if self.target_encode and y is None:
+            raise ValueError("y is needed for target encoding")
+        df = as_categorical(X).reset_index(drop=True)
+
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.categorical_vars = list(df.select_dtypes(include='category').columns)
+            # impute_fit_df_TE's X includes y (fatality), which isn't scaled
+            not_scaled = ['longitude', 'latitude', 'fatality'] if self.target_encode else ['longitude', 'latitude']
+            self.continuous_vars = [col for col in self.columns if col not in self.categorical_vars and col not in not_scaled]
+            # as in impute_fit_df, every continuous variable has an overall median, and those in vars_to_groupby a median by group
+            self.median_vars = [col for col in vars_to_groupby if col in self.columns] + \
+                [col for col in self.columns if col not in self.categorical_vars and col not in vars_to_groupby and col != 'fatality']
+            self.encoded_vars = [col for col in self.categorical_vars if col not in ['date', 'time', 'fatality']]
+            self.categories = {col: pd.Index(df[col].cat.categories) for col in self.categorical_vars}
+            self.category_counts = {}
+            self.sketches = {}
+            self.grouped_sketches = {}
+            self.minimums = pd.Series(np.nan, index=self.continuous_vars)
+            self.maximums = pd.Series(np.nan, index=self.continuous_vars)
+            self.n_bikes = 0
+            self.target_counts = {}
+            self.class_counts = None
+        elif list(df.columns) != self.columns:
+            raise ValueError(f"Columns differ from the first batch: {sorted(set(df.columns) ^ set(self.columns))}")
+        self.n_rows += len(df)
+
+        # category counts
+        for col in self.categorical_vars:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+            self.categories[col] = self.categories[col].append(df[col].cat.categories.difference(self.categories[col]))
+            counts = df[col].value_counts()
+            self.category_counts[col] = add_counts(self.category_counts.get(col), counts[counts > 0])
+
+        # quantile sketches, with the groups of vars_to_groupby
+        if "vehicle_type" in df.columns:
+            df["vehicle_type_2"] = map_categories(df["vehicle_type"], vehicle_type_2_rules)
+        for col in self.median_vars:
+            values = df[col].to_numpy(dtype='float')
+            self.sketches.setdefault(col, QuantileSketch(self.max_centroids)).update(values)
+            group_col = vars_to_groupby.get(col)
+            if group_col in df.columns:
+                group = df[group_col].astype('category')
+                codes = group.cat.codes.to_numpy()
+                grouped_sketches = self.grouped_sketches.setdefault(col, {})
+                for code, category in enumerate(group.cat.categories):
+                    rows = codes == code
+                    if rows.any():
+                        grouped_sketches.setdefault(category, QuantileSketch(self.max_centroids)).update(values[rows])
+
+        # minimum and maximum, leaving out the engine_capacity_cc of bikes, which is only known once the car median is (see fitted_values)
+        continuous = df[self.continuous_vars]
+        if 'engine_capacity_cc' in self.continuous_vars and 'vehicle_type' in df.columns:
+            bikes = (df["vehicle_type"] == "Pedal cycle").to_numpy()
+            self.n_bikes += bikes.sum()
+            continuous = continuous.assign(engine_capacity_cc=np.where(bikes, np.nan, df['engine_capacity_cc']))
+        self.minimums = np.fmin(self.minimums, continuous.min().astype('float'))
+        self.maximums = np.fmax(self.maximums, continuous.max().astype('float'))
+
+        # counts of each target class for each category, including missing values
+        if self.target_encode:
+            classes, y_codes = np.unique(np.asarray(y), return_inverse=True)
+            self.class_counts = add_counts(self.class_counts, pd.Series(np.bincount(y_codes, minlength=len(classes)), index=classes))
+            for col in self.encoded_vars:
+                # counted by (category code, class code), with missing values (code -1) counted as the last category
+                categories = df[col].cat.categories
+                codes = df[col].cat.codes.to_numpy().astype('int64')
+                codes[codes < 0] = len(categories)
+                counts = np.bincount(codes * len(classes) + y_codes, minlength=(len(categories) + 1) * len(classes)).reshape(-1, len(classes))
+                counts = pd.DataFrame(counts, index=pd.Index(list(categories) + [np.nan], dtype='object'), columns=classes)
+                self.target_counts[col] = add_counts(self.target_counts.get(col), counts[counts.sum(axis=1) > 0])
+
+        return self
+
+    def fitted_values(self):
+        # the same values as impute_fit_df(X) (or impute_fit_df_TE(X, y)) for X (and y) the concatenation of every batch
+        if self.columns is None:
+            raise RuntimeError("partial_fit hasn't been called")
+
+        # value_counts(normalize=True) order: most frequent first
+        categorical_freqs = {}
+        for col, counts in self.category_counts.items():
+            freqs = counts / counts.sum() if counts.sum() > 0 else counts.astype('float')
+            categorical_freqs[col] = freqs.sort_values(ascending=False, kind='stable').to_dict()
+
+        continuous_medians_grouped = {}
+        continuous_medians = {}
+        for col, sketch in self.sketches.items():
+            continuous_medians[col] = sketch.quantile(0.5)
+            if col in self.grouped_sketches:
+                groups = self.grouped_sketches[col]
+                continuous_medians_grouped[col] = pd.Series([groups[group].quantile(0.5) for group in groups], index=pd.Index(list(groups), name=vars_to_groupby[col]), name=col).sort_index()
+            else:
+                continuous_medians_grouped[col] = None
+
+        scaler = self.scaler(continuous_medians_grouped, continuous_medians)
+        if not self.target_encode:
+            return categorical_freqs, vars_to_groupby, continuous_medians_grouped, continuous_medians, scaler
+
+        return categorical_freqs, vars_to_groupby, continuous_medians_grouped, continuous_medians, scaler, self.target_encoder()
+
+    def scaler(self, continuous_medians_grouped, continuous_medians):
+        if len(self.continuous_vars) == 0:
+            return None
+
+        minimums = self.minimums.copy()
+        maximums = self.maximums.copy()
+        if self.n_bikes > 0:
+            # see impute_fit_df
+            try:
+                engine_capacity_car = continuous_medians_grouped["engine_capacity_cc"].loc["Car"]
+            except (KeyError, AttributeError):
+                engine_capacity_car = continuous_medians["engine_capacity_cc"]
+            minimums['engine_capacity_cc'] = np.fmin(minimums['engine_capacity_cc'], 0.00065 * engine_capacity_car)
+            maximums['engine_capacity_cc'] = np.fmax(maximums['engine_capacity_cc'], 0.00065 * engine_capacity_car)
+
+        # fitted on just the minimums and maximums, which gives the same scaler as fitting on every row
+        scaler = MinMaxScaler()
+        scaler.fit(pd.DataFrame([minimums, maximums], columns=self.continuous_vars))
+        scaler.n_samples_seen_ = self.n_rows
+        return scaler
+
+    def target_encoder(self):
+        # TargetEncoder(smooth='auto') encodes each category as its mean target, shrunk towards the overall mean by
+        # lambda = var(y) * n / (var(y) * n + within-category sum of squared deviations / n), which for a binary target only needs
+        # the number of rows and positives in each category
+        classes = np.sort(self.class_counts.index.to_numpy())
+        positive = classes[1] if len(classes) > 1 else None
+        target_mean = self.class_counts.get(positive, 0) / self.class_counts.sum()
+        target_variance = target_mean * (1 - target_mean)
+
+        # categories_, feature_names_in_ etc. are set by fitting on one row per category, then the encodings are replaced
+        category_values = {}
+        for col in self.encoded_vars:
+            counts = self.target_counts[col]
+            observed = counts.index[~counts.index.isna()]
+            category_values[col] = list(np.unique(observed.to_numpy())) + ([np.nan] if counts.index.isna().any() else [])
+        n_template = max(1, max(len(values) for values in category_values.values()))
+        template = pd.DataFrame({col: values + values[:1] * (n_template - len(values)) for col, values in category_values.items()})
+        encoder = TargetEncoder(categories='auto', target_type='binary', smooth='auto', cv=5, random_state=42)
+        encoder.fit(template, np.resize(classes, n_template))
+
+        encodings = []
+        for col, categories in zip(self.encoded_vars, encoder.categories_):
+            counts = self.target_counts[col].reindex(pd.Index(categories, dtype='object')).fillna(0)
+            n = counts.sum(axis=1).to_numpy(dtype='float')
+            n_positive = counts[positive].to_numpy(dtype='float') if positive in counts.columns else np.zeros(len(n))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = n_positive / n
+                squared_deviations = n_positive - n_positive**2 / n
+                shrinkage = target_variance * n / (target_variance * n + squared_deviations / n)
+                encodings.append(np.where(np.isnan(shrinkage), target_mean, shrinkage * means + (1 - shrinkage) * target_mean))
+
+        encoder.classes_ = classes
+        encoder.target_mean_ = target_mean
+        encoder.encodings_ = encodings
+        return encoder
+
+    def template(self):
+        # an empty DataFrame with every column and category seen, for CustomPreprocessor.compile_plan
+        return pd.DataFrame({col: pd.Categorical([], categories=self.categories[col]) if col in self.categorical_vars else pd.Series([], dtype='float')
+                             for col in self.columns})
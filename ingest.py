@@ -0,0 +1,160 @@
+import argparse
+import glob
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# ingest of the DfT road safety csvs (accidents, vehicles and casualties for each year) into a parquet dataset of the collisions involving a bike,
+# with the same rows and labels as the extract written by get_raw_data.r, partitioned by year (path_to_dataset/year=2022/part-0.parquet)
+# read_raw_data/transform_raw_data accept the dataset in place of the csv, and only read the years and columns they need
+# each year is written separately, so adding a year doesn't reprocess the others
+# usage: python ingest.py raw_data stats19_dataset --schema stats19_schema.csv --years 2019 2020 2021 2022
+
+# columns that are numbers in the DfT csvs, and their types - every other column is a code (mapped to its label) or an identifier, read as a string
+# -1 is the DfT code for a missing number, so is read as a missing value
+numeric_schema = {
+    'accident_year': 'Int16',
+    'location_easting_osgr': 'float64',
+    'location_northing_osgr': 'float64',
+    'longitude': 'float64',
+    'latitude': 'float64',
+    'number_of_vehicles': 'Int16',
+    'number_of_casualties': 'Int16',
+    'speed_limit': 'Int16',
+    'vehicle_reference': 'Int16',
+    'casualty_reference': 'Int16',
+    'age_of_driver': 'float64',
+    'engine_capacity_cc': 'float64',
+    'age_of_vehicle': 'float64',
+    'age_of_casualty': 'float64'
+}
+# identifiers, which are kept as they are rather than looked up
+id_vars = ['accident_index', 'accident_reference']
+
+def format_column_names(names):
+    # as format_column_names in the stats19 R package, e.g. "1st_road_class" -> "first_road_class"
+    # the DfT csvs from 2024 on use collision_ in place of accident_ (e.g. collision_index), which is mapped back to accident_
+    formatted = []
+    for name in names:
+        name = name.lower().replace(" ", "_").replace("(", "").replace(")", "").replace("1st", "first").replace("2nd", "second").replace("-", "_").replace("?", "")
+        formatted.append(re.sub("^collision_", "accident_", name))
+    return formatted
+
+def read_lookups(path_to_schema):
+    # code -> label lookup for each variable, from a csv with variable, code and label columns
+    # e.g. exported from R with write.csv(stats19::stats19_schema, "stats19_schema.csv", row.names = FALSE)
+    schema = pd.read_csv(path_to_schema, dtype=str)
+    return {variable: dict(zip(lookup['code'], lookup['label'])) for variable, lookup in schema.groupby('variable')}
+
+def label_codes(values, lookup):
+    # replaces each code in a categorical column with its label, keeping codes that have no label (as format_stats19 in get_raw_data.r)
+    # the lookup is done once per distinct code, then applied to every row by its category code
+    labels = np.array([lookup.get(code, code) for code in values.cat.categories], dtype='object')
+    label_codes, label_categories = pd.factorize(labels, sort=True)
+
+    # missing values have code -1, which picks out the appended -1
+    return pd.Categorical.from_codes(np.append(label_codes, -1)[values.cat.codes.to_numpy()], categories=label_categories)
+
+def read_dft_csv(path_to_csv, lookups):
+    # reads one of the DfT csvs with an explicit type for every column: numeric_schema for numbers, strings for identifiers,
+    # and categoricals of labels for everything else
+    raw_names = pd.read_csv(path_to_csv, nrows=0).columns
+    names = format_column_names(raw_names)
+    dtype = {raw_name: numeric_schema.get(name, 'str' if name in id_vars else 'category') for raw_name, name in zip(raw_names, names)}
+    df = pd.read_csv(path_to_csv, dtype=dtype)
+    df.columns = names
+
+    for col in df.columns:
+        if col in numeric_schema and col not in ['longitude', 'latitude', 'location_easting_osgr', 'location_northing_osgr']:
+            df[col] = df[col].mask(df[col] == -1)
+        elif col in lookups and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = label_codes(df[col], lookups[col])
+
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'].astype('str'), format="%d/%m/%Y")
+
+    return df
+
+def join_tables(accidents, vehicles, casualties):
+    # the rows of get_raw_data.r's extract: every vehicle of every collision involving a bike, with one row for each of the vehicle's casualties
+    # (or one row with no casualty), with each collision's rows together
+    # columns in more than one table (e.g. accident_year) are taken from the accidents table
+    vehicles = vehicles.drop(columns=[col for col in vehicles.columns if col in accidents.columns and col != 'accident_index'])
+    casualties = casualties.drop(columns=[col for col in casualties.columns if (col in accidents.columns or col in vehicles.columns)
+                                          and col not in ['accident_index', 'vehicle_reference']])
+
+    # collisions without a bike are dropped before the joins rather than after
+    involving_cyclist = vehicles.loc[vehicles['vehicle_type'] == 'Pedal cycle', 'accident_index'].unique()
+    accidents = accidents[accidents['accident_index'].isin(involving_cyclist)]
+    vehicles = vehicles[vehicles['accident_index'].isin(involving_cyclist)]
+    casualties = casualties[casualties['accident_index'].isin(involving_cyclist)]
+
+    df = pd.merge(accidents, vehicles, how="inner", on="accident_index")
+    df = pd.merge(df, casualties, how="left", on=["accident_index", "vehicle_reference"])
+
+    return df.sort_values(['accident_index', 'vehicle_reference', 'casualty_reference'], kind='stable').reset_index(drop=True)
+
+def write_partition(df, path_to_dataset, year):
+    # written to a temporary directory first, then swapped in, so that an interrupted write never leaves a partial year
+    path = os.path.join(path_to_dataset, f"year={year}")
+    os.makedirs(path + ".tmp", exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(path + ".tmp", "part-0.parquet"))
+
+    if os.path.exists(path):
+        os.rename(path, path + ".old")
+    os.rename(path + ".tmp", path)
+    shutil.rmtree(path + ".old", ignore_errors=True)
+
+def ingest_year(year, path_to_accidents, path_to_vehicles, path_to_casualties, path_to_dataset, lookups):
+    # returns the number of rows written
+    df = join_tables(read_dft_csv(path_to_accidents, lookups), read_dft_csv(path_to_vehicles, lookups), read_dft_csv(path_to_casualties, lookups))
+    write_partition(df, path_to_dataset, year)
+
+    return len(df)
+
+def find_dft_csvs(raw_dir):
+    # {year: {"accidents": path, "vehicles": path, "casualties": path}} for the DfT csvs in raw_dir,
+    # named e.g. dft-road-casualty-statistics-accident-2022.csv (or -collision- from 2024 on)
+    table_names = {'accident': 'accidents', 'collision': 'accidents', 'vehicle': 'vehicles', 'casualty': 'casualties'}
+    csvs = {}
+    for path in glob.glob(os.path.join(raw_dir, "dft-road-casualty-statistics-*.csv")):
+        match = re.fullmatch(r"dft-road-casualty-statistics-(accident|collision|vehicle|casualty)-(\d{4})\.csv", os.path.basename(path))
+        if match is not None:
+            csvs.setdefault(int(match.group(2)), {})[table_names[match.group(1)]] = path
+
+    return csvs
+
+def ingest(raw_dir, path_to_dataset, path_to_schema, years=None, overwrite=False):
+    # ingests each year (default: every year with all 3 csvs in raw_dir) that isn't already in the dataset, or every year if overwrite=True
+    lookups = read_lookups(path_to_schema)
+    csvs = find_dft_csvs(raw_dir)
+    years = sorted(year for year, tables in csvs.items() if len(tables) == 3) if years is None else years
+
+    for year in years:
+        if year not in csvs or len(csvs[year]) < 3:
+            raise ValueError(f"Missing DfT csvs for {year} in {raw_dir}: found {sorted(csvs.get(year, {}))}")
+        if os.path.exists(os.path.join(path_to_dataset, f"year={year}")) and not overwrite:
+            print(f"Skipping {year}, already ingested")
+            continue
+
+        n_rows = ingest_year(year, csvs[year]['accidents'], csvs[year]['vehicles'], csvs[year]['casualties'], path_to_dataset, lookups)
+        print(f"Ingested {year}: {n_rows} rows")
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest the DfT road safety csvs into a year-partitioned parquet dataset of collisions involving a bike")
+    parser.add_argument("raw_dir", help="directory of dft-road-casualty-statistics-<table>-<year>.csv files")
+    parser.add_argument("path_to_dataset")
+    parser.add_argument("--schema", required=True, help="csv of variable, code, label, e.g. stats19::stats19_schema")
+    parser.add_argument("--years", type=int, nargs="+", default=None, help="default: every year in raw_dir")
+    parser.add_argument("--overwrite", action="store_true", help="reingest years that are already in the dataset")
+    args = parser.parse_args()
+
+    ingest(args.raw_dir, args.path_to_dataset, args.schema, years=args.years, overwrite=args.overwrite)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import atexit
+import functools
+import json
+import multiprocessing.util
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+# per-stage timing of the preprocessing pipeline: wall time, cpu time, peak memory, and rows/columns in and out of each stage
+# the functions in functions.py (and CustomPreprocessor.fit/transform) are stages, and a function can mark parts of itself as stages with
+# `with stage("name"):` - stages within stages are recorded with their parents, so the trace shows where the time goes within e.g. impute_transform_df
+# profiling is off unless switched on, and then every stage costs a single check
+# switched on by:
+# - the STATS19_PROFILE environment variable: "1" prints a summary at exit, anything else is a path the trace is written to at exit;
+#   STATS19_PROFILE_MEMORY=1 also records peak memory (with tracemalloc, which slows everything down ~2x)
+#   the stages run in worker processes (score.py, explain.py) are included if the workers call init_worker
+# - the profile context manager: with profile("trace.json"): df = transform_raw_data(...)
+# traces are in the Chrome trace format, so can be viewed in chrome://tracing or https://ui.perfetto.dev, and compared with compare_traces
+# usage: STATS19_PROFILE=trace.json python score.py ... then compare_traces("trace.json", "previous_trace.json")
+
+# whether stages are recorded, and whether their peak memory is
+enabled = False
+memory = False
+# whether tracemalloc was started here, rather than by e.g. benchmark.py
+started_tracemalloc = False
+# recorded stages, as Chrome trace events
+events = []
+start_time = time.perf_counter()
+# stack of open stages, per thread
+local = threading.local()
+# directory that worker processes write their events to, to be merged into the trace at exit (see init_worker)
+worker_dir = None
+
+class NoStage:
+    # stands in for Stage when profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_output(self, output):
+        pass
+
+no_stage = NoStage()
+
+def shape(value):
+    # (rows, columns) of a DataFrame, array or sparse matrix, (rows, None) of a Series or list of records
+    if hasattr(value, "shape"):
+        return (value.shape[0], value.shape[1] if len(value.shape) > 1 else None)
+    if isinstance(value, list):
+        return (len(value), None)
+    if isinstance(value, dict):
+        return (1, None)
+    return None
+
+class Stage:
+    def __init__(self, name, input=None):
+        self.name = name
+        self.input_shape = shape(input) if input is not None else None
+        self.output_shape = None
+        # largest traced memory seen by the stages within this one
+        self.peak = 0
+
+    def __enter__(self):
+        stack = getattr(local, "stack", None)
+        if stack is None:
+            stack = local.stack = []
+        if memory and tracemalloc.is_tracing():
+            # the peak is reset for this stage, so the peak so far is handed to the stage around it first
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start_cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        end_cpu = time.process_time()
+        local.stack.pop()
+
+        args = {"cpu_ms": (end_cpu - self.start_cpu) * 1000}
+        if memory and tracemalloc.is_tracing():
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if len(local.stack) > 0:
+                local.stack[-1].peak = max(local.stack[-1].peak, peak)
+            args["peak_mb"] = (peak - self.start_memory) / 2**20
+        if self.input_shape is not None:
+            args["rows_in"], args["columns_in"] = self.input_shape
+        if self.output_shape is not None:
+            args["rows_out"], args["columns_out"] = self.output_shape
+        if exc_info[0] is not None:
+            args["error"] = exc_info[0].__name__
+
+        events.append({"name": self.name, "ph": "X", "ts": (self.start - start_time) * 1e6, "dur": (end - self.start) * 1e6,
+                       "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+        return False
+
+    def set_output(self, output):
+        # records the rows/columns of the stage's output (the first DataFrame or array, if output is a tuple)
+        if isinstance(output, tuple):
+            output = next((value for value in output if hasattr(value, "shape")), None)
+        self.output_shape = shape(output) if output is not None else None
+
+def stage(name, input=None):
+    # with stage("clean_df.as_categorical", df) as s: ...; s.set_output(df)
+    return Stage(name, input) if enabled else no_stage
+
+def profiled(func):
+    # records each call of func as a stage named after it, with the shapes of its first DataFrame/array argument and of its output
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        input = next((arg for arg in args if hasattr(arg, "shape") or isinstance(arg, (list, dict))), None)
+        with Stage(name, input) as s:
+            output = func(*args, **kwargs)
+            s.set_output(output)
+        return output
+
+    return wrapper
+
+def start(track_memory=False):
+    global enabled, memory, started_tracemalloc
+    enabled = True
+    memory = track_memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracemalloc = True
+
+def stop():
+    global enabled, memory, started_tracemalloc
+    if started_tracemalloc:
+        tracemalloc.stop()
+        started_tracemalloc = False
+    enabled = False
+    memory = False
+
+class Profile:
+    def __init__(self, path=None, track_memory=True):
+        self.path = path
+        self.track_memory = track_memory
+
+    def __enter__(self):
+        # profiling that was already on (e.g. from STATS19_PROFILE) is left on at the end
+        self.was_enabled = (enabled, memory)
+        self.first_event = len(events)
+        start(self.track_memory or memory)
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.was_enabled[0]:
+            stop()
+        elif not self.was_enabled[1] and memory:
+            stop()
+            start(False)
+        self.events = events[self.first_event:]
+        if self.path is not None:
+            write_trace(self.path, self.events)
+        return False
+
+    def summary(self):
+        return summary(self.events)
+
+def profile(path=None, track_memory=True):
+    # records every stage run within it, and writes them to path (if given) as a Chrome trace at the end
+    # the events recorded are in .events, and summarised by .summary()
+    return Profile(path, track_memory)
+
+def write_trace(path, trace_events=None):
+    trace_events = events if trace_events is None else trace_events
+    with open(path + ".tmp", "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    os.replace(path + ".tmp", path)
+
+def load_trace(path):
+    with open(path) as f:
+        return json.load(f)["traceEvents"]
+
+def summary(trace_events=None):
+    # calls, total wall and cpu time, largest peak memory and rows of each stage, slowest first
+    trace_events = events if trace_events is None else trace_events
+    df = pd.DataFrame([{"stage": event["name"], "wall_ms": event["dur"] / 1000, **event["args"]} for event in trace_events if event.get("ph") == "X"])
+    if len(df) == 0:
+        return pd.DataFrame(columns=["calls", "wall_ms", "cpu_ms", "peak_mb", "rows_in", "rows_out"])
+    for col in ["peak_mb", "rows_in", "rows_out"]:
+        if col not in df.columns:
+            df[col] = float("nan")
+
+    return df.groupby("stage").agg(calls=("wall_ms", "size"), wall_ms=("wall_ms", "sum"), cpu_ms=("cpu_ms", "sum"),
+                                   peak_mb=("peak_mb", "max"), rows_in=("rows_in", "max"), rows_out=("rows_out", "max")).sort_values("wall_ms", ascending=False)
+
+def init_worker():
+    # called by the initializer of a process pool's workers, so that the stages run in the worker are in the trace written at exit
+    # pool workers exit without running atexit, so the worker's events are written to a file of their own by a multiprocessing finalizer,
+    # which does run as they exit
+    if enabled and worker_dir is not None:
+        multiprocessing.util.Finalize(None, write_worker_trace, exitpriority=0)
+
+def write_worker_trace():
+    # only this process's events, as a forked worker starts with a copy of its parent's
+    pid = os.getpid()
+    fd, path = tempfile.mkstemp(prefix=f"{pid}-", suffix=".json", dir=worker_dir)
+    os.close(fd)
+    write_trace(path, [event for event in events if event["pid"] == pid])
+
+def merge_worker_traces():
+    # adds the events written by worker processes (see init_worker) to events
+    for name in sorted(os.listdir(worker_dir)):
+        if name.endswith(".json"):
+            events.extend(load_trace(os.path.join(worker_dir, name)))
+    shutil.rmtree(worker_dir, ignore_errors=True)
+
+def finish(path):
+    merge_worker_traces()
+    if path == "1":
+        print(summary().to_string())
+    else:
+        write_trace(path)
+
+def compare_traces(path, previous_path, threshold=1.2):
+    # total wall time of each stage in two traces, with the stages that are more than threshold times slower flagged
+    current = summary(load_trace(path))
+    previous = summary(load_trace(previous_path))
+    df = current[["calls", "wall_ms", "peak_mb"]].join(previous[["calls", "wall_ms", "peak_mb"]], how="outer", rsuffix="_previous")
+    df["ratio"] = df["wall_ms"] / df["wall_ms_previous"]
+    df["slower"] = df["ratio"] > threshold
+
+    return df.sort_values("ratio", ascending=False)
+
+# switched on for the whole run by STATS19_PROFILE
+# the worker directory is passed on to worker processes in STATS19_PROFILE_WORKERS, so a spawned worker, which imports this module again,
+# writes its events there rather than being a profiled run of its own
+if os.environ.get("STATS19_PROFILE", "") not in ["", "0"]:
+    start(os.environ.get("STATS19_PROFILE_MEMORY", "") not in ["", "0"])
+    if "STATS19_PROFILE_WORKERS" in os.environ:
+        worker_dir = os.environ["STATS19_PROFILE_WORKERS"]
+    else:
+        worker_dir = os.environ["STATS19_PROFILE_WORKERS"] = tempfile.mkdtemp(prefix="stats19-profile-")
+        atexit.register(finish, os.environ["STATS19_PROFILE"])
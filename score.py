@@ -0,0 +1,121 @@
+import argparse
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+
+import profiling
+from functions import read_raw_data_by_collision, collision_byte_ranges, read_raw_data_range, expand_collisions, clean_df
+
+# batch scoring of a STATS19-format csv (as written by get_raw_data.r) with a saved pipeline
+# usage: python score.py stats19CycleCollisions.csv pipeline.joblib probabilities.csv --workers 8
+# the csv is split into byte ranges of whole collisions, and each range is read, transformed, cleaned and scored in a worker process,
+# so the parsing of the csv is spread over the workers too - the main process only reads the rows either side of each split
+# probabilities are written in input order, one row per bike casualty, keyed by its accident_index and casualty_reference in the STATS19 data,
+# and the accident_index_2 that transform_raw_data gives it
+
+def save_pipeline(pipeline, features, path):
+    # the pipeline has to be importable outside the notebook that fitted it, e.g. using functions.CustomPreprocessor rather than a class defined in the notebook
+    joblib.dump({"pipeline": pipeline, "features": list(features)}, path)
+
+def load_pipeline(path):
+    saved = joblib.load(path)
+    return saved["pipeline"], saved["features"]
+
+# each worker loads the pipeline once, rather than having it pickled with every chunk
+pipeline = None
+features = None
+
+def init_worker(path_to_pipeline):
+    global pipeline, features
+    pipeline, features = load_pipeline(path_to_pipeline)
+    profiling.init_worker()
+
+def seed_pipeline(pipeline, chunk_number, seed):
+    # missing values are imputed by sampling, so the sampling is seeded per chunk to make the output the same whichever worker scores the chunk
+    for step in getattr(pipeline, "named_steps", {}).values():
+        if hasattr(step, "rng_"):
+            step.rng_ = np.random.default_rng([seed, chunk_number])
+
+def chunks(path_to_csv, chunksize):
+    # what each worker is given: a (path, start, end) byte range of a csv (see functions.collision_byte_ranges), which the worker reads,
+    # or for a parquet dataset written by ingest.py, a chunk of whole collisions read in the main process
+    if os.path.isdir(path_to_csv):
+        return read_raw_data_by_collision(path_to_csv, chunksize=chunksize)
+    return ((path_to_csv, start, end) for start, end in collision_byte_ranges(path_to_csv, chunksize=chunksize))
+
+def read_chunk(chunk):
+    return read_raw_data_range(*chunk) if isinstance(chunk, tuple) else chunk
+
+def score_chunk(chunk, chunk_number, seed):
+    seed_pipeline(pipeline, chunk_number, seed)
+    chunk = read_chunk(chunk)
+
+    df, n_casualties, _ = expand_collisions(chunk, keys=True)
+    keys = casualty_keys(df)
+    df = clean_df(df)
+
+    if len(df) > 0:
+        probabilities = pipeline.predict_proba(df[features])[:, 1]
+    else:
+        probabilities = np.array([])
+
+    return keys, probabilities, n_casualties
+
+def casualty_keys(df):
+    # accident_index, casualty_reference and accident_index_2 of each row of expand_collisions(..., keys=True)
+    # accident_index_2 is numbered from 0 within the chunk, and offset by the number of casualties in the previous chunks once the results are back in order
+    return pd.DataFrame({
+        "accident_index": df['accident_index'].to_numpy(),
+        "casualty_reference": df['casualty_reference'].to_numpy(dtype='int64'),
+        "accident_index_2": df['accident_index_2'].to_numpy()
+    })
+
+def score_csv(path_to_csv, path_to_pipeline, path_to_output, chunksize=100000, n_workers=None, seed=0):
+    # returns the number of rows written
+    # at most 2 chunks per worker are in flight, so memory doesn't depend on the size of the csv
+    n_workers = n_workers or os.cpu_count()
+    pending = collections.deque()
+    casualty_offset = 0
+    n_rows = 0
+
+    with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(path_to_pipeline,)) as executor, \
+            open(path_to_output, "w", newline="") as f:
+        f.write("accident_index,casualty_reference,accident_index_2,probability\n")
+
+        def write_next():
+            nonlocal casualty_offset, n_rows
+            keys, probabilities, n_casualties = pending.popleft().result()
+            keys["accident_index_2"] += casualty_offset
+            keys.assign(probability=probabilities).to_csv(f, header=False, index=False)
+            casualty_offset += n_casualties
+            n_rows += len(probabilities)
+
+        for chunk_number, chunk in enumerate(chunks(path_to_csv, chunksize)):
+            pending.append(executor.submit(score_chunk, chunk, chunk_number, seed))
+            if len(pending) >= 2 * n_workers:
+                write_next()
+
+        while len(pending) > 0:
+            write_next()
+
+    return n_rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a STATS19-format csv with a saved pipeline")
+    parser.add_argument("path_to_csv")
+    parser.add_argument("path_to_pipeline", help="pipeline saved with score.save_pipeline")
+    parser.add_argument("path_to_output")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows of the csv read at a time")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for imputing missing values")
+    args = parser.parse_args()
+
+    n_rows = score_csv(args.path_to_csv, args.path_to_pipeline, args.path_to_output, chunksize=args.chunksize, n_workers=args.workers, seed=args.seed)
+    print(f"Scored {n_rows} casualties")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+from cache import input_hash
+
+# nearest DfT traffic count points to each collision, and the traffic volumes there as a measure of exposure
+# the count points are indexed once in a BallTree (haversine distance), which is saved in the cache directory,
+# so nearest/radius queries for every collision are one vectorised call rather than a scan of every count point for every collision
+# usage: df = add_exposure_features(df, load_count_point_index("dft_traffic_counts_raw_counts.csv"))
+
+# mean radius of the earth, to convert haversine distances (radians) to km
+earth_radius_km = 6371.0088
+# traffic volumes of each count point used as exposure features
+volume_vars = ['pedal_cycles', 'all_motor_vehicles']
+
+def read_count_points(path_to_csv):
+    # location and mean daily volumes of each count point, from the DfT raw counts (hourly counts on each count date, by direction)
+    # or the DfT AADF file (annual average daily flows, which has no count_date)
+    usecols = ['count_point_id', 'year', 'count_date', 'latitude', 'longitude'] + volume_vars
+    df = pd.read_csv(path_to_csv, header=0, usecols=lambda col: col in usecols)
+
+    # volumes are summed over the hours and directions of each day (or year, for AADF), then averaged over the days and years counted
+    keys = ['count_point_id', 'year'] + (['count_date'] if 'count_date' in df.columns else [])
+    # (min_count=1 so that a count point that never counted e.g. bikes has a missing volume rather than 0)
+    daily_volumes = df.groupby(keys)[volume_vars].sum(min_count=1)
+    volumes = daily_volumes.groupby('count_point_id').mean()
+    locations = df.groupby('count_point_id')[['latitude', 'longitude']].first()
+
+    return locations.join(volumes).dropna(subset=['latitude', 'longitude'])
+
+class CountPointIndex:
+    # BallTree of count point locations, queried with latitude/longitude in degrees and returning distances in km
+    def __init__(self, count_points):
+        self.count_points = count_points
+        self.tree = BallTree(np.radians(count_points[['latitude', 'longitude']].to_numpy(dtype='float')), metric='haversine')
+
+    def nearest(self, latitude, longitude, k=1):
+        # distances (km) and positions in count_points of the k nearest count points to each point, both of shape (n, k)
+        # points with a missing location get nan distances and position -1
+        points, located = self.points(latitude, longitude)
+        distances = np.full((len(points), k), np.nan)
+        positions = np.full((len(points), k), -1)
+        if located.any():
+            distances[located], positions[located] = self.tree.query(points[located], k=k)
+        return distances * earth_radius_km, positions
+
+    def within(self, latitude, longitude, radius_km):
+        # distances (km) and positions in count_points of every count point within radius_km of each point, nearest first
+        # returned as lists of arrays, as the number of count points differs between points - points with a missing location get empty arrays
+        points, located = self.points(latitude, longitude)
+        distances = [np.array([])] * len(points)
+        positions = [np.array([], dtype='int')] * len(points)
+        if located.any():
+            located_positions, located_distances = self.tree.query_radius(points[located], r=radius_km / earth_radius_km,
+                                                                          return_distance=True, sort_results=True)
+            for i, p, d in zip(np.flatnonzero(located), located_positions, located_distances):
+                positions[i] = p
+                distances[i] = d * earth_radius_km
+        return distances, positions
+
+    def points(self, latitude, longitude):
+        points = np.radians(np.column_stack([np.asarray(latitude, dtype='float'), np.asarray(longitude, dtype='float')]))
+        return points, ~np.isnan(points).any(axis=1)
+
+def load_count_point_index(path_to_csv, cache_dir=".cache"):
+    # builds the CountPointIndex of the count points in path_to_csv, or loads it from cache_dir if it has already been built for the same file
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, "count_points-" + input_hash(path_to_csv, cache_dir)[:32] + ".joblib")
+    if os.path.exists(path):
+        # touch the entry so that cache.evict treats it as recently used
+        os.utime(path)
+        return joblib.load(path)
+
+    index = CountPointIndex(read_count_points(path_to_csv))
+    # written to a temporary file first so that an interrupted write never leaves a partial entry
+    joblib.dump(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    return index
+
+def exposure_features(latitude, longitude, index, k=1):
+    # for each point: the distance to the nearest count point (km) and the mean daily volumes there
+    # with k > 1 the volumes are averaged over the k nearest count points, weighted by inverse distance
+    distances, positions = index.nearest(latitude, longitude, k=k)
+    located = positions[:, 0] >= 0
+
+    features = pd.DataFrame({'count_point_distance_km': distances[:, 0]})
+    weights = 1 / np.maximum(distances[located], 0.01)
+    for var in volume_vars:
+        values = np.full(len(positions), np.nan)
+        volumes = index.count_points[var].to_numpy(dtype='float')[positions[located]]
+        # count points without a volume are left out of the average
+        counted = ~np.isnan(volumes)
+        with np.errstate(invalid='ignore'):
+            values[located] = (np.where(counted, volumes, 0) * weights).sum(axis=1) / (counted * weights).sum(axis=1)
+        features['count_point_' + var] = values
+
+    return features
+
+def add_exposure_features(df, index, k=1):
+    # adds exposure_features to df (e.g. the output of transform_raw_data), from its latitude and longitude columns
+    # the features are numbers, so clean_df and the imputation treat them as continuous variables - they're missing for collisions without a location,
+    # and the volumes for count points that never counted that kind of vehicle, which impute_transform_df fills with the overall median seen in fit
+    features = exposure_features(df['latitude'], df['longitude'], index, k=k)
+    df = df.copy(deep=False)
+    for col in features.columns:
+        df[col] = features[col].to_numpy()
+
+    return df
@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from scipy import sparse
+
+# memory mapped store of the preprocessed cross-validation folds of a search (see experiment.preprocess_folds), shared by its worker processes
+# the preprocessing steps are fitted on the train part of each fold, so each fold has its own numerically encoded matrix, which is written once
+# as row-major .npy files with the fold's train rows followed by its test rows (and the fold's train/test indices into the original X)
+# workers are passed a StoredFold (the fold's directory) rather than the arrays, and open the files read-only with np.load(mmap_mode='r'),
+# so X_train and X_test are views of the same memory map, every worker reads the same pages of the page cache, and nothing is pickled or copied
+# sparse matrices (e.g. CustomPreprocessor(sparse_output=True)) are stored as their CSR data/indices/indptr arrays, which are memory mapped the same way
+# usage: fold = write_fold("folds/fold-0", X_train, y_train, X_test, y_test, train_index, test_index); X_train, y_train, X_test, y_test = fold.load()
+
+# folds already opened in this process, so that a worker fitting many candidates on a fold opens its files once
+opened = {}
+
+def write_array(path, array):
+    # written through a memory map rather than np.save, so that e.g. a column-major array is converted to row-major a block at a time
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+    out[:] = array
+    out.flush()
+    del out
+
+def write_matrix(path, name, X_train, X_test):
+    # X_train and X_test stacked into one matrix, as name.npy or, if sparse, name_data.npy, name_indices.npy and name_indptr.npy
+    # returns the matrix's metadata
+    if sparse.issparse(X_train):
+        X_train = sparse.csr_matrix(X_train)
+        X_test = sparse.csr_matrix(X_test)
+        X_train.sort_indices()
+        X_test.sort_indices()
+        write_array(os.path.join(path, name + "_data.npy"), np.concatenate([X_train.data, X_test.data]))
+        write_array(os.path.join(path, name + "_indices.npy"), np.concatenate([X_train.indices, X_test.indices]))
+        write_array(os.path.join(path, name + "_indptr.npy"), np.concatenate([X_train.indptr, X_test.indptr[1:] + X_train.indptr[-1]]))
+        return {"sparse": True, "n_columns": X_train.shape[1]}
+
+    X_train = np.asarray(X_train)
+    X_test = np.asarray(X_test)
+    out = np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=np.result_type(X_train, X_test),
+                                    shape=(X_train.shape[0] + X_test.shape[0],) + X_train.shape[1:])
+    out[:X_train.shape[0]] = X_train
+    out[X_train.shape[0]:] = X_test
+    out.flush()
+    del out
+    return {"sparse": False}
+
+def write_fold(path, X_train, y_train, X_test, y_test, train_index=None, test_index=None):
+    # writes a fold to the directory path and returns its StoredFold
+    # written to a temporary directory first, then renamed, so that an interrupted write never leaves a partial fold
+    shutil.rmtree(path + ".tmp", ignore_errors=True)
+    os.makedirs(path + ".tmp")
+    meta = write_matrix(path + ".tmp", "X", X_train, X_test)
+    meta["n_train"] = X_train.shape[0]
+    write_array(os.path.join(path + ".tmp", "y.npy"), np.concatenate([np.asarray(y_train), np.asarray(y_test)]))
+    if train_index is not None:
+        write_array(os.path.join(path + ".tmp", "train_index.npy"), np.asarray(train_index))
+        write_array(os.path.join(path + ".tmp", "test_index.npy"), np.asarray(test_index))
+    with open(os.path.join(path + ".tmp", "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(path + ".tmp", path)
+    opened.pop(path, None)
+
+    return StoredFold(path)
+
+def split_rows(X, n_train, meta):
+    # (X_train, X_test) as views of X's rows
+    if not meta["sparse"]:
+        return X[:n_train], X[n_train:]
+
+    data, indices, indptr = X
+    n_columns = meta["n_columns"]
+    # the test part's indptr is rebased to start at 0, which copies just the indptr
+    train_end = indptr[n_train]
+    X_train = sparse.csr_matrix((data[:train_end], indices[:train_end], indptr[:n_train + 1]), shape=(n_train, n_columns), copy=False)
+    X_test = sparse.csr_matrix((data[train_end:], indices[train_end:], indptr[n_train:] - train_end), shape=(len(indptr) - 1 - n_train, n_columns), copy=False)
+    return X_train, X_test
+
+class StoredFold:
+    # a fold written by write_fold - only its path is pickled, so it can be passed to worker processes for free
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        # (X_train, y_train, X_test, y_test), read-only and memory mapped
+        if self.path not in opened:
+            with open(os.path.join(self.path, "meta.json")) as f:
+                meta = json.load(f)
+            if meta["sparse"]:
+                X = tuple(np.load(os.path.join(self.path, f"X_{part}.npy"), mmap_mode='r') for part in ["data", "indices", "indptr"])
+            else:
+                X = np.load(os.path.join(self.path, "X.npy"), mmap_mode='r')
+            y = np.load(os.path.join(self.path, "y.npy"), mmap_mode='r')
+            n_train = meta["n_train"]
+            X_train, X_test = split_rows(X, n_train, meta)
+            opened[self.path] = (X_train, y[:n_train], X_test, y[n_train:])
+
+        return opened[self.path]
+
+    def indices(self):
+        # (train_index, test_index) of the fold's rows in the X it was split from
+        return (np.load(os.path.join(self.path, "train_index.npy"), mmap_mode='r'),
+                np.load(os.path.join(self.path, "test_index.npy"), mmap_mode='r'))
+
+    def __repr__(self):
+        return f"StoredFold({self.path!r})"
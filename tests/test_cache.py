@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import functions
+from benchmark import write_synthetic_csv
+from cache import cache_key, load_df, evictable, evict
+
+def write_entry(cache_dir, name, n_bytes, mtime):
+    path = os.path.join(cache_dir, name)
+    if name.startswith("folds-"):
+        os.makedirs(path)
+        with open(os.path.join(path, "X_train.npy"), "wb") as f:
+            f.write(b"x" * n_bytes)
+    else:
+        with open(path, "wb") as f:
+            f.write(b"x" * n_bytes)
+    os.utime(path, (mtime, mtime))
+
+    return path
+
+def test_invalidated_by_input(tmp_path):
+    path_to_csv = str(tmp_path / "extract.csv")
+    cache_dir = str(tmp_path / "cache")
+    write_synthetic_csv(path_to_csv, 500)
+    df = load_df(path_to_csv, cache_dir)
+    key = cache_key(path_to_csv, cache_dir)
+    assert os.path.exists(os.path.join(cache_dir, key + ".arrow"))
+
+    write_synthetic_csv(path_to_csv, 600)
+    assert cache_key(path_to_csv, cache_dir) != key
+    assert len(load_df(path_to_csv, cache_dir)) > len(df)
+
+def test_invalidated_by_functions_source(tmp_path, monkeypatch):
+    path_to_csv = str(tmp_path / "extract.csv")
+    cache_dir = str(tmp_path / "cache")
+    write_synthetic_csv(path_to_csv, 500)
+    os.makedirs(cache_dir)
+    path_to_functions = str(tmp_path / "functions.py")
+    shutil.copy(functions.__file__, path_to_functions)
+    monkeypatch.setattr(functions, "__file__", path_to_functions)
+    key = cache_key(path_to_csv, cache_dir)
+    assert cache_key(path_to_csv, cache_dir) == key
+
+    with open(path_to_functions, "a") as f:
+        f.write("\n# changed\n")
+    assert cache_key(path_to_csv, cache_dir) != key
+
+def test_evict_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path)
+    oldest = write_entry(cache_dir, "a.arrow", 100, 1000)
+    old = write_entry(cache_dir, "folds-b", 100, 2000)
+    new = write_entry(cache_dir, "count_points-c", 100, 3000)
+    newest = write_entry(cache_dir, "explain-d", 100, 4000)
+
+    # within the bound, nothing is deleted
+    evict(cache_dir, 400)
+    assert all(os.path.exists(path) for path in [oldest, old, new, newest])
+
+    # touching an entry makes it the most recently used
+    os.utime(oldest, (5000, 5000))
+    evict(cache_dir, 250)
+    assert os.path.exists(oldest) and os.path.exists(newest)
+    assert not os.path.exists(old) and not os.path.exists(new)
+
+def test_evict_leaves_other_entries(tmp_path):
+    cache_dir = str(tmp_path)
+    assert not evictable("weather.sqlite")
+    assert not evictable("input_hashes.json")
+    assert not evictable("folds-b.tmp")
+    weather = write_entry(cache_dir, "weather.sqlite", 1000, 1000)
+    hashes = write_entry(cache_dir, "input_hashes.json", 1000, 1000)
+    writing = write_entry(cache_dir, "folds-b.tmp", 1000, 1000)
+    in_use = write_entry(cache_dir, "folds-c", 100, 1000)
+    entry = write_entry(cache_dir, "d.arrow", 100, 2000)
+
+    # the folds in keep are counted, but not deleted
+    evict(cache_dir, 0, keep=[in_use])
+    assert all(os.path.exists(path) for path in [weather, hashes, writing, in_use])
+    assert not os.path.exists(entry)
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from xgboost import XGBClassifier
+
+from benchmark import write_synthetic_csv, benchmark_features
+from experiment import CachedSearchCV, fit_candidate
+from functions import transform_raw_data, clean_df, CustomPreprocessor
+
+def test_early_stopping_uses_train_part():
+    rng = np.random.default_rng(0)
+    X_train = rng.random((400, 5))
+    y_train = (X_train[:, 0] + 0.3 * rng.random(400) > 0.6).astype(int)
+    X_test = rng.random((100, 5))
+    # fewer labels than rows, which XGBoost refuses to evaluate on, so the fit fails if the test part is used for early stopping
+    y_test = np.zeros(50, dtype='int')
+
+    result = fit_candidate(XGBClassifier(n_estimators=200, n_jobs=1), {}, (X_train, y_train, X_test, y_test), lambda y, predicted: 0.0,
+                           early_stopping_rounds=5)
+    assert result["best_iteration"] < 199
+
+def test_halving_ranks_within_rounds(tmp_path):
+    write_synthetic_csv(str(tmp_path / "extract.csv"), 3000)
+    df = clean_df(transform_raw_data(str(tmp_path / "extract.csv"))).reset_index(drop=True)
+    X = df[benchmark_features]
+    # a noisy target that depends on the features, so the candidates' scores differ
+    noise = np.random.default_rng(0).random(len(df))
+    y = pd.Series(np.where(((df['speed_limit'].astype('float') >= 40) & (noise < 0.8)) | (noise > 0.9), 1, 0), name='fatality')
+    pipeline = Pipeline([("preprocessor", CustomPreprocessor(rng=0)), ("model", XGBClassifier(n_estimators=16, n_jobs=1))])
+
+    search = CachedSearchCV(pipeline, {"model__max_depth": [1, 2, 3, 4], "model__learning_rate": [0.1, 0.3]}, n_iter=8, cv=3, random_state=0,
+                            refit=False, cache_dir=None, halving_factor=2, n_jobs=1).fit(X, y)
+    results = search.cv_results_
+    assert sorted(results["iter"].unique()) == [0, 1, 2, 3]
+    for _, round_results in results.groupby("iter"):
+        assert round_results["rank_test_precision"].min() == 1
+        assert round_results["rank_test_precision"].max() <= len(round_results)
+        best = round_results["mean_test_precision"].max()
+        assert (round_results.loc[round_results["rank_test_precision"] == 1, "mean_test_precision"] == best).all()
+    assert results["mean_test_precision"].nunique() > 1
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from benchmark import write_synthetic_csv, benchmark_features
+from functions import read_raw_data, expand_collisions, transform_raw_data, transform_raw_data_chunked, read_raw_data_by_collision, collision_byte_ranges, \
+    read_raw_data_range, clean_df, impute_categorical_vars, impute_fit_df, impute_transform_df, impute_fit_df_TE, impute_transform_df_TE, \
+    CustomPreprocessor
+
+def collisions(tmp_path, n_rows=4000):
+    write_synthetic_csv(str(tmp_path / "extract.csv"), n_rows)
+    df = clean_df(transform_raw_data(str(tmp_path / "extract.csv"))).reset_index(drop=True)
+    X = df[benchmark_features]
+    y = pd.Series(np.where(df['casualty_severity'] == "Fatal", 1, 0), name='fatality')
+    return X, y
+
+def without_missing_categories(X):
+    # rows whose categorical values are all known, so that nothing is imputed by sampling - continuous values are imputed with medians,
+    # which are the same in every transform
+    categorical_vars = X.select_dtypes(include='category').columns
+    return X[X[categorical_vars].notna().all(axis=1)].reset_index(drop=True)
+
+def as_frame(preprocessor, X):
+    return pd.DataFrame(preprocessor.transform(X), columns=preprocessor.get_feature_names_out())
+
+def test_custom_preprocessor_matches_one_hot(tmp_path):
+    X, _ = collisions(tmp_path)
+    X_complete = without_missing_categories(X)
+    assert X_complete['engine_capacity_cc'].isna().any()
+    fitted = impute_fit_df(X)
+
+    # with columns for categories that aren't in the data
+    encoded_cols_dict = {'vehicle_type': ['vehicle_type_Hovercraft'], 'speed_limit': ['speed_limit_10']}
+    expected = impute_transform_df(X_complete, *fitted, benchmark_features, encoded_cols_dict=encoded_cols_dict).astype('float')
+    preprocessor = CustomPreprocessor(encoded_cols_dict=encoded_cols_dict, rng=0).fit(X)
+    pd.testing.assert_frame_equal(as_frame(preprocessor, X_complete), expected)
+    assert 'vehicle_type_Hovercraft' in expected.columns
+
+    # a selection of the one-hot columns
+    one_hot_encoded_cols = ['vehicle_type_Car', 'vehicle_type_Pedal cycle', 'speed_limit_30', 'light_conditions_Daylight', 'season_summer']
+    expected = impute_transform_df(X_complete, *fitted, benchmark_features, one_hot_encoded_cols=one_hot_encoded_cols).astype('float')
+    preprocessor = CustomPreprocessor(one_hot_encoded_cols=one_hot_encoded_cols, rng=0).fit(X)
+    pd.testing.assert_frame_equal(as_frame(preprocessor, X_complete), expected)
+
+def test_custom_preprocessor_log_cols(tmp_path):
+    # as the CustomPreprocessor of the imputed values notebook, which added the log of the scaled engine capacity to impute_transform_df's output
+    X, _ = collisions(tmp_path)
+    X_complete = without_missing_categories(X)
+    fitted = impute_fit_df(X)
+    expected = impute_transform_df(X_complete, *fitted, benchmark_features).astype('float')
+    expected['log_engine_capacity_cc'] = np.log(expected['engine_capacity_cc'] + 0.0000001)
+    expected = expected[sorted(expected.columns)]
+
+    preprocessor = CustomPreprocessor(rng=0, log_cols=['engine_capacity_cc']).fit(X)
+    pd.testing.assert_frame_equal(as_frame(preprocessor, X_complete), expected)
+    sparse_preprocessor = CustomPreprocessor(rng=0, log_cols=['engine_capacity_cc'], sparse_output=True).fit(X)
+    assert np.array_equal(sparse_preprocessor.transform(X_complete).toarray(), expected.to_numpy())
+
+def test_custom_preprocessor_matches_target_encoding(tmp_path):
+    X, y = collisions(tmp_path)
+    X_complete = without_missing_categories(X)
+    fitted = impute_fit_df_TE(X, y)
+
+    expected = impute_transform_df_TE(X_complete, *fitted[:5], benchmark_features, fitted[5]).astype('float')
+    preprocessor = CustomPreprocessor(encoding="target", rng=0).fit(X, y)
+    pd.testing.assert_frame_equal(as_frame(preprocessor, X_complete), expected)
+
+def test_custom_preprocessor_records(tmp_path):
+    # dicts and lists of dicts (both the small batch and vectorised lookups) give the same output as a DataFrame
+    X, y = collisions(tmp_path)
+    X_complete = without_missing_categories(X).iloc[:100]
+    records = X_complete.astype('object').where(X_complete.notna(), None).to_dict('records')
+
+    for preprocessor in [CustomPreprocessor(rng=0).fit(X), CustomPreprocessor(encoding="target", rng=0).fit(X, y)]:
+        expected = preprocessor.transform(X_complete)
+        assert np.array_equal(preprocessor.transform(records[0]), expected[:1])
+        assert np.array_equal(preprocessor.transform(records[:10]), expected[:10])
+        assert np.array_equal(preprocessor.transform(records), expected)
+
+def test_custom_preprocessor_unseen_categories(tmp_path):
+    # fitted without bikes, so "Pedal cycle" is as unseen as "Hovercraft", but still gets the bike engine_capacity_cc
+    X, y = collisions(tmp_path)
+    is_bike = (X['vehicle_type'] == "Pedal cycle").to_numpy()
+    X_fit = X[~is_bike].reset_index(drop=True)
+    X_fit['vehicle_type'] = X_fit['vehicle_type'].cat.remove_unused_categories()
+    y_fit = y[~is_bike].reset_index(drop=True)
+    record = X_fit.iloc[0].to_dict()
+    records = [{**record, 'vehicle_type': vehicle_type, 'engine_capacity_cc': np.nan} for vehicle_type in ["Pedal cycle", "Hovercraft"]]
+
+    preprocessor = CustomPreprocessor(rng=0).fit(X_fit)
+    out = as_frame(preprocessor, records)
+    vehicle_type_cols = [col for col in out.columns if col.startswith("vehicle_type_")]
+    assert (out[vehicle_type_cols] == 0).all().all()
+    _, _, continuous_medians_grouped, continuous_medians, scaler = impute_fit_df(X_fit)
+    engine_capacity = np.array([0.00065 * continuous_medians_grouped['engine_capacity_cc'].loc["Car"], continuous_medians['engine_capacity_cc']])
+    engine_position = list(scaler.feature_names_in_).index('engine_capacity_cc')
+    assert np.allclose(out['engine_capacity_cc'], engine_capacity * scaler.scale_[engine_position] + scaler.min_[engine_position])
+
+    preprocessor = CustomPreprocessor(encoding="target", rng=0).fit(X_fit, y_fit)
+    out = as_frame(preprocessor, records)
+    assert (out['vehicle_type'] == preprocessor.encoder_.target_mean_).all()
+    assert np.allclose(out['engine_capacity_cc'], engine_capacity * scaler.scale_[engine_position] + scaler.min_[engine_position])
+
+def as_objects(df):
+    # categoricals as their values, as the categories of each chunk differ
+    return df.astype({col: 'object' for col in df.select_dtypes(include='category').columns})
+
+def test_chunked_matches_in_memory(tmp_path):
+    path_to_csv = str(tmp_path / "extract.csv")
+    write_synthetic_csv(path_to_csv, 3000)
+    expected = as_objects(transform_raw_data(path_to_csv))
+
+    # chunks small enough that they split collisions
+    raw_chunks = list(read_raw_data(path_to_csv, chunksize=50))
+    assert any(chunk['accident_index'].iloc[-1] == next_chunk['accident_index'].iloc[0] for chunk, next_chunk in zip(raw_chunks, raw_chunks[1:]))
+    # prepending held-back rows keeps the categoricals categorical
+    raw = read_raw_data(path_to_csv)
+    for chunk in read_raw_data_by_collision(path_to_csv, chunksize=50):
+        assert (chunk.dtypes == 'category').equals(raw.dtypes == 'category')
+    chunks = list(transform_raw_data_chunked(path_to_csv, chunksize=50))
+    assert len(chunks) > 1
+    pd.testing.assert_frame_equal(pd.concat([as_objects(chunk) for chunk in chunks]), expected)
+
+    # byte ranges of whole collisions, as read by score.py's workers
+    ranges = list(collision_byte_ranges(path_to_csv, chunksize=50))
+    assert len(ranges) > 1
+    assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+    assert ranges[-1][1] == os.path.getsize(path_to_csv)
+    casualty_offset = 0
+    row_offset = 0
+    chunks = []
+    for start, end in ranges:
+        chunk, n_casualties, n_rows = expand_collisions(read_raw_data_range(path_to_csv, start, end), casualty_offset, row_offset)
+        casualty_offset += n_casualties
+        row_offset += n_rows
+        chunks.append(as_objects(chunk))
+    pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+def test_sparse_output_matches_dense(tmp_path):
+    X, _ = collisions(tmp_path)
+    fitted = impute_fit_df(X)
+    encoded_cols_dict = {'vehicle_type': ['vehicle_type_Hovercraft'], 'speed_limit': ['speed_limit_10']}
+    one_hot_encoded_cols = ['vehicle_type_Car', 'vehicle_type_Pedal cycle', 'speed_limit_30', 'light_conditions_Daylight', 'season_summer']
+
+    # the same rng, so the same missing values are imputed
+    for options in [{}, {'encoded_cols_dict': encoded_cols_dict}, {'one_hot_encoded_cols': one_hot_encoded_cols}]:
+        dense = impute_transform_df(X, *fitted, benchmark_features, rng=0, **options)
+        matrix, columns = impute_transform_df(X, *fitted, benchmark_features, rng=0, sparse_output=True, **options)
+        assert matrix.format == 'csr'
+        assert columns == list(dense.columns)
+        assert np.array_equal(matrix.toarray(), dense.to_numpy(dtype='float'))
+
+        dense_preprocessor = CustomPreprocessor(rng=0, **options).fit(X)
+        sparse_preprocessor = CustomPreprocessor(rng=0, sparse_output=True, **options).fit(X)
+        matrix = sparse_preprocessor.transform(X)
+        assert matrix.format == 'csr' and matrix.has_sorted_indices
+        assert list(sparse_preprocessor.get_feature_names_out()) == list(dense_preprocessor.get_feature_names_out())
+        assert np.array_equal(matrix.toarray(), dense_preprocessor.transform(X))
+
+def test_impute_categorical_vars():
+    rng = np.random.default_rng(0)
+    n = 20000
+    categorical_freqs = {'light_conditions': {'Daylight': 0.5, 'Darkness - lights lit': 0.3, 'Darkness - no lighting': 0.2},
+                         'sex_of_casualty': {'Male': 0.6, 'Female': 0.4}}
+    df = pd.DataFrame({
+        'light_conditions': pd.Categorical(rng.choice(['Daylight', 'Darkness - lights lit'], n)),
+        'sex_of_casualty': pd.Categorical(rng.choice(['Male', 'Female'], n))
+    })
+    for col in categorical_freqs:
+        df[col] = df[col].mask(rng.random(n) < 0.3)
+    missing = df.isna()
+
+    # the same seed gives the same draws
+    imputed = impute_categorical_vars(df.copy(), categorical_freqs, list(categorical_freqs), rng=1)
+    pd.testing.assert_frame_equal(impute_categorical_vars(df.copy(), categorical_freqs, list(categorical_freqs), rng=1), imputed)
+    assert not imputed.equals(impute_categorical_vars(df.copy(), categorical_freqs, list(categorical_freqs), rng=2))
+
+    for col, freq_dict in categorical_freqs.items():
+        # only the missing cells change
+        assert imputed[col].notna().all()
+        pd.testing.assert_series_equal(imputed[col][~missing[col]].astype('object'), df[col][~missing[col]].astype('object'))
+
+        # and are drawn with the fitted frequencies, including categories that weren't in the column
+        draws = imputed[col][missing[col]].value_counts(normalize=True)
+        for category, freq in freq_dict.items():
+            assert abs(draws[category] - freq) < 0.03
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import write_synthetic_csv, benchmark_features
+from functions import transform_raw_data, clean_df, impute_fit_df, impute_fit_df_TE
+from incremental import IncrementalImputer, QuantileSketch
+
+def batches(tmp_path, n_batches=3):
+    # batches with their own categories (only those seen in the batch), as from transforming each month separately
+    write_synthetic_csv(str(tmp_path / "extract.csv"), 6000)
+    df = clean_df(transform_raw_data(str(tmp_path / "extract.csv"))).reset_index(drop=True)
+    X = df[benchmark_features]
+    y = pd.Series(np.where(df['casualty_severity'] == "Fatal", 1, 0), name='fatality')
+
+    for rows in np.array_split(np.arange(len(X)), n_batches):
+        X_batch = X.iloc[rows].reset_index(drop=True)
+        for col in X_batch.select_dtypes(include='category').columns:
+            X_batch[col] = X_batch[col].cat.remove_unused_categories()
+        yield X_batch, y.iloc[rows].reset_index(drop=True)
+
+def assert_fitted_values_equal(incremental, full):
+    categorical_freqs, vars_to_groupby, continuous_medians_grouped, continuous_medians, scaler = incremental[:5]
+    assert categorical_freqs.keys() == full[0].keys()
+    for col, freqs in categorical_freqs.items():
+        assert freqs == pytest.approx(full[0][col]), col
+    assert vars_to_groupby == full[1]
+    assert continuous_medians == pytest.approx(full[3])
+    assert continuous_medians_grouped.keys() == full[2].keys()
+    for col, medians in continuous_medians_grouped.items():
+        assert medians.to_dict() == pytest.approx(full[2][col].to_dict()), col
+    assert list(scaler.feature_names_in_) == list(full[4].feature_names_in_)
+    assert np.allclose(scaler.data_min_, full[4].data_min_)
+    assert np.allclose(scaler.data_max_, full[4].data_max_)
+
+def test_partial_fit_matches_fit(tmp_path):
+    imputer = IncrementalImputer()
+    imputer_TE = IncrementalImputer(target_encode=True)
+    X_batches, y_batches = [], []
+    for X_batch, y_batch in batches(tmp_path):
+        imputer.partial_fit(X_batch)
+        imputer_TE.partial_fit(X_batch, y_batch)
+        X_batches.append(X_batch)
+        y_batches.append(y_batch)
+    X = pd.concat(X_batches, ignore_index=True)
+    y = pd.concat(y_batches, ignore_index=True)
+
+    assert_fitted_values_equal(imputer.fitted_values(), impute_fit_df(X))
+
+    fitted = imputer_TE.fitted_values()
+    full = impute_fit_df_TE(X, y)
+    assert_fitted_values_equal(fitted, full)
+    encoder, full_encoder = fitted[5], full[5]
+    assert list(encoder.feature_names_in_) == list(full_encoder.feature_names_in_)
+    assert encoder.target_mean_ == pytest.approx(full_encoder.target_mean_)
+    for categories, full_categories, encodings, full_encodings in zip(encoder.categories_, full_encoder.categories_, encoder.encodings_, full_encoder.encodings_):
+        assert pd.Index(categories).equals(pd.Index(full_categories))
+        assert np.allclose(encodings, full_encodings)
+
+def test_quantile_sketch_compressed():
+    # more distinct values than max_centroids, added in batches, so the sketch is compressed several times
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(7.3, 0.5, 100000)
+    sketch = QuantileSketch(max_centroids=500)
+    for batch in np.array_split(values, 10):
+        sketch.update(batch)
+
+    assert len(sketch.means) <= 500
+    assert sketch.counts.sum() == len(values)
+    # the estimate of each quantile is within 0.5% of it in rank
+    sorted_values = np.sort(values)
+    for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+        rank = np.searchsorted(sorted_values, sketch.quantile(q)) / len(values)
+        assert abs(rank - q) < 0.005, q
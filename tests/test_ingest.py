@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pandas as pd
+
+from benchmark import synthetic_raw_data
+from cache import cache_key, load_df
+from functions import transform_raw_data, clean_df
+from ingest import ingest
+
+accident_vars = ['longitude', 'latitude', 'date', 'time', 'number_of_vehicles', 'speed_limit', 'day_of_week', 'first_road_class', 'road_type',
+                 'junction_detail', 'junction_control', 'second_road_class', 'pedestrian_crossing_human_control',
+                 'pedestrian_crossing_physical_facilities', 'light_conditions', 'weather_conditions', 'road_surface_conditions',
+                 'special_conditions_at_site', 'carriageway_hazards', 'urban_or_rural_area']
+vehicle_vars = ['vehicle_type', 'towing_and_articulation', 'vehicle_manoeuvre', 'vehicle_location_restricted_lane', 'junction_location',
+                'skidding_and_overturning', 'hit_object_in_carriageway', 'vehicle_leaving_carriageway', 'hit_object_off_carriageway',
+                'first_point_of_impact', 'vehicle_left_hand_drive', 'propulsion_code', 'journey_purpose_of_driver', 'sex_of_driver',
+                'driver_imd_decile', 'driver_home_area_type', 'engine_capacity_cc', 'age_of_vehicle', 'age_of_driver', 'age_band_of_driver',
+                'lsoa_of_driver']
+casualty_vars = ['sex_of_casualty', 'casualty_home_area_type', 'casualty_imd_decile', 'casualty_severity', 'age_of_casualty',
+                 'age_band_of_casualty', 'lsoa_of_casualty']
+
+def write_year(tmp_path, year):
+    # the extract written by get_raw_data.r for a year, and the DfT csvs it comes from, in which missing numbers are -1
+    # the DfT csvs have labels rather than codes, which ingest keeps as they are as they aren't in the schema
+    extract = synthetic_raw_data(2000, seed=year)
+    collisions = extract['accident_index'].cat.codes
+    extract['speed_limit'] = extract['speed_limit'].astype('float').mask(collisions % 7 == 0)
+    extract['age_of_casualty'] = extract['age_of_casualty'].mask(collisions % 5 == 0)
+    extract.to_csv(tmp_path / f"extract_{year}.csv", index=False)
+
+    df = extract.drop(columns=['longitude.y', 'latitude.y', 'date.y']).rename(columns={'longitude.x': 'longitude', 'latitude.x': 'latitude', 'date.x': 'date'})
+    df['accident_index'] = df['accident_index'].astype('str')
+    for col in ['speed_limit', 'engine_capacity_cc', 'age_of_vehicle', 'age_of_driver', 'age_of_casualty']:
+        df[col] = df[col].fillna(-1)
+    accidents = df.drop_duplicates('accident_index')[['accident_index'] + accident_vars].copy()
+    accidents['date'] = pd.to_datetime(accidents['date']).dt.strftime("%d/%m/%Y")
+    vehicles = df.drop_duplicates(['accident_index', 'vehicle_reference'])[['accident_index', 'vehicle_reference'] + vehicle_vars]
+    casualties = df[df['casualty_reference'].notna()][['accident_index', 'vehicle_reference', 'casualty_reference'] + casualty_vars]
+
+    (tmp_path / "raw").mkdir(exist_ok=True)
+    accidents.to_csv(tmp_path / "raw" / f"dft-road-casualty-statistics-accident-{year}.csv", index=False)
+    vehicles.to_csv(tmp_path / "raw" / f"dft-road-casualty-statistics-vehicle-{year}.csv", index=False)
+    casualties.to_csv(tmp_path / "raw" / f"dft-road-casualty-statistics-casualty-{year}.csv", index=False)
+
+def test_parquet_matches_csv(tmp_path):
+    write_year(tmp_path, 2022)
+    pd.DataFrame({'variable': ['sex_of_casualty'], 'code': ['9'], 'label': ['Not a label in the data']}).to_csv(tmp_path / "schema.csv", index=False)
+    ingest(str(tmp_path / "raw"), str(tmp_path / "dataset"), str(tmp_path / "schema.csv"))
+
+    from_csv = transform_raw_data(str(tmp_path / "extract_2022.csv")).reset_index(drop=True)
+    from_parquet = transform_raw_data(str(tmp_path / "dataset"), years=[2022]).reset_index(drop=True)
+
+    assert from_csv['speed_limit'].isna().any()
+    assert list(from_csv.columns) == list(from_parquet.columns)
+    for col in from_csv.columns:
+        csv_values = from_csv[col].astype('object').where(from_csv[col].notna(), None).astype('str')
+        parquet_values = from_parquet[col].astype('object').where(from_parquet[col].notna(), None).astype('str')
+        assert (csv_values == parquet_values).all(), col
+    assert from_csv['speed_limit'].dtype == from_parquet['speed_limit'].dtype == 'Int16'
+
+    # the same one-hot columns, e.g. speed_limit_30 rather than speed_limit_30.0
+    csv_columns = pd.get_dummies(clean_df(from_csv)[['speed_limit']]).columns
+    assert list(csv_columns) == list(pd.get_dummies(clean_df(from_parquet)[['speed_limit']]).columns)
+    assert 'speed_limit_30' in csv_columns
+
+def test_load_df_from_dataset(tmp_path):
+    for year in [2021, 2022]:
+        write_year(tmp_path, year)
+    pd.DataFrame({'variable': [], 'code': [], 'label': []}).to_csv(tmp_path / "schema.csv", index=False)
+    ingest(str(tmp_path / "raw"), str(tmp_path / "dataset"), str(tmp_path / "schema.csv"))
+    cache_dir = str(tmp_path / "cache")
+
+    df = load_df(str(tmp_path / "dataset"), cache_dir=cache_dir, years=[2022])
+    pd.testing.assert_frame_equal(df, clean_df(transform_raw_data(str(tmp_path / "dataset"), years=[2022])))
+    # loaded from the cache the second time
+    pd.testing.assert_frame_equal(load_df(str(tmp_path / "dataset"), cache_dir=cache_dir, years=[2022]), df)
+    assert len([name for name in os.listdir(cache_dir) if name.endswith(".arrow")]) == 1
+
+    # the other years are separate entries, and the entry of a year only depends on that year's partition
+    key = cache_key(str(tmp_path / "dataset"), cache_dir, years=[2022])
+    assert key != cache_key(str(tmp_path / "dataset"), cache_dir)
+    assert key != cache_key(str(tmp_path / "dataset"), cache_dir, years=[2021, 2022])
+    shutil.rmtree(tmp_path / "dataset" / "year=2021")
+    assert key == cache_key(str(tmp_path / "dataset"), cache_dir, years=[2022])
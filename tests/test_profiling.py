@@ -0,0 +1,100 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from benchmark import write_synthetic_csv, benchmark_features
+from functions import transform_raw_data, clean_df, impute_fit_df, impute_transform_df, impute_fit_df_TE, impute_transform_df_TE
+from profiling import profile, write_trace, compare_traces
+
+# fits and saves a pipeline, then scores the csv with it in 2 worker processes
+score_script = """
+import numpy as np
+from sklearn.pipeline import Pipeline
+from xgboost import XGBClassifier
+from benchmark import write_synthetic_csv
+from functions import transform_raw_data, clean_df, CustomPreprocessor
+from score import save_pipeline, score_csv
+
+if __name__ == "__main__":
+    features = ['age_of_casualty', 'vehicle_type', 'speed_limit', 'light_conditions']
+    write_synthetic_csv("extract.csv", 2000)
+    df = clean_df(transform_raw_data("extract.csv"))
+    y = np.where(df['casualty_severity'] == "Fatal", 1, 0)
+    pipeline = Pipeline([("preprocessor", CustomPreprocessor(rng=0)), ("model", XGBClassifier(n_estimators=2, n_jobs=1))]).fit(df[features], y)
+    save_pipeline(pipeline, features, "pipeline.joblib")
+    score_csv("extract.csv", "pipeline.joblib", "probabilities.csv", chunksize=500, n_workers=2)
+"""
+
+def test_stages_named_after_their_function(tmp_path):
+    # the one-hot and target encoding functions have stages doing the same thing, which are recorded separately
+    write_synthetic_csv(str(tmp_path / "extract.csv"), 2000)
+    df = clean_df(transform_raw_data(str(tmp_path / "extract.csv"))).reset_index(drop=True)
+    X = df[benchmark_features]
+    y = pd.Series(np.where(df['casualty_severity'] == "Fatal", 1, 0), name='fatality')
+
+    with profile(track_memory=False) as p:
+        fitted = impute_fit_df(X)
+        impute_transform_df(X, *fitted, benchmark_features, rng=0)
+        fitted = impute_fit_df_TE(X, y)
+        impute_transform_df_TE(X, *fitted[:5], benchmark_features, fitted[5], rng=0)
+    stages = p.summary()
+
+    for function in ["impute_fit_df", "impute_fit_df_TE"]:
+        for name in ["medians", "scaler"]:
+            assert stages.loc[f"{function}.{name}", "calls"] == 1
+    for function in ["impute_transform_df", "impute_transform_df_TE"]:
+        assert stages.loc[f"{function}.scale", "calls"] == 1
+
+def test_environment_variable_profiles_workers(tmp_path):
+    # the trace written at exit has the stages run in score.py's worker processes as well as in the main one
+    env = dict(os.environ, STATS19_PROFILE="trace.json", PYTHONPATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    env.pop("STATS19_PROFILE_WORKERS", None)
+    subprocess.run([sys.executable, "-c", score_script], cwd=tmp_path, env=env, check=True)
+
+    with open(tmp_path / "trace.json") as f:
+        trace_events = json.load(f)["traceEvents"]
+    fit_pids = {event["pid"] for event in trace_events if event["name"] == "CustomPreprocessor.fit"}
+    transform_pids = {event["pid"] for event in trace_events if event["name"] == "CustomPreprocessor.transform"}
+    # the pipeline is fitted in the main process, which also transforms in fit
+    assert len(fit_pids) == 1
+    assert len(transform_pids - fit_pids) == 2
+
+def test_write_trace(tmp_path):
+    write_synthetic_csv(str(tmp_path / "extract.csv"), 500)
+    with profile(str(tmp_path / "trace.json")) as p:
+        clean_df(transform_raw_data(str(tmp_path / "extract.csv")))
+
+    # Chrome trace format: complete ("X") events, with times in microseconds
+    with open(tmp_path / "trace.json") as f:
+        trace = json.load(f)
+    assert trace["displayTimeUnit"] == "ms"
+    assert trace["traceEvents"] == p.events
+    assert {"transform_raw_data", "clean_df"} <= {event["name"] for event in trace["traceEvents"]}
+    for event in trace["traceEvents"]:
+        assert event["ph"] == "X"
+        assert isinstance(event["ts"], float) and event["dur"] >= 0
+        assert isinstance(event["pid"], int) and isinstance(event["tid"], int)
+        assert event["args"]["peak_mb"] >= 0
+    clean = next(event for event in trace["traceEvents"] if event["name"] == "clean_df")
+    assert clean["args"]["rows_in"] == clean["args"]["rows_out"]
+
+def test_compare_traces(tmp_path):
+    def event(name, dur):
+        return {"name": name, "ph": "X", "ts": 0.0, "dur": dur, "pid": 1, "tid": 1, "args": {"cpu_ms": dur / 1000}}
+
+    write_trace(str(tmp_path / "previous.json"), [event("clean_df", 10000), event("clean_df", 10000), event("expand_collisions", 5000),
+                                                  event("read_raw_data", 1000)])
+    write_trace(str(tmp_path / "trace.json"), [event("clean_df", 30000), event("expand_collisions", 5000), event("transform_raw_data", 1000)])
+    df = compare_traces(str(tmp_path / "trace.json"), str(tmp_path / "previous.json"))
+
+    assert df.loc["clean_df", "calls"] == 1 and df.loc["clean_df", "calls_previous"] == 2
+    assert df.loc["clean_df", "wall_ms"] == 30 and df.loc["clean_df", "wall_ms_previous"] == 20
+    assert df.loc["clean_df", "ratio"] == 1.5 and df.loc["clean_df", "slower"]
+    assert df.loc["expand_collisions", "ratio"] == 1 and not df.loc["expand_collisions", "slower"]
+    # stages in only one of the traces
+    assert np.isnan(df.loc["transform_raw_data", "wall_ms_previous"]) and np.isnan(df.loc["read_raw_data", "wall_ms"])
+    assert df.index[0] == "clean_df"
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.pipeline import Pipeline
+from xgboost import XGBClassifier
+
+from benchmark import write_synthetic_csv
+from explain import explain_csv, contributions, aggregation_matrix, source_variables
+from functions import transform_raw_data, clean_df, CustomPreprocessor
+from score import save_pipeline, score_csv
+
+features = ['age_of_casualty', 'engine_capacity_cc', 'vehicle_type', 'speed_limit', 'light_conditions', 'road_surface_conditions', 'sex_of_casualty']
+
+def save_fitted_pipeline(path_to_csv, path):
+    df = clean_df(transform_raw_data(path_to_csv))
+    y = np.where(df['casualty_severity'] == "Fatal", 1, 0)
+    pipeline = Pipeline([("preprocessor", CustomPreprocessor(rng=0)), ("model", XGBClassifier(n_estimators=5, n_jobs=1))]).fit(df[features], y)
+    save_pipeline(pipeline, features, path)
+    return df, pipeline
+
+def test_outputs_join_to_stats19_records(tmp_path):
+    path_to_csv = str(tmp_path / "extract.csv")
+    write_synthetic_csv(path_to_csv, 5000)
+    save_fitted_pipeline(path_to_csv, str(tmp_path / "pipeline.joblib"))
+
+    # each bike casualty of the extract, in input order
+    raw = pd.read_csv(path_to_csv, dtype={'accident_index': 'str'})
+    bike_casualties = raw[(raw['vehicle_type'] == 'Pedal cycle') & raw['casualty_reference'].notna()][['accident_index', 'casualty_reference']]\
+        .drop_duplicates().astype({'casualty_reference': 'int64'}).reset_index(drop=True)
+
+    # in chunks small enough that the keys come from several workers
+    n_rows = score_csv(path_to_csv, str(tmp_path / "pipeline.joblib"), str(tmp_path / "probabilities.csv"), chunksize=500, n_workers=2)
+    scores = pd.read_csv(tmp_path / "probabilities.csv", dtype={'accident_index': 'str'})
+    assert n_rows == len(scores) == len(bike_casualties)
+    pd.testing.assert_frame_equal(scores[['accident_index', 'casualty_reference']], bike_casualties)
+    assert scores['accident_index_2'].tolist() == list(range(len(scores)))
+
+    explain_csv(path_to_csv, str(tmp_path / "pipeline.joblib"), str(tmp_path / "contributions.csv"), chunksize=500, n_workers=2,
+                cache_dir=str(tmp_path / "cache"))
+    contributions = pd.read_csv(tmp_path / "contributions.csv", dtype={'accident_index': 'str'})
+    pd.testing.assert_frame_equal(contributions[['accident_index', 'casualty_reference', 'accident_index_2']], scores[['accident_index', 'casualty_reference', 'accident_index_2']])
+
+def test_contributions_add_up_to_log_odds(tmp_path):
+    path_to_csv = str(tmp_path / "extract.csv")
+    write_synthetic_csv(path_to_csv, 2000)
+    df, pipeline = save_fitted_pipeline(path_to_csv, str(tmp_path / "pipeline.joblib"))
+    # rows without missing categories, so that nothing is imputed by sampling, which would differ between batches and a single transform
+    categorical_vars = df[features].select_dtypes(include='category').columns
+    df = df[df[categorical_vars].notna().all(axis=1)]
+
+    values = contributions(df, pipeline, features, batch_size=300)
+    X = pipeline.named_steps["preprocessor"].transform(df[features])
+    model = pipeline.named_steps["model"]
+    margin = model.get_booster().predict(xgb.DMatrix(X, missing=model.missing), output_margin=True, validate_features=False)
+    assert len(df) > 300
+    assert list(values.columns) == features + ["bias"]
+    np.testing.assert_allclose(values.sum(axis=1), margin, rtol=1e-4, atol=1e-4)
+
+def test_aggregation_matrix_sums_one_hot_columns():
+    columns = ['age_of_casualty', 'speed_limit_30', 'speed_limit_60', 'vehicle_type_Car', 'vehicle_type_2_Car', 'sex_of_casualty_Male', 'other']
+    features = ['age_of_casualty', 'speed_limit', 'vehicle_type', 'vehicle_type_2', 'sex_of_casualty']
+    assert source_variables(columns, features) == ['age_of_casualty', 'speed_limit', 'speed_limit', 'vehicle_type', 'vehicle_type_2', 'sex_of_casualty', 'other']
+
+    matrix, variables = aggregation_matrix(columns, features)
+    assert variables == features + ['other']
+    contribs = np.arange(1, len(columns) + 1, dtype='float')
+    assert list(contribs @ matrix) == [1, 2 + 3, 4, 5, 6, 7]
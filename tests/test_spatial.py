@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+from benchmark import write_synthetic_csv
+from functions import transform_raw_data, clean_df, impute_fit_df, impute_transform_df, impute_fit_df_TE, impute_transform_df_TE, CustomPreprocessor
+from spatial import CountPointIndex, add_exposure_features, earth_radius_km
+
+def count_points():
+    return pd.DataFrame({
+        'latitude': [51.5, 51.51, 51.6, 53.4],
+        'longitude': [-0.1, -0.1, -0.1, -2.2],
+        'pedal_cycles': [100.0, 200.0, np.nan, 50.0],
+        'all_motor_vehicles': [1000.0, 2000.0, 3000.0, 500.0]
+    }, index=pd.Index([10, 11, 12, 13], name='count_point_id'))
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    latitude, longitude, latitudes, longitudes = np.radians([latitude, longitude]).tolist() + [np.radians(latitudes), np.radians(longitudes)]
+    a = np.sin((latitudes - latitude) / 2)**2 + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2)**2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(a))
+
+def test_nearest():
+    index = CountPointIndex(count_points())
+    distances, positions = index.nearest([51.5, np.nan, 53.0], [-0.1, -0.1, -2.0], k=2)
+
+    assert positions.tolist() == [[0, 1], [-1, -1], [3, 2]]
+    assert np.isnan(distances[1]).all()
+    expected = haversine_km(53.0, -2.0, count_points()['latitude'].to_numpy()[[3, 2]], count_points()['longitude'].to_numpy()[[3, 2]])
+    assert np.allclose(distances[2], expected)
+
+def test_within():
+    index = CountPointIndex(count_points())
+    distances, positions = index.within([51.5, np.nan, 53.0, 51.505], [-0.1, -0.1, -2.0, np.nan], radius_km=15)
+
+    assert len(distances) == len(positions) == 4
+    # the point 11km south of count point 12 has count points 0, 1 and 12 within 15km, nearest first
+    assert positions[0].tolist() == [0, 1, 2]
+    assert np.allclose(distances[0], haversine_km(51.5, -0.1, np.array([51.5, 51.51, 51.6]), np.array([-0.1, -0.1, -0.1])))
+    # nothing within 15km, and missing locations
+    for i in [1, 2, 3]:
+        assert len(positions[i]) == 0 and len(distances[i]) == 0
+
+def test_exposure_features_are_imputed(tmp_path):
+    write_synthetic_csv(str(tmp_path / "extract.csv"), 2000)
+    df = clean_df(transform_raw_data(str(tmp_path / "extract.csv"))).reset_index(drop=True)
+    # collisions without a location, and nearest to the count point without a bike count
+    df.loc[:9, 'latitude'] = np.nan
+    df.loc[10:19, 'latitude'] = 51.6
+    df.loc[10:19, 'longitude'] = -0.1
+    df = add_exposure_features(df, CountPointIndex(count_points()))
+    exposure_vars = ['count_point_distance_km', 'count_point_pedal_cycles', 'count_point_all_motor_vehicles']
+    assert df[exposure_vars].isna().any().all()
+
+    features = ['vehicle_type', 'engine_capacity_cc', 'age_of_driver'] + exposure_vars
+    X = df[features]
+    y = pd.Series(np.where(df['casualty_severity'] == "Fatal", 1, 0), name='fatality')
+
+    fitted = impute_fit_df(X)
+    for var in exposure_vars:
+        assert fitted[3][var] == X[var].median()
+    assert not impute_transform_df(X, *fitted, features, rng=0).isna().any().any()
+    fitted = impute_fit_df_TE(X, y)
+    assert not impute_transform_df_TE(X, *fitted[:5], features, fitted[5], rng=0).isna().any().any()
+
+    for preprocessor in [CustomPreprocessor(rng=0).fit(X), CustomPreprocessor(encoding="target", rng=0).fit(X, y),
+                         CustomPreprocessor(rng=0).partial_fit(X.iloc[:500]).partial_fit(X.iloc[500:])]:
+        assert not np.isnan(preprocessor.transform(X)).any()
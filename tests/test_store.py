@@ -0,0 +1,51 @@
+import pickle
+
+import numpy as np
+from scipy import sparse
+
+from store import StoredFold, write_fold
+
+def test_dense_fold(tmp_path):
+    rng = np.random.default_rng(0)
+    # column-major, like CustomPreprocessor's output
+    X_train = np.asfortranarray(rng.random((50, 4)))
+    X_test = np.asfortranarray(rng.random((20, 4)))
+    y_train = rng.integers(0, 2, 50)
+    y_test = rng.integers(0, 2, 20)
+    train_index = np.arange(50) * 2
+    test_index = np.arange(20) * 2 + 1
+    fold = write_fold(str(tmp_path / "fold-0"), X_train, y_train, X_test, y_test, train_index, test_index)
+
+    # only the path is pickled
+    fold = pickle.loads(pickle.dumps(fold))
+    loaded = fold.load()
+    for array, expected in zip(loaded, [X_train, y_train, X_test, y_test]):
+        assert np.array_equal(array, expected)
+        assert not array.flags.writeable
+    assert loaded[0].flags.c_contiguous and loaded[2].flags.c_contiguous
+    assert fold.load() is loaded
+    assert all(np.array_equal(index, expected) for index, expected in zip(fold.indices(), [train_index, test_index]))
+
+def test_sparse_fold(tmp_path):
+    rng = np.random.default_rng(0)
+    # with empty rows at the split and at the end
+    X_train = sparse.vstack([sparse.random(49, 6, density=0.3, random_state=0), sparse.csr_matrix((1, 6))], format='csr')
+    X_test = sparse.vstack([sparse.random(19, 6, density=0.3, random_state=1), sparse.csr_matrix((1, 6))], format='csr')
+    y_train = rng.integers(0, 2, 50)
+    y_test = rng.integers(0, 2, 20)
+    write_fold(str(tmp_path / "fold-0"), X_train, y_train, X_test, y_test)
+
+    loaded_X_train, loaded_y_train, loaded_X_test, loaded_y_test = StoredFold(str(tmp_path / "fold-0")).load()
+    assert loaded_X_train.format == loaded_X_test.format == 'csr'
+    assert loaded_X_train.shape == X_train.shape and loaded_X_test.shape == X_test.shape
+    assert np.array_equal(loaded_X_train.toarray(), X_train.toarray())
+    assert np.array_equal(loaded_X_test.toarray(), X_test.toarray())
+    # the test part's indptr is rebased to start at 0
+    assert loaded_X_test.indptr[0] == 0
+    assert np.array_equal(loaded_X_test.indptr, X_test.indptr)
+    assert np.array_equal(loaded_y_train, y_train) and np.array_equal(loaded_y_test, y_test)
+
+    # rewriting the fold replaces what this process has opened
+    write_fold(str(tmp_path / "fold-0"), X_test, y_test, X_train, y_train)
+    loaded_X_train, _, _, _ = StoredFold(str(tmp_path / "fold-0")).load()
+    assert np.array_equal(loaded_X_train.toarray(), X_test.toarray())
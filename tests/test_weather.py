@@ -0,0 +1,74 @@
+import asyncio
+
+import numpy as np
+import pandas as pd
+
+from benchmark import synthetic_raw_data
+from functions import transform_raw_data, weather_vars
+from weather import add_weather, grid_cells, transform_raw_data_with_weather
+
+class FakeBackend:
+    # returns the same made-up weather for every hour, recording each (latitude, longitude, date) fetched
+    def __init__(self):
+        self.fetched = []
+
+    async def fetch(self, latitude, longitude, date):
+        self.fetched.append((latitude, longitude, date))
+        df = pd.DataFrame({var: np.full(24, latitude + i) for i, var in enumerate(weather_vars)})
+        df["hour"] = np.arange(24)
+        return df
+
+    def close(self):
+        pass
+
+def collisions():
+    return pd.DataFrame({
+        'latitude': [51.5, 51.6, 53.4, np.nan],
+        'longitude': [-0.1, -0.12, -2.2, -1.0],
+        'date': ['2022-03-01', '2022-03-01', '2022-03-02', '2022-03-02'],
+        'time': ['08:15', '17:45', '12:00', '09:00']
+    })
+
+def check_weather(df):
+    # the first two collisions are in the same grid cell on the same day, and the last has no location
+    assert np.allclose(df['T2M'].iloc[:3], [51.5 + 1, 51.5 + 1, 53.5 + 1])
+    assert df[weather_vars].iloc[3].isna().all()
+
+def test_add_weather(tmp_path):
+    backend = FakeBackend()
+    check_weather(add_weather(collisions(), backend=backend, cache_path=str(tmp_path / "weather.sqlite")))
+    assert len(backend.fetched) == 2
+
+    # cached, so nothing is fetched again
+    check_weather(add_weather(collisions(), backend=backend, cache_path=str(tmp_path / "weather.sqlite")))
+    assert len(backend.fetched) == 2
+
+def test_add_weather_in_running_loop(tmp_path):
+    # as in a notebook, where add_weather is called while an event loop is running
+    backend = FakeBackend()
+
+    async def notebook_cell():
+        return add_weather(collisions(), backend=backend, cache_path=str(tmp_path / "weather.sqlite"))
+
+    check_weather(asyncio.run(notebook_cell()))
+    assert len(backend.fetched) == 2
+    check_weather(asyncio.run(notebook_cell()))
+    assert len(backend.fetched) == 2
+
+def test_transform_raw_data_with_weather(tmp_path):
+    # the extract written by get_raw_data.r has weather columns, which can differ between the rows of a collision (e.g. by hour),
+    # but transform_raw_data ignores them, and transform_raw_data_with_weather replaces them with add_weather's
+    extract = synthetic_raw_data(2000)
+    for i, var in enumerate(weather_vars):
+        extract[var] = np.arange(len(extract)) + i
+    extract.to_csv(tmp_path / "extract.csv", index=False)
+
+    df = transform_raw_data(str(tmp_path / "extract.csv"))
+    assert not any(var in df.columns for var in weather_vars)
+    extract.drop(columns=weather_vars).to_csv(tmp_path / "extract_without_weather.csv", index=False)
+    pd.testing.assert_frame_equal(df, transform_raw_data(str(tmp_path / "extract_without_weather.csv")))
+
+    with_weather = transform_raw_data_with_weather(str(tmp_path / "extract.csv"), backend=FakeBackend(), cache_path=str(tmp_path / "weather.sqlite"))
+    pd.testing.assert_frame_equal(with_weather.drop(columns=weather_vars), df)
+    latitude, _ = grid_cells(with_weather['latitude'], with_weather['longitude'])
+    assert np.allclose(with_weather['T2M'], latitude + 1)
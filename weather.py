@@ -0,0 +1,236 @@
+import asyncio
+import http.client
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+
+import numpy as np
+import pandas as pd
+
+from functions import read_raw_data, expand_collisions, weather_vars
+
+# weather at the time and location of each collision, from the NASA POWER API (as get_power in get_raw_data.r)
+# NASA POWER's meteorology is on a 0.5 x 0.625 degree grid, so every collision in the same grid cell on the same day has the same weather
+# and is fetched with one request. Requests are made concurrently, and each (cell, date) is cached in an sqlite database,
+# so rerunning (or adding a new year) only fetches the (cell, date)s that aren't already cached
+# usage: df = transform_raw_data_with_weather("stats19CycleCollisions.csv")
+
+# where fetched weather is cached by default - outside .cache, as it's slow to fetch again and cache.evict only manages entries derived from local files
+weather_cache_path = os.path.join("weather_cache", "weather.sqlite")
+
+# latitude, longitude resolution of NASA POWER's meteorology grid
+grid_resolution = (0.5, 0.625)
+
+def grid_cells(latitude, longitude, resolution=grid_resolution):
+    # centre of the grid cell containing each point, rounded so that the same cell always has exactly the same coordinates
+    latitude_resolution, longitude_resolution = resolution
+    return np.round(np.round(np.asarray(latitude, dtype='float') / latitude_resolution) * latitude_resolution, 4), \
+           np.round(np.round(np.asarray(longitude, dtype='float') / longitude_resolution) * longitude_resolution, 4)
+
+class NasaPowerBackend:
+    # fetches the hourly weather for a day at a point from the NASA POWER API
+    # requests are made over a pool of at most max_connections persistent connections, each used by one thread at a time
+    # base_url can point at any server with the same API, e.g. a local stub server for testing
+    # any object with the same fetch and close methods can be used as a backend instead
+    def __init__(self, base_url="https://power.larc.nasa.gov", community="ag", max_connections=8, timeout=60):
+        self.base_url = urlparse(base_url)
+        self.community = community
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_connections)
+        self.connections = [None] * max_connections
+        self.free_connections = None
+        self.loop = None
+
+    def connect(self):
+        if self.base_url.scheme == "https":
+            return http.client.HTTPSConnection(self.base_url.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.base_url.netloc, timeout=self.timeout)
+
+    def get(self, i, path):
+        # runs in the executor, using connection i, which is reopened if the server has closed it
+        for attempt in range(2):
+            if self.connections[i] is None:
+                self.connections[i] = self.connect()
+            try:
+                self.connections[i].request("GET", path)
+                response = self.connections[i].getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.connections[i].close()
+                self.connections[i] = None
+                if attempt == 1:
+                    raise
+
+    async def fetch(self, latitude, longitude, date):
+        # returns a DataFrame of the weather_vars for each hour (local solar time) of date, which is a "YYYY-MM-DD" string
+        day = date.replace("-", "")
+        query = urlencode({
+            "parameters": ",".join(weather_vars),
+            "community": self.community,
+            "latitude": latitude,
+            "longitude": longitude,
+            "start": day,
+            "end": day,
+            "time-standard": "LST",
+            "format": "JSON"
+        })
+        path = self.base_url.path.rstrip("/") + "/api/temporal/hourly/point?" + query
+
+        # the queue of free connections belongs to an event loop, so it's recreated if the backend is used from a new one
+        if self.free_connections is None or self.loop is not asyncio.get_running_loop():
+            self.loop = asyncio.get_running_loop()
+            self.free_connections = asyncio.Queue()
+            for i in range(len(self.connections)):
+                self.free_connections.put_nowait(i)
+        i = await self.free_connections.get()
+        try:
+            status, body = await asyncio.get_running_loop().run_in_executor(self.executor, self.get, i, path)
+        finally:
+            self.free_connections.put_nowait(i)
+
+        if status != 200:
+            raise RuntimeError(f"NASA POWER request failed with status {status}: {body[:200]}")
+        data = json.loads(body)
+        fill_value = data.get("header", {}).get("fill_value", -999)
+        parameters = data["properties"]["parameter"]
+
+        # values are keyed by "YYYYMMDDHH"
+        df = pd.DataFrame({var: pd.Series(parameters[var]) for var in weather_vars})
+        df = df.mask(df == fill_value)
+        df["hour"] = df.index.str.slice(8, 10).astype('int')
+        return df.reset_index(drop=True)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for connection in self.connections:
+            if connection is not None:
+                connection.close()
+
+def open_cache(cache_path):
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    connection = sqlite3.connect(cache_path)
+    columns = ", ".join(f"{var} REAL" for var in weather_vars)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS weather (latitude REAL, longitude REAL, date TEXT, hour INTEGER, {columns}, "
+                       "PRIMARY KEY (latitude, longitude, date, hour))")
+    return connection
+
+def cached_weather(connection, keys):
+    # returns the cached rows (latitude, longitude, date, hour, weather_vars) for the (latitude, longitude, date)s in keys
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (latitude REAL, longitude REAL, date TEXT)")
+    connection.execute("DELETE FROM wanted")
+    connection.executemany("INSERT INTO wanted VALUES (?, ?, ?)", keys[['latitude', 'longitude', 'date']].itertuples(index=False))
+    columns = ", ".join(f"w.{var}" for var in weather_vars)
+    return pd.read_sql_query(f"SELECT w.latitude, w.longitude, w.date, w.hour, {columns} FROM weather w "
+                             "JOIN wanted USING (latitude, longitude, date)", connection)
+
+def save_weather(connection, latitude, longitude, date, df):
+    placeholders = ", ".join("?" * (4 + len(weather_vars)))
+    connection.executemany(f"INSERT OR REPLACE INTO weather VALUES ({placeholders})",
+                           [(latitude, longitude, date, int(row.hour)) + tuple(None if pd.isna(getattr(row, var)) else float(getattr(row, var)) for var in weather_vars)
+                            for row in df.itertuples(index=False)])
+
+async def fetch_weather(keys, backend, connection, max_concurrency=8, retries=3):
+    # fetches the weather for each (latitude, longitude, date) in keys and saves it to the cache, with at most max_concurrency requests in flight
+    # failed requests are retried with exponential backoff, and then skipped (so are fetched again next time) - returns the number skipped
+    queue = asyncio.Queue()
+    for key in keys[['latitude', 'longitude', 'date']].itertuples(index=False):
+        queue.put_nowait(key)
+    n_failed = 0
+    n_saved = 0
+
+    async def worker():
+        nonlocal n_failed, n_saved
+        while not queue.empty():
+            latitude, longitude, date = queue.get_nowait()
+            for attempt in range(retries):
+                try:
+                    df = await backend.fetch(latitude, longitude, date)
+                    break
+                except Exception as e:
+                    if attempt == retries - 1:
+                        print(f"Skipping weather for {latitude}, {longitude} on {date}: {e}")
+                        df = None
+                    else:
+                        await asyncio.sleep(2**attempt)
+            if df is None:
+                n_failed += 1
+                continue
+
+            save_weather(connection, latitude, longitude, date, df)
+            n_saved += 1
+            # committed regularly so that an interrupted run keeps what it has fetched
+            if n_saved % 100 == 0:
+                connection.commit()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+    finally:
+        connection.commit()
+
+    return n_failed
+
+async def update_weather(wanted, backend, cache_path, max_concurrency=8, retries=3):
+    # returns the cached weather for the (latitude, longitude, date)s in wanted, first fetching and caching any that aren't cached
+    # the sqlite connection can only be used by the thread that opened it, so it's opened here, in the thread running the event loop (see run)
+    connection = open_cache(cache_path)
+    try:
+        cached = cached_weather(connection, wanted)
+        missing = wanted.merge(cached[['latitude', 'longitude', 'date']].drop_duplicates(), how='left', indicator=True)
+        missing = missing[missing['_merge'] == 'left_only']
+        if len(missing) > 0:
+            print(f"Fetching weather for {len(missing)} of {len(wanted)} (grid cell, date)s")
+            close_backend = backend is None
+            backend = backend if backend is not None else NasaPowerBackend(max_connections=max_concurrency)
+            try:
+                await fetch_weather(missing, backend, connection, max_concurrency, retries)
+            finally:
+                if close_backend:
+                    backend.close()
+            cached = cached_weather(connection, wanted)
+    finally:
+        connection.close()
+
+    return cached
+
+def run(coroutine):
+    # asyncio.run can't be called from a running event loop (e.g. in a notebook), so the coroutine is run in its own thread instead
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+def add_weather(df, backend=None, cache_path=weather_cache_path, max_concurrency=8, retries=3):
+    # returns df with the weather_vars at the grid cell, date and hour of each row, fetching any that aren't in the cache
+    # df needs latitude, longitude, date ("YYYY-MM-DD" or datetime) and time ("HH:MM") columns, e.g. the output of read_raw_data
+    # rows whose weather couldn't be fetched have missing values
+    latitude, longitude = grid_cells(df['latitude'], df['longitude'])
+    keys = pd.DataFrame({
+        'latitude': latitude,
+        'longitude': longitude,
+        'date': pd.to_datetime(np.asarray(df['date'])).strftime("%Y-%m-%d"),
+        'hour': pd.Series(np.asarray(df['time'], dtype='object')).str.slice(0, 2).astype('float').to_numpy()
+    })
+    wanted = keys[['latitude', 'longitude', 'date']].dropna().drop_duplicates()
+
+    cached = run(update_weather(wanted, backend, cache_path, max_concurrency, retries))
+
+    # each row's weather is looked up by its (latitude, longitude, date, hour)
+    lookup = pd.MultiIndex.from_frame(cached[['latitude', 'longitude', 'date', 'hour']].astype({'hour': 'float'}))
+    positions = lookup.get_indexer(pd.MultiIndex.from_frame(keys))
+    df = df.copy(deep=False)
+    for var in weather_vars:
+        df[var] = np.append(cached[var].to_numpy(dtype='float'), np.nan)[positions]
+
+    return df
+
+def transform_raw_data_with_weather(path_to_csv, backend=None, cache_path=weather_cache_path, max_concurrency=8):
+    # transform_raw_data, with the weather_vars of each collision
+    df = read_raw_data(path_to_csv)
+    df = add_weather(df, backend=backend, cache_path=cache_path, max_concurrency=max_concurrency)
+    df_expanded, _, _ = expand_collisions(df, weather=True)
+
+    return df_expanded